@@ -10,11 +10,22 @@ def get_calc(model_spec, **kwargs):
     """Get a calculator from a trained model.
 
     The positional argument will be passed to `pinn.get_model`, keyword
-    arguments will be passed to the calculator.
+    arguments will be passed to the calculator. A SavedModel directory
+    written by `pinn export` is loaded directly. A list of models is loaded
+    as an ensemble, see `pinn.export.EnsemblePotential`.
     """
+    import os
     import tensorflow as tf
     from pinn import get_model
-    from pinn.calculator import PiNN_calc
+    from pinn.calculator import PiNN_calc, PiNN_saved_calc
+    if isinstance(model_spec, (list, tuple)):
+        from pinn.export import EnsemblePotential, load_ensemble
+        module = EnsemblePotential(load_ensemble(model_spec),
+                                   dtype=tf.keras.backend.floatx())
+        return PiNN_saved_calc(module, **kwargs)
+    if isinstance(model_spec, str) and \
+       tf.io.gfile.exists(os.path.join(model_spec, 'saved_model.pb')):
+        return PiNN_saved_calc(model_spec, **kwargs)
     if isinstance(model_spec, tf.estimator.Estimator):
         model = model_spec
     else:
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""Throughput benchmarks for the neighbor list and the networks
+
+The benchmark times each stage of a potential evaluation separately:
+
+- `nl`: the neighbor list layer of the network;
+- `preprocess`: `network.preprocess` (neighbor list and e.g. fingerprints);
+- `forward`: the network prediction, including preprocessing;
+- `forces`: prediction and forces (gradient w.r.t. the coordinates);
+- `stress`: prediction, forces and stress (periodic systems only).
+
+Each stage is traced once with `tf.function` and then timed over several
+repeats, the reported time is the median wall time per batch.
+"""
+import time
+import numpy as np
+import tensorflow as tf
+from pinn.utils import connect_dist_grad
+
+atom_types = [1, 6, 7, 8, 9]
+
+default_networks = {
+    'PiNet': {'name': 'PiNet',
+              'params': {'atom_types': atom_types, 'rc': 5.0}},
+    'PiNet2': {'name': 'PiNet2',
+               'params': {'atom_types': atom_types, 'rc': 5.0}},
+    'BPNN': {'name': 'BPNN',
+             'params': {
+                 'rc': 5.0,
+                 'sf_spec': [
+                     {'type': 'G2', 'i': 'ALL', 'j': 'ALL',
+                      'Rs': [1., 2., 3., 4.], 'eta': [1., 1., 1., 1.]},
+                     {'type': 'G4', 'i': 'ALL', 'j': 'ALL',
+                      'lambd': [1., -1.], 'zeta': [1., 1.], 'eta': [0.1, 0.1]}],
+                 'nn_spec': {e: [32, 32] for e in atom_types}}},
+    'LJ': {'name': 'LJ', 'params': {'rc': 5.0}},
+}
+
+stages = ['nl', 'preprocess', 'forward', 'forces', 'stress']
+
+
+def water_box(n_atoms, seed=0):
+    """Generates a periodic box of randomly placed water molecules
+
+    The box is sized to the density of liquid water, the molecules are
+    randomly oriented but not relaxed.
+
+    Args:
+        n_atoms (int): approximate number of atoms (rounded to molecules)
+        seed (int): random seed
+
+    Returns:
+        dict of numpy arrays with `elems`, `coord` and `cell`
+    """
+    rng = np.random.default_rng(seed)
+    n_mols = max(n_atoms//3, 1)
+    length = (n_mols/0.0334)**(1/3) # 0.0334 molecules/Å^3
+    water = np.array([[0., 0., 0.], [0.757, 0.586, 0.], [-0.757, 0.586, 0.]])
+    rot = np.linalg.qr(rng.normal(size=[n_mols, 3, 3]))[0]
+    center = rng.uniform(0, length, [n_mols, 1, 3])
+    coord = np.einsum('ij,mkj->mik', water, rot) + center
+    return {'elems': np.tile([8, 1, 1], n_mols),
+            'coord': coord.reshape([-1, 3]),
+            'cell': np.eye(3)*length}
+
+
+def qm9_like(n_atoms, seed=0):
+    """Generates a QM9-like molecule, with randomly placed atoms
+
+    The atoms are drawn from H, C, N, O and F with a composition close to
+    QM9 and placed in a sphere with roughly the density of organic
+    molecules, the structure is not periodic.
+
+    Args:
+        n_atoms (int): number of atoms
+        seed (int): random seed
+
+    Returns:
+        dict of numpy arrays with `elems` and `coord`
+    """
+    rng = np.random.default_rng(seed)
+    elems = rng.choice(atom_types, n_atoms, p=[0.51, 0.35, 0.06, 0.07, 0.01])
+    radius = (n_atoms/0.1*3/4/np.pi)**(1/3) # 0.1 atoms/Å^3
+    direction = rng.normal(size=[n_atoms, 3])
+    direction /= np.linalg.norm(direction, axis=1, keepdims=True)
+    coord = direction * radius * rng.uniform(0, 1, [n_atoms, 1])**(1/3)
+    return {'elems': elems, 'coord': coord}
+
+
+synthetic_systems = {'water': water_box, 'qm9': qm9_like}
+
+
+def make_batch(structures, dtype='float32'):
+    """Concatenates a list of structures into a sparse batch
+
+    Args:
+        structures (list): dicts with `elems`, `coord` and optionally `cell`
+        dtype (str): floating point type of the batch
+
+    Returns:
+        dict of tensors in the PiNN batch format
+    """
+    batch = {
+        'ind_1': np.concatenate([np.full([len(s['elems']), 1], i)
+                                 for i, s in enumerate(structures)]),
+        'elems': np.concatenate([s['elems'] for s in structures]),
+        'coord': np.concatenate([s['coord'] for s in structures])}
+    if 'cell' in structures[0]:
+        batch['cell'] = np.stack([s['cell'] for s in structures])
+    return {k: tf.constant(v, dtype=tf.int32 if k in ['ind_1', 'elems'] else dtype)
+            for k, v in batch.items()}
+
+
+def _get_nl(network):
+    """Returns the neighbor list layer used by a network"""
+    if hasattr(network, 'nl_layer'):
+        return network.nl_layer
+    return network.preprocess.nl_layer
+
+
+def _stage_fns(network):
+    """Builds the functions to time for each stage of a network"""
+    nl = _get_nl(network)
+
+    def _energy(tensors):
+        # per-structure energy, like potential_model
+        pred = tf.reshape(network(tensors), [-1])
+        n_structs = tf.reduce_max(tensors['ind_1'])+1
+        return tf.math.unsorted_segment_sum(pred, tensors['ind_1'][:, 0], n_structs)
+
+    def _forces(tensors):
+        with tf.GradientTape() as tape:
+            tape.watch(tensors['coord'])
+            energy = _energy(tensors)
+        return energy, -tape.gradient(energy, tensors['coord'])
+
+    def _stress(tensors):
+        # same as the potential model: reconnect diff to coord and take the
+        # pairwise gradient for the virial
+        coord = tensors['coord']
+        with tf.GradientTape() as tape:
+            tape.watch(coord)
+            tensors = network.preprocess(tensors)
+            connect_dist_grad(tensors)
+            diff = tensors['diff']
+            energy = _energy(tensors)
+        d_coord, d_diff = tape.gradient(energy, [coord, diff])
+        if isinstance(d_diff, tf.IndexedSlices):
+            d_diff = tf.math.unsorted_segment_sum(
+                d_diff.values, d_diff.indices, tf.shape(diff)[0])
+        ind = tf.gather(tensors['ind_1'][:, 0], tensors['ind_2'][:, 0])
+        stress = tf.math.unsorted_segment_sum(
+            tf.expand_dims(d_diff, 2) * tf.expand_dims(diff, 1),
+            ind, tf.shape(tensors['cell'])[0])
+        stress /= tf.reshape(tf.linalg.det(tensors['cell']), [-1, 1, 1])
+        return energy, -d_coord, stress
+
+    return {
+        'nl': lambda tensors: nl(tensors),
+        'preprocess': lambda tensors: network.preprocess(dict(tensors)),
+        'forward': lambda tensors: _energy(dict(tensors)),
+        'forces': lambda tensors: _forces(dict(tensors)),
+        'stress': lambda tensors: _stress(dict(tensors))}
+
+
+def time_stages(network, tensors, repeats=10, stages=stages):
+    """Times the stages of a network for one batch
+
+    Args:
+        network: a PiNN network (Keras model)
+        tensors (dict): a batch of input tensors
+        repeats (int): number of timed evaluations of each stage
+        stages (list): stages to time
+
+    Returns:
+        dict of median wall times per batch (in seconds), stages that do not
+        apply (stress for non-periodic systems) are set to None
+    """
+    fns = _stage_fns(network)
+    times = {}
+    for stage in stages:
+        if stage == 'stress' and 'cell' not in tensors:
+            times[stage] = None
+            continue
+        fn = tf.function(fns[stage])
+        tf.nest.map_structure(lambda x: x.numpy(), fn(tensors)) # warm up
+        elapsed = []
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            tf.nest.map_structure(lambda x: x.numpy(), fn(tensors))
+            elapsed.append(time.perf_counter() - t0)
+        times[stage] = float(np.median(elapsed))
+    return times
+
+
+def run_benchmark(networks, batches, repeats=10, stages=stages):
+    """Runs the benchmark for several networks and batches
+
+    Args:
+        networks (dict): network specifications, by label
+        batches (list): list of (label, tensors) for the batches
+        repeats (int): number of timed evaluations of each stage
+        stages (list): stages to time
+
+    Returns:
+        list of records (dict), one for each network and batch
+    """
+    import pinn
+    records = []
+    for net_label, spec in networks.items():
+        network = pinn.get_network(spec)
+        for data_label, tensors in batches:
+            n_structs = int(tf.reduce_max(tensors['ind_1']))+1
+            n_atoms = int(tf.shape(tensors['ind_1'])[0])
+            n_pairs = int(tf.shape(_get_nl(network)(tensors)['ind_2'])[0])
+            times = time_stages(network, tensors, repeats, stages)
+            records.append({
+                'network': net_label, 'data': data_label,
+                'batch_size': n_structs, 'n_atoms': n_atoms,
+                'n_pairs': n_pairs, **{f'{k}_time': v for k, v in times.items()},
+                'atoms_per_sec': n_atoms/times['forward'] if times.get('forward') else None})
+    return records
+
+
+def run_profile(networks, batches, repeats=10, logdir=None):
+    """Profiles the forward pass of networks layer by layer
+
+    The networks are run eagerly under a `LayerProfiler`, see
+    `pinn.profiler.LayerProfiler` for details.
+
+    Args:
+        networks (dict): network specifications, by label
+        batches (list): list of (label, tensors) for the batches
+        repeats (int): number of profiled evaluations
+        logdir (str): if set, write `tf.profiler` traces there
+
+    Returns:
+        list of records (dict), one for each network, batch and layer
+    """
+    import pinn
+    from pinn.profiler import LayerProfiler
+    records = []
+    for net_label, spec in networks.items():
+        network = pinn.get_network(spec)
+        for data_label, tensors in batches:
+            network(dict(tensors)) # build the layers
+            with LayerProfiler(network, logdir=logdir) as profiler:
+                for _ in range(repeats):
+                    network(dict(tensors))
+            records += [{'network': net_label, 'data': data_label, **r}
+                        for r in profiler.records()]
+    return records
+
+
+def write_report(records, output, fmt='json'):
+    """Writes the benchmark records as JSON or CSV
+
+    Args:
+        records (list): records from `run_benchmark`
+        output: file object to write to
+        fmt (str): 'json' or 'csv'
+    """
+    if fmt == 'json':
+        import json
+        json.dump(records, output, indent=2)
+        output.write('\n')
+    elif fmt == 'csv':
+        import csv
+        writer = csv.DictWriter(output, fieldnames=list(records[0].keys()))
+        writer.writeheader()
+        writer.writerows(records)
+    else:
+        raise ValueError(f'Unknown report format {fmt}')
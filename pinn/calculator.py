@@ -97,3 +97,57 @@ class PiNN_calc(Calculator):
         if 'stress' in results and self._atoms_to_calc.pbc.all():
             results['stress'] = results['stress'].flat[[0, 4, 8, 5, 2, 1]]
         self.results = results
+
+
+class PiNN_saved_calc(Calculator):
+    def __init__(self, export_dir, atoms=None, to_eV=1.0,
+                 properties=['energy', 'forces', 'stress']):
+        """ASE calculator for a potential exported with `pinn export`
+
+        The SavedModel is loaded directly, its functions are already traced,
+        so no model parameters or checkpoints are needed.
+
+        For ensembles, the mean energy, forces and stress of the members are
+        calculated, with their standard deviations as the `energy_std` and
+        (per-atom) `forces_std` properties.
+
+        Args:
+            export_dir: directory of the SavedModel, or an `ExportedPotential`
+                or `EnsemblePotential` module
+            atoms: optional, ase Atoms object
+            to_eV: conversion of the energy unit of the model to eV
+            properties: properties to calculate, the stress is only
+                calculated for periodic structures
+        """
+        Calculator.__init__(self, atoms=atoms)
+        if isinstance(export_dir, str):
+            self.module = tf.saved_model.load(export_dir)
+        else:
+            self.module = export_dir
+        self.implemented_properties = list(properties)
+        if hasattr(self.module, 'n_members'):
+            self.implemented_properties += [
+                f'{p}_std' for p in ['energy', 'forces'] if p in properties]
+        self.to_eV = to_eV
+        self.dtype = self.module.energy.input_signature[0]['coord'].dtype
+
+    def calculate(self, atoms=None, properties=None, system_changes=None):
+        """Run a calculation, the properties of the calculator are computed
+        with the exported function, regardless of `properties`."""
+        from pinn.export import signature_name
+        Calculator.calculate(self, atoms, properties, system_changes)
+        pbc = self.atoms.pbc.any()
+        tensors = {
+            'coord': tf.constant(self.atoms.positions, self.dtype),
+            'elems': tf.constant(self.atoms.numbers, tf.int32),
+            'ind_1': tf.zeros([len(self.atoms), 1], tf.int32)}
+        if pbc:
+            tensors['cell'] = tf.constant(self.atoms.cell[np.newaxis, :, :], self.dtype)
+        properties = [p for p in self.implemented_properties if pbc or p != 'stress']
+        fn = getattr(self.module, signature_name(properties, pbc))
+        results = {k: v.numpy() if k.startswith('forces') else v.numpy()[0]
+                   for k, v in fn(tensors).items()}
+        results = {k: v*self.to_eV for k, v in results.items()}
+        if 'stress' in results and self.atoms.pbc.all():
+            results['stress'] = results['stress'].flat[[0, 4, 8, 5, 2, 1]]
+        self.results = results
@@ -6,7 +6,7 @@ import operator
 from pathlib import Path
 import random
 import subprocess
-import click, pinn, os
+import click, pinn, os, json
 from pinn.report import report_log
 from typing import List
 
@@ -73,15 +73,29 @@ def convert(filename, fmt, output, shuffle, seed, total):
 @click.option('--ckpt-every', metavar='', default=10000, type=int, show_default=True)
 @click.option('--max-ckpts', metavar='', default=1, type=int, show_default=True)
 @click.option('--early-stop', metavar='', type=str, default=None, help="[default: None]")
+@click.option('--accum-steps', metavar='', type=int, default=None, help="[default: None (keep as params)]")
+@click.option('--workers', metavar='', default=1, type=int, show_default=True)
+@click.option('--distribute/--no-distribute', metavar='', default=False, show_default=True)
+@click.option('--threads', metavar='', type=int, default=None, help="[default: None (TF default)]")
 @click.option('--init/--no-init', metavar='', default=False, show_default=True)
 def train(params, model_dir, train_ds, eval_ds, batch, cache, preprocess,
           scratch_dir, train_steps, eval_steps, shuffle_buffer,
-          max_ckpts, log_every, ckpt_every, early_stop, init):
+          max_ckpts, log_every, ckpt_every, early_stop, accum_steps,
+          workers, distribute, threads, init):
     """Train a model with PiNN.
 
     See the documentation for more detailed descriptions of the options
     https://Teoroo-CMC.github.io/PiNN/latest/usage/cli/train/
     """
+    if (workers > 1 or distribute) and early_stop:
+        raise click.UsageError('--early-stop is not supported in distributed training.')
+    if workers > 1:
+        kwargs = dict(click.get_current_context().params, workers=1, distribute=True)
+        if threads is None:
+            kwargs['threads'] = max(1, os.cpu_count()//workers)
+        _spawn_workers(workers, kwargs)
+        return
+
     import yaml, warnings
     import tensorflow as tf
     from shutil import rmtree
@@ -98,6 +112,8 @@ def train(params, model_dir, train_ds, eval_ds, batch, cache, preprocess,
         params = yaml.load(f, Loader=yaml.Loader)
     if model_dir is not None:
         params['model_dir'] = model_dir
+    if accum_steps is not None:
+        params['model'].setdefault('params', {})['accum_steps'] = accum_steps
 
     if init:
         ds = load_tfrecord(train_ds)
@@ -105,8 +121,12 @@ def train(params, model_dir, train_ds, eval_ds, batch, cache, preprocess,
 
     if scratch_dir is not None:
         scratch_dir = mkdtemp(prefix='pinn', dir=scratch_dir)
-    def _dataset_fn(fname):
+    def _dataset_fn(fname, input_context=None):
         dataset = load_tfrecord(fname)
+        if input_context is not None:
+            # each replica reads a disjoint shard of the dataset
+            dataset = dataset.shard(input_context.num_input_pipelines,
+                                    input_context.input_pipeline_id)
         if batch is not None:
             dataset = dataset.apply(sparse_batch(batch))
         if preprocess:
@@ -124,12 +144,31 @@ def train(params, model_dir, train_ds, eval_ds, batch, cache, preprocess,
             dataset = dataset.cache(cache_dir)
         return dataset
 
-    train_fn = lambda: _dataset_fn(train_ds).repeat().shuffle(shuffle_buffer)
+    train_fn = lambda input_context=None: _dataset_fn(
+        train_ds, input_context).repeat().shuffle(shuffle_buffer)
     eval_fn = lambda: _dataset_fn(eval_ds)
+    session_config, strategy = None, None
+    if threads is not None:
+        session_config = tf.compat.v1.ConfigProto(
+            intra_op_parallelism_threads=threads)
+    task = json.loads(os.environ.get('TF_CONFIG', '{}')).get('task', {})
+    evaluator = distribute and task.get('type') == 'evaluator'
+    if evaluator:
+        # the evaluator runs as a local estimator on the saved checkpoints
+        os.environ.pop('TF_CONFIG')
+    elif distribute:
+        # all-reduce the gradients between the workers listed in TF_CONFIG
+        tf.compat.v1.disable_eager_execution()
+        ring = tf.distribute.experimental.CommunicationImplementation.RING
+        strategy = tf.distribute.MultiWorkerMirroredStrategy(
+            communication_options=tf.distribute.experimental.CommunicationOptions(
+                implementation=ring))
     config = tf.estimator.RunConfig(keep_checkpoint_max=max_ckpts,
                                     log_step_count_steps=log_every,
                                     save_summary_steps=log_every,
-                                    save_checkpoints_steps=ckpt_every)
+                                    save_checkpoints_steps=ckpt_every,
+                                    session_config=session_config,
+                                    train_distribute=strategy)
 
     model = get_model(params, config=config)
     if early_stop:
@@ -141,10 +180,66 @@ def train(params, model_dir, train_ds, eval_ds, batch, cache, preprocess,
         hooks=None
     train_spec = tf.estimator.TrainSpec(input_fn=train_fn, max_steps=train_steps, hooks=hooks)
     eval_spec  = tf.estimator.EvalSpec(input_fn=eval_fn, steps=eval_steps)
-    tf.estimator.train_and_evaluate(model, train_spec, eval_spec)
+    if evaluator:
+        _evaluate_checkpoints(model, eval_fn, eval_steps, train_steps)
+    else:
+        tf.estimator.train_and_evaluate(model, train_spec, eval_spec)
     if scratch_dir is not None:
         rmtree(scratch_dir)
 
+
+def _evaluate_checkpoints(model, eval_fn, eval_steps, train_steps):
+    """Evaluates new checkpoints until the last training step is reached"""
+    import tensorflow as tf
+    for ckpt in tf.train.checkpoints_iterator(model.model_dir):
+        try:
+            results = model.evaluate(eval_fn, steps=eval_steps, checkpoint_path=ckpt)
+        except (ValueError, tf.errors.NotFoundError):
+            continue # the checkpoint was removed before it was read
+        if results['global_step'] >= train_steps:
+            break
+
+
+def _train_worker(tf_config, kwargs):
+    os.environ['TF_CONFIG'] = json.dumps(tf_config)
+    train.callback(**kwargs)
+
+
+def _spawn_workers(n_workers, kwargs):
+    """Runs n_workers training processes and one evaluator on this host"""
+    import socket
+    import multiprocessing as mp
+    from multiprocessing.connection import wait
+    ports = []
+    for _ in range(n_workers+1):
+        with socket.socket() as s:
+            s.bind(('localhost', 0))
+            ports.append(s.getsockname()[1])
+    cluster = {'worker': [f'localhost:{port}' for port in ports[:-1]],
+               'evaluator': [f'localhost:{ports[-1]}']}
+    tasks = [{'type': 'worker', 'index': i} for i in range(n_workers)]
+    tasks += [{'type': 'evaluator', 'index': 0}]
+    ctx = mp.get_context('spawn')
+    procs = [ctx.Process(target=_train_worker,
+                         args=({'cluster': cluster, 'task': task}, kwargs))
+             for task in tasks]
+    for p in procs:
+        p.start()
+    try:
+        running = list(procs)
+        while running:
+            for sentinel in wait([p.sentinel for p in running]):
+                p = next(p for p in running if p.sentinel == sentinel)
+                running.remove(p)
+                p.join()
+                if p.exitcode != 0:
+                    raise click.ClickException(
+                        f'training process {procs.index(p)} exited with code {p.exitcode}')
+    finally:
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+
 @click.command(name='log', context_settings=CONTEXT_SETTINGS,
                options_metavar='[options]', short_help='inspect training logs')
 @click.argument('logdir', metavar='logdir', nargs=1)
@@ -172,12 +267,12 @@ def log(logdir, tag, fmt):
     steps = [logs[k][:,0] for k in keys]
     data = [logs[k][:,1] for k in keys]
     steps, rows = np.unique(np.concatenate(steps), return_inverse=True)
-    cols = np.concatenate([np.full_like(v, i, np.int) for i, v in enumerate(data)])
+    cols = np.concatenate([np.full_like(v, i, int) for i, v in enumerate(data)])
 
     tmp = np.full([len(steps), len(logs.values())], np.nan)
     tmp[rows, cols] = np.concatenate(data)
     out = np.concatenate([steps[:,None], tmp], axis=1)
-    header = ('Step',*[k.replace('METRICS/','') for k in keys])
+    header = ('Step',*[k.replace('METRICS/','').replace('THROUGHPUT/','') for k in keys])
     np.savetxt(stdout, out, '%-9d '+fmt*tmp.shape[1],
                header='  '.join(header))
 
@@ -191,12 +286,106 @@ def report(model_host_path:str, filter:List[str], log_name:str='eval.log'):
     log_paths = model_host_path.glob(f'**/{log_name}')
     report_log(list(map(str, map(lambda x:x.parent, log_paths))), filter, log_name)
 
+@click.command(name='benchmark', context_settings=CONTEXT_SETTINGS,
+               options_metavar='[options]', short_help='benchmark networks')
+@click.argument('params', metavar='params', nargs=-1)
+@click.option('-n', '--network', metavar='', default='PiNet,PiNet2,BPNN,LJ', show_default=True)
+@click.option('-d', '--dataset', metavar='', default=None)
+@click.option('-s', '--system', metavar='', default='water,qm9', show_default=True)
+@click.option('--sizes', metavar='', default='24,192,1536', show_default=True)
+@click.option('-b', '--batch', metavar='', default='1,8', show_default=True)
+@click.option('-r', '--repeats', metavar='', default=10, type=int, show_default=True)
+@click.option('--stages', metavar='', default='nl,preprocess,forward,forces,stress', show_default=True)
+@click.option('-f', '--fmt', metavar='', default='json', type=click.Choice(['json', 'csv']), show_default=True)
+@click.option('-o', '--output', metavar='', default='-', show_default=True)
+@click.option('--profile/--no-profile', metavar='', default=False, show_default=True)
+@click.option('--trace-dir', metavar='', default=None)
+def benchmark(params, network, dataset, system, sizes, batch, repeats, stages, fmt, output,
+              profile, trace_dir):
+    """Benchmark the neighbor list and networks stage by stage
+
+    The networks are taken from the params files if given, or the default
+    networks listed with --network otherwise. The data are read from
+    --dataset, or generated for the synthetic --system at the given --sizes
+    (number of atoms per structure). With --profile, the forward pass is
+    profiled layer by layer instead.
+
+    See the documentation for more detailed descriptions of the options
+    https://Teoroo-CMC.github.io/PiNN/latest/usage/cli/benchmark/
+    """
+    import yaml
+    from pinn.benchmark import (default_networks, synthetic_systems, make_batch,
+                                run_benchmark, run_profile, write_report)
+    _split = lambda arg: [x for x in arg.split(',') if x]
+    if params:
+        networks = {}
+        for fname in params:
+            with open(fname) as f:
+                networks[fname] = yaml.safe_load(f)['network']
+    else:
+        networks = {name: default_networks[name] for name in _split(network)}
+    batch_sizes = [int(b) for b in _split(batch)]
+    batches = []
+    if dataset is not None:
+        from pinn.io import load_ds, sparse_batch
+        ds = load_ds(dataset)
+        for b in batch_sizes:
+            tensors = next(iter(ds.apply(sparse_batch(b))))
+            tensors = {k: tensors[k] for k in ['ind_1', 'elems', 'coord', 'cell']
+                       if k in tensors}
+            batches.append((dataset, tensors))
+    else:
+        for sys in _split(system):
+            for size in [int(n) for n in _split(sizes)]:
+                for b in batch_sizes:
+                    structures = [synthetic_systems[sys](size, seed=i) for i in range(b)]
+                    batches.append((f'{sys}-{size}', make_batch(structures)))
+    if profile or trace_dir:
+        records = run_profile(networks, batches, repeats, trace_dir)
+    else:
+        records = run_benchmark(networks, batches, repeats, _split(stages))
+    with click.open_file(output, 'w') as f:
+        write_report(records, f, fmt)
+
+
+@click.command(name='export', context_settings=CONTEXT_SETTINGS,
+               options_metavar='[options]', short_help='export a potential as SavedModel')
+@click.argument('model_dir', metavar='model_dir', nargs=-1, required=True)
+@click.argument('export_dir', metavar='export_dir', nargs=1)
+@click.option('-c', '--checkpoint', metavar='', default=None, multiple=True,
+              help="[default: None (latest)], once for each model_dir")
+def export(model_dir, export_dir, checkpoint):
+    """Export a trained potential as a TensorFlow SavedModel
+
+    The SavedModel contains the network weights and the traced functions
+    for energies, forces and stress (with and without periodic boundary
+    conditions), with the unit conversions of the model. It can be loaded
+    with `pinn.get_calc(export_dir)`. Several model_dirs are exported as an
+    ensemble.
+
+    See the documentation for more detailed descriptions of the options
+    https://Teoroo-CMC.github.io/PiNN/latest/usage/cli/export/
+    """
+    from pinn.export import export_potential
+    checkpoint = list(checkpoint) or None
+    if checkpoint is not None and len(checkpoint) != len(model_dir):
+        raise click.BadParameter('give one checkpoint for each model_dir',
+                                 param_hint='--checkpoint')
+    if len(model_dir) == 1:
+        export_potential(model_dir[0], export_dir, checkpoint and checkpoint[0])
+        click.echo(f'Exported {model_dir[0]} to {export_dir}.')
+    else:
+        export_potential(list(model_dir), export_dir, checkpoint)
+        click.echo(f'Exported an ensemble of {len(model_dir)} models to {export_dir}.')
+
 
 main.add_command(convert)
 main.add_command(train)
 main.add_command(log)
 main.add_command(version)
 main.add_command(report)
+main.add_command(benchmark)
+main.add_command(export)
 
 if __name__ == '__main__':
     main()
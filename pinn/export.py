@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""Export trained potentials as TensorFlow SavedModels
+
+The exported model holds the network weights and pre-traced inference
+functions, including the neighbor list and the unit conversions of the
+potential model (`e_scale`, `e_unit` and `e_dress`), so that it can be used
+without the params file, the estimator or tracing the graph again.
+"""
+import numpy as np
+import tensorflow as tf
+from pinn.utils import atomic_dress, connect_dist_grad
+
+signatures = {
+    'energy': (['energy'], False),
+    'energy_forces': (['energy', 'forces'], False),
+    'energy_pbc': (['energy'], True),
+    'energy_forces_pbc': (['energy', 'forces'], True),
+    'energy_forces_stress_pbc': (['energy', 'forces', 'stress'], True),
+}
+
+
+def signature_name(properties, pbc):
+    """Name of the exported function computing the properties"""
+    outputs = [p for p in ['energy', 'forces', 'stress'] if p in properties or p == 'energy']
+    name = '_'.join(outputs) + ('_pbc' if pbc else '')
+    if name not in signatures:
+        raise ValueError(f'No exported function for {properties} with pbc={pbc}')
+    return name
+
+
+def restore_network(params, checkpoint=None):
+    """Builds the network of a model and restores its weights
+
+    The variable names are those of the network built in a new graph, as in
+    the estimator; the weights are then assigned to an eager copy of the
+    network, whose variables are created in the same order.
+
+    Args:
+        params (dict): model parameters, with `model_dir` and `network`
+        checkpoint (str): checkpoint to restore (default: the latest in
+            `model_dir`)
+
+    Returns:
+        the network, with restored weights
+    """
+    from pinn import get_network
+    from pinn.benchmark import make_batch, water_box
+    if checkpoint is None:
+        checkpoint = tf.train.latest_checkpoint(params['model_dir'])
+    if checkpoint is None:
+        raise ValueError(f"No checkpoint found in {params['model_dir']}")
+    reader = tf.train.load_checkpoint(checkpoint)
+    # dummy structure to build the variables
+    network_params = params['network'].get('params', {})
+    elems = network_params.get('atom_types', list(network_params.get('nn_spec', [1])))
+    dummy = water_box(6)
+    dummy['elems'] = np.full_like(dummy['elems'], elems[0])
+    with tf.Graph().as_default():
+        network = get_network(params['network'])
+        network(make_batch([dummy]))
+        names = [v.name.split(':')[0] for v in network.variables]
+    missing = [n for n in names if not reader.has_tensor(n)]
+    if missing:
+        raise ValueError(f'Variables {missing} not found in {checkpoint}')
+    network = get_network(params['network'])
+    network(make_batch([dummy]))
+    for name, var in zip(names, network.variables):
+        var.assign(reader.get_tensor(name))
+    return network
+
+
+def potential_energy(network, tensors, model_params):
+    """Per-structure energies of a potential model, in its output unit
+
+    Args:
+        network: the network of the model
+        tensors (dict of tensors): input tensors, preprocessed or not
+        model_params (dict): parameters of the potential model, with
+            `e_scale`, `e_unit` and `e_dress`
+
+    Returns:
+        energies with shape `(n_structures)`
+    """
+    pred = network(tensors)
+    n_structs = tf.reduce_max(tensors['ind_1'])+1
+    energy = tf.math.unsorted_segment_sum(pred, tensors['ind_1'][:, 0], n_structs)
+    energy = energy / model_params['e_scale']
+    if model_params['e_dress']:
+        energy += atomic_dress(tensors, model_params['e_dress'], dtype=energy.dtype)
+    return energy * model_params['e_unit']
+
+
+class ExportedPotential(tf.Module):
+    """Inference functions of a potential model
+
+    Each function takes `coord` `(n_atoms, 3)`, `elems` `(n_atoms)` and
+    `ind_1` `(n_atoms, 1)`, plus `cell` `(n_structures, 3, 3)` for periodic
+    structures, and returns a dictionary with the per-structure `energy`,
+    the `forces` and the per-structure `stress`, in the output unit of the
+    model.
+    """
+
+    def __init__(self, network, model_params, dtype=tf.float32):
+        super(ExportedPotential, self).__init__()
+        self._setup([(network, model_params, None)], dtype)
+
+    def _setup(self, members, dtype):
+        # only the weights are saved, the attributes of some networks (e.g.
+        # the element keys of BPNN) can not be, the functions use the network
+        self.weights = [v for network, _, _ in members for v in network.variables]
+        self.dtype = dtype
+        for name, (properties, pbc) in signatures.items():
+            setattr(self, name, self._make_fn(members, properties, pbc))
+
+    def _combine(self, outputs):
+        """outputs of the function from those of each member"""
+        return outputs[0]
+
+    def _make_fn(self, members, properties, pbc):
+        spec = {'coord': tf.TensorSpec([None, 3], self.dtype, name='coord'),
+                'elems': tf.TensorSpec([None], tf.int32, name='elems'),
+                'ind_1': tf.TensorSpec([None, 1], tf.int32, name='ind_1')}
+        if pbc:
+            spec['cell'] = tf.TensorSpec([None, 3, 3], self.dtype, name='cell')
+
+        @tf.function(input_signature=[spec])
+        def fn(tensors):
+            coord = tensors['coord']
+            with tf.GradientTape(persistent=len(members) > 1) as tape:
+                tape.watch(coord)
+                member_tensors = _preprocess(members, tensors)
+                energies = [potential_energy(network, member_tensors[i], model_params)
+                            for i, (network, model_params, _) in enumerate(members)]
+            return self._combine([
+                _derivatives(tape, energy, coord, tensors, properties)
+                for energy, tensors in zip(energies, member_tensors)])
+        return fn
+
+
+class EnsemblePotential(ExportedPotential):
+    """Inference functions of an ensemble of potential models
+
+    The functions take the same inputs as `ExportedPotential`, and return
+    the mean `energy`, `forces` and `stress` of the members, with the
+    standard deviation of the energy of each structure (`energy_std`) and
+    of the forces on each atom (`forces_std`, the root mean square of the
+    deviation of the force vectors from the mean).
+
+    The neighbor list and the basis are computed once for the members with
+    the same preprocessing parameters (e.g. the same `rc` and basis).
+    """
+
+    def __init__(self, members, dtype=tf.float32):
+        """
+        Args:
+            members (list): `(network, model_params, network_params)` of
+                each member, see `load_ensemble`
+            dtype: dtype of the coordinates
+        """
+        super(ExportedPotential, self).__init__()
+        self.n_members = tf.Variable(len(members), trainable=False)
+        self._setup([(network, model_params, preprocess_key(network_params))
+                     for network, model_params, network_params in members], dtype)
+
+    def _combine(self, outputs):
+        outputs = {k: tf.stack([o[k] for o in outputs]) for k in outputs[0]}
+        combined = {k: tf.reduce_mean(v, axis=0) for k, v in outputs.items()}
+        combined['energy_std'] = tf.math.reduce_std(outputs['energy'], axis=0)
+        if 'forces' in outputs:
+            deviation = outputs['forces'] - combined['forces']
+            combined['forces_std'] = tf.sqrt(
+                tf.reduce_mean(tf.reduce_sum(deviation**2, axis=2), axis=0))
+        return combined
+
+
+# parameters of the networks that determine the preprocessed tensors and the
+# basis, ensemble members that agree on them share the preprocessing
+_preprocess_params = {
+    'PiNet': ['atom_types', 'rc', 'cutoff_type', 'basis_type', 'n_basis', 'gamma',
+              'center', 'nl_dtype', 'csr', 'nl_type', 'nl_max_atoms', 'basis_table'],
+    'PiNet2': ['atom_types', 'rc', 'cutoff_type', 'basis_type', 'n_basis', 'gamma',
+               'center', 'nl_dtype', 'csr', 'nl_type', 'nl_max_atoms', 'basis_table'],
+    'BPNN': ['sf_spec', 'rc', 'cutoff_type', 'use_jacobian', 'nl_dtype', 'csr',
+             'nl_type', 'nl_max_atoms', 'basis_table'],
+    'LJ': ['rc'],
+}
+
+
+def preprocess_key(network_params):
+    """Key of the preprocessing of a network, networks with the same key
+    produce the same preprocessed tensors and basis
+
+    Args:
+        network_params (dict): network specification, with `name` and
+            `params`
+
+    Returns:
+        a hashable key, unique for networks not known to PiNN
+    """
+    import inspect
+    from pinn.networks.pinet import PiNet
+    from pinn.networks.pinet2 import PiNet2
+    from pinn.networks.bpnn import BPNN
+    from pinn.networks.lj import LJ
+    name = network_params['name']
+    if name not in _preprocess_params:
+        return id(network_params)
+    network_cls = {'PiNet': PiNet, 'PiNet2': PiNet2, 'BPNN': BPNN, 'LJ': LJ}[name]
+    defaults = inspect.signature(network_cls.__init__).parameters
+    params = network_params.get('params', {})
+    return (name, *[(k, repr(params.get(k, defaults[k].default)))
+                    for k in _preprocess_params[name]])
+
+
+def _preprocess(members, tensors):
+    """Preprocessed tensors of each member, computed once for the members
+    with the same preprocessing key"""
+    shared, member_tensors = {}, []
+    for i, (network, _, key) in enumerate(members):
+        key = i if key is None else key
+        if key not in shared:
+            preprocessed = network.preprocess(dict(tensors))
+            connect_dist_grad(preprocessed)
+            if hasattr(network, 'cutoff_basis'):
+                preprocessed['basis'] = network.cutoff_basis(preprocessed['dist'])
+            shared[key] = preprocessed
+        member_tensors.append(shared[key])
+    return member_tensors
+
+
+def _derivatives(tape, energy, coord, tensors, properties):
+    """forces and stress from the energy, with the preprocessed tensors"""
+    outputs = {'energy': energy}
+    if 'stress' in properties:
+        d_coord, d_diff = tape.gradient(energy, [coord, tensors['diff']])
+        if isinstance(d_diff, tf.IndexedSlices):
+            d_diff = tf.math.unsorted_segment_sum(
+                d_diff.values, d_diff.indices, tf.shape(tensors['diff'])[0])
+        # same as the potential model, the virial of each structure
+        ind = tf.gather(tensors['ind_1'][:, 0], tensors['ind_2'][:, 0])
+        stress = tf.math.unsorted_segment_sum(
+            tf.expand_dims(d_diff, 1) * tf.expand_dims(tensors['diff'], 2),
+            ind, tf.shape(tensors['cell'])[0])
+        stress /= tf.reshape(tf.linalg.det(tensors['cell']), [-1, 1, 1])
+        outputs['stress'] = stress
+    elif 'forces' in properties:
+        d_coord = tape.gradient(energy, coord)
+    if 'forces' in properties:
+        outputs['forces'] = -tf.convert_to_tensor(d_coord)
+    return outputs
+
+
+def load_params(model_spec):
+    """Parameters of a model
+
+    Args:
+        model_spec: model_dir, params file or params dict of the model
+
+    Returns:
+        the params dict, with `model_dir` for model directories
+    """
+    import yaml, os
+    if not isinstance(model_spec, str):
+        return model_spec
+    if tf.io.gfile.isdir(model_spec):
+        params_file = os.path.join(model_spec, 'params.yml')
+        with tf.io.gfile.GFile(params_file) as f:
+            return dict(yaml.load(f, Loader=yaml.Loader), model_dir=model_spec)
+    with tf.io.gfile.GFile(model_spec) as f:
+        return yaml.load(f, Loader=yaml.Loader)
+
+
+def load_potential(model_spec, checkpoint=None):
+    """Restores the network of a trained potential model
+
+    Args:
+        model_spec: model_dir, params file or params dict of the model
+        checkpoint (str): checkpoint to restore (default: the latest)
+
+    Returns:
+        the network with restored weights, and the parameters of the
+        potential model
+    """
+    from pinn.models.potential import default_params
+    params = load_params(model_spec)
+    if params['model']['name'] != 'potential_model':
+        raise NotImplementedError(
+            f"Exporting {params['model']['name']} is not supported")
+    model_params = {**default_params, **params['model'].get('params', {})}
+    model_params['e_dress'] = {int(k): float(v) for k, v in model_params['e_dress'].items()}
+    return restore_network(params, checkpoint), model_params
+
+
+def load_ensemble(model_specs, checkpoints=None):
+    """Restores the members of an ensemble of potential models
+
+    Args:
+        model_specs (list): model_dir, params file or params dict of each
+            model
+        checkpoints (list): checkpoint to restore for each model (default:
+            the latest)
+
+    Returns:
+        the `(network, model_params, network_params)` of each member
+    """
+    if checkpoints is None:
+        checkpoints = [None] * len(model_specs)
+    return [(*load_potential(spec, checkpoint), load_params(spec)['network'])
+            for spec, checkpoint in zip(model_specs, checkpoints)]
+
+
+def export_potential(model_spec, export_dir, checkpoint=None):
+    """Exports a trained potential model as a SavedModel
+
+    Args:
+        model_spec: model_dir, params file or params dict of the model, or
+            a list of them to export an ensemble
+        export_dir (str): directory to write the SavedModel to
+        checkpoint: checkpoint to export (default: the latest), a list of
+            checkpoints for an ensemble
+
+    Returns:
+        the exported `ExportedPotential` or `EnsemblePotential` module
+    """
+    dtype = tf.keras.backend.floatx()
+    if isinstance(model_spec, (list, tuple)):
+        module = EnsemblePotential(load_ensemble(model_spec, checkpoint), dtype=dtype)
+    else:
+        module = ExportedPotential(*load_potential(model_spec, checkpoint), dtype=dtype)
+    # the functions already return the gradients, the custom gradients of
+    # the network layers are not needed in the SavedModel
+    options = tf.saved_model.SaveOptions(experimental_custom_gradients=False)
+    tf.saved_model.save(module, export_dir, options=options,
+                        signatures={name: getattr(module, name) for name in signatures})
+    return module
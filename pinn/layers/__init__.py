@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from .nl import CellListNL
-from .basis import CutoffFunc, GaussianBasis, PolynomialBasis
+from .nl import CellListNL, AllPairsNL, AutoNL, get_nl_layer
+from .basis import CutoffFunc, GaussianBasis, PolynomialBasis, CutoffBasis, \
+    TabulatedBasis
 from .misc import AtomicOnehot, ANNOutput
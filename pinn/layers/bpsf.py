@@ -9,13 +9,19 @@ and the caching of Jacobian are implemented in `networks.bpnn.BPFingerprint`.
 
 import numpy as np
 import tensorflow as tf
-from pinn.utils import pi_named
-from .basis import GaussianBasis
+from pinn.utils import pi_named, sorted_segment_sum
+from .basis import GaussianBasis, CutoffBasis
 
 
-def sf2fp(i_rind, a_rind, sf):
-    """Helper function to concatenat"""
+def sf2fp(i_rind, a_rind, sf, row_ptr=None):
+    """Helper function to concatenat
+
+    If the offsets row_ptr of the neighbor list are given, the pairs (and
+    triplets) are sorted by i and a sorted segment sum is used.
+    """
     n_sf = sf.shape[-1]
+    if row_ptr is not None:
+        return sorted_segment_sum(sf, i_rind, tf.reduce_max(a_rind)+1)
     fp = tf.scatter_nd(tf.expand_dims(i_rind, 1), sf,
                        [tf.reduce_max(a_rind)+1, n_sf])
     return fp
@@ -67,26 +73,30 @@ def _triplet_filter(ind_2, ind_3, elems, i, j, k):
 
 
 class G2_SF(tf.keras.layers.Layer):
-    def __init__(self, Rs, eta, i="ALL", j="ALL"):
+    def __init__(self, Rs, eta, i="ALL", j="ALL", cutoff=None):
         """
         Args:
             Rs (list of floats): Gaussian centers
             eta (list of floats): Gaussian widths
             i (str): species i
             j (str): species j
+            cutoff (layer, optional): cutoff function, when given the cutoff
+                is applied with the basis and `fc` is not needed in call
         """
         super(G2_SF, self).__init__()
         self.basis = GaussianBasis(center=Rs, gamma=eta)
+        self.cutoff_basis = None if cutoff is None else CutoffBasis(cutoff, self.basis)
         self.i = i
         self.j = j
 
-    def call(self, ind_2, dist, elems, fc):
+    def call(self, ind_2, dist, elems, fc=None, row_ptr=None):
         """
         Args:
             ind_2: (N_pair x 2) indices for each pair
             dist: (N_pair) array of distance
             elems: (N_atom) elements for each atom
-            fc: (N_pair) cutoff functio  n
+            fc: (N_pair) cutoff function, not needed if the cutoff is given
+            row_ptr: (N_atom+1) offsets of the pairs, if the pairs are sorted
 
         Returns:
             fp: a (n_atom x n_fingerprint) tensor of fingerprints
@@ -109,13 +119,16 @@ class G2_SF(tf.keras.layers.Layer):
             p_filter = tf.reduce_all(p_filter, axis=0)
             p_ind = tf.cast(tf.where(p_filter)[:, 0], tf.int32)
             dist = tf.gather(dist, p_ind)
-            fc = tf.gather(fc, p_ind)
+            fc = None if fc is None else tf.gather(fc, p_ind)
             i_rind = tf.gather(a_rind, tf.gather(i_rind, p_ind))
         else:
             p_ind = tf.cumsum(tf.ones_like(i_rind))-1
 
-        sf = self.basis(dist, fc)
-        fp = sf2fp(i_rind, a_rind, sf)
+        if self.cutoff_basis is not None:
+            sf = self.cutoff_basis(dist)
+        else:
+            sf = self.basis(dist, fc)
+        fp = sf2fp(i_rind, a_rind, sf, row_ptr)
         jacob_ind = tf.stack([p_ind, i_rind], axis=1)
         return fp, jacob_ind
 
@@ -129,6 +142,8 @@ class G3_SF(tf.keras.layers.Layer):
             lambd (list of floats): lambda parameter of G3 SF
             zeta (list of floats): zeta parameter of G3 SF
             eta (list of floats): Gaussian widths
+            cutoff (layer): cutoff function
+            rc (float): cutoff radius
             i (str): species i
             j (str): species j
             k (str): species k
@@ -138,12 +153,13 @@ class G3_SF(tf.keras.layers.Layer):
         self.zeta = tf.cast(zeta, tf.keras.backend.floatx())
         self.basis = GaussianBasis(center=np.zeros_like(eta), gamma=eta)
         self.cutoff = cutoff
+        self.cutoff_basis = CutoffBasis(cutoff, self.basis)
         self.rc = rc
         self.i = i
         self.j = j
         self.k = k
 
-    def call(self, ind_2, ind_3, dist, diff, elems, fc):
+    def call(self, ind_2, ind_3, dist, diff, elems, fc=None, row_ptr=None):
         """
 
         Args:
@@ -152,7 +168,8 @@ class G3_SF(tf.keras.layers.Layer):
             dist: (N_pair) array of distance
             diff: (N_pair) array of bond vectors
             elems: (N_atom) elements for each atom
-            fc: (N_pair) cutoff functio  n
+            fc: (N_pair) cutoff function, not needed if the cutoff is given
+            row_ptr: (N_atom+1) offsets of the pairs, if the pairs are sorted
 
         Returns:
             fp: a (n_atom x n_fingerprint) tensor of fingerprints
@@ -177,7 +194,6 @@ class G3_SF(tf.keras.layers.Layer):
         dist_jk = tf.norm(diff_jk, axis=1)
         t_ind = tf.where(dist_jk < self.rc)[:, 0]
         dist_jk = tf.gather(dist_jk, t_ind)
-        fc_jk = self.cutoff(dist_jk)
         # other distances/vectors are gathered from the neighbor list
         ind_ij = tf.gather(ind_ij, t_ind)
         ind_ik = tf.gather(ind_ik, t_ind)
@@ -186,19 +202,19 @@ class G3_SF(tf.keras.layers.Layer):
         diff_ik = tf.gather(diff, ind_ik)
         dist_ij = tf.gather(dist, ind_ij)
         dist_ik = tf.gather(dist, ind_ik)
-        fc_ij = tf.gather(fc, ind_ij)
-        fc_ik = tf.gather(fc, ind_ik)
+        # the ij/ik basis is evaluated once per pair and gathered to triplets
+        basis = self.cutoff_basis(dist)
 
         cos_ijk = tf.einsum("id,id->i", diff_ij, diff_ik) / dist_ij / dist_ik
         sf = (
             2 ** (1 - self.zeta[None,:])
             * (1 + self.lambd[None,:] * cos_ijk[:,None]) ** self.zeta[None,:]
-            * self.basis(dist_ij, fc_ij)
-            * self.basis(dist_ik, fc_ik)
-            * self.basis(dist_jk, fc_jk)
+            * tf.gather(basis, ind_ij)
+            * tf.gather(basis, ind_ik)
+            * self.cutoff_basis(dist_jk)
         )
 
-        fp = sf2fp(i_rind, a_rind, sf)
+        fp = sf2fp(i_rind, a_rind, sf, row_ptr)
         jacob_ind = _triplet_jacobian(i_rind, ind_ij, ind_ik)
         return fp, jacob_ind
 
@@ -206,7 +222,7 @@ class G3_SF(tf.keras.layers.Layer):
 class G4_SF(tf.keras.layers.Layer):
     """BP-style G4 symmetry functions."""
 
-    def __init__(self, lambd, zeta, eta, i="ALL", j="ALL", k="ALL"):
+    def __init__(self, lambd, zeta, eta, i="ALL", j="ALL", k="ALL", cutoff=None):
         """
         Args:
             lambd (list of floats): lambda parameter of G4 SF
@@ -215,16 +231,19 @@ class G4_SF(tf.keras.layers.Layer):
             i (str): species i
             j (str): species j
             k (str): species k
+            cutoff (layer, optional): cutoff function, when given the cutoff
+                is applied with the basis and `fc` is not needed in call
         """
         super(G4_SF, self).__init__()
         self.lambd = tf.cast(lambd, tf.keras.backend.floatx())
         self.zeta = tf.cast(zeta, tf.keras.backend.floatx())
         self.basis = GaussianBasis(center=np.zeros_like(eta), gamma=eta)
+        self.cutoff_basis = None if cutoff is None else CutoffBasis(cutoff, self.basis)
         self.i = i
         self.j = j
         self.k = k
 
-    def call(self, ind_2, ind_3, dist, diff, elems, fc):
+    def call(self, ind_2, ind_3, dist, diff, elems, fc=None, row_ptr=None):
         """
 
         Args:
@@ -233,7 +252,8 @@ class G4_SF(tf.keras.layers.Layer):
             dist: (N_pair) array of distance
             diff: (N_pair) array of bond vectors
             elems: (N_atom) elements for each atom
-            fc: (N_pair) cutoff functio  n
+            fc: (N_pair) cutoff function, not needed if the cutoff is given
+            row_ptr: (N_atom+1) offsets of the pairs, if the pairs are sorted
 
         Returns:
             fp: a (n_atom x n_fingerprint) tensor of fingerprints
@@ -253,17 +273,20 @@ class G4_SF(tf.keras.layers.Layer):
         diff_ik = tf.gather(diff, ind_ik)
         dist_ij = tf.gather(dist, ind_ij)
         dist_ik = tf.gather(dist, ind_ik)
-        fc_ij = tf.gather(fc, ind_ij)
-        fc_ik = tf.gather(fc, ind_ik)
+        # the basis is evaluated once per pair and gathered to triplets
+        if self.cutoff_basis is not None:
+            basis = self.cutoff_basis(dist)
+        else:
+            basis = self.basis(dist, fc)
 
         cos_ijk = tf.einsum("id,id->i", diff_ij, diff_ik) / dist_ij / dist_ik
         sf = (
             2 ** (1 - self.zeta[None,:])
             * (1 + self.lambd[None,:] * cos_ijk[:,None]) ** self.zeta[None,:]
-            * self.basis(dist_ij, fc_ij)
-            * self.basis(dist_ik, fc_ik)
+            * tf.gather(basis, ind_ij)
+            * tf.gather(basis, ind_ik)
         )
 
-        fp = sf2fp(i_rind, a_rind, sf)
+        fp = sf2fp(i_rind, a_rind, sf, row_ptr)
         jacob_ind = _triplet_jacobian(i_rind, ind_ij, ind_ik)
         return fp, jacob_ind
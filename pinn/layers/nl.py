@@ -18,19 +18,34 @@ def _displace_matrix(max_repeat):
     return d
 
 
-def _pbc_repeat(coord, cell, ind_1, rc):
-    """This is a helper function for cell_list_nl"""
-    n_repeat = rc * tf.norm(tf.linalg.inv(cell), axis=1)
+def _pbc_repeat(coord, cell, ind_1, rc, cell_inv, ghosts='slab'):
+    """This is a helper function for cell_list_nl
+
+    With ghosts='slab', only the images within rc of the original cell are
+    generated, i.e. the atoms in a slab of width rc at the opposing faces.
+    With ghosts='full', every atom is repeated in all the neighboring cells
+    within the cutoff.
+    """
+    n_repeat = rc * tf.norm(cell_inv, axis=1)
     n_repeat = tf.cast(tf.math.ceil(n_repeat), tf.int32)
     max_repeat = tf.reduce_max(n_repeat, axis=0)
     disp_mat = _displace_matrix(max_repeat)
 
     repeat_mask = tf.reduce_all(
         tf.expand_dims(n_repeat, 1) >= tf.abs(disp_mat), axis=2)
-    atom_mask = tf.gather(repeat_mask, ind_1)
+    atom_mask = tf.gather(repeat_mask, ind_1[:, 0])
+    if ghosts == 'slab':
+        # distance from the image to each pair of faces of the cell, an image
+        # farther than rc from any face can not neighbor an atom in the cell
+        ind = ind_1[:, 0]
+        frac = tf.einsum('ix,ixy->iy', coord, tf.gather(cell_inv, ind))
+        frac = tf.expand_dims(frac, 1) + tf.cast(disp_mat, coord.dtype)
+        spacing = tf.gather(1/tf.norm(cell_inv, axis=1), ind)
+        outside = tf.maximum(frac-1, -frac) * tf.expand_dims(spacing, 1)
+        atom_mask &= tf.reduce_all(outside < rc, axis=2)
     repeat_ar = tf.cast(tf.where(atom_mask), tf.int32)
     repeat_a = repeat_ar[:, :1]
-    repeat_r = repeat_ar[:, 2]
+    repeat_r = repeat_ar[:, 1]
     repeat_s = tf.gather_nd(ind_1, repeat_a)
     repeat_pos = (tf.gather_nd(coord, repeat_a) +
                   tf.reduce_sum(
@@ -40,28 +55,73 @@ def _pbc_repeat(coord, cell, ind_1, rc):
     return repeat_pos, repeat_s, repeat_a
 
 
-def _wrap_coord(tensors):
-    """wrap positions to unit cell"""
-    cell = tf.gather_nd(tensors['cell'], tensors['ind_1'])
-    coord = tf.expand_dims(tensors['coord'], -1)
-    frac_coord = tf.linalg.solve(tf.transpose(cell, perm=[0, 2, 1]), coord)
-    frac_coord %= 1
-    coord = tf.matmul(tf.transpose(cell, perm=[0, 2, 1]), frac_coord)
-    return tf.squeeze(coord, -1)
+def _is_orthorhombic(cell):
+    """whether all cells in the batch are diagonal"""
+    return tf.reduce_all(tf.equal(cell, tf.linalg.diag(tf.linalg.diag_part(cell))))
+
+
+def _cell_inverse(cell):
+    """inverse of each cell in the batch, the columns of the inverse are the
+    reciprocal vectors (without 2*pi)"""
+    return tf.cond(_is_orthorhombic(cell),
+                   lambda: tf.linalg.diag(1/tf.linalg.diag_part(cell)),
+                   lambda: tf.linalg.inv(cell))
+
+
+def _wrap_coord(tensors, cell_inv):
+    """wrap positions to unit cell
+
+    The fractional coordinates are obtained with the inverse cell of each
+    structure, orthorhombic cells are wrapped elementwise.
+    """
+    ind = tensors['ind_1'][:, 0]
+    coord, cell = tensors['coord'], tensors['cell']
+    def _orthorhombic():
+        length = tf.gather(tf.linalg.diag_part(cell), ind)
+        return coord - tf.math.floor(coord/length)*length
+    def _general():
+        frac_coord = tf.einsum('ix,ixy->iy', coord, tf.gather(cell_inv, ind))
+        frac_coord -= tf.math.floor(frac_coord)
+        return tf.einsum('ix,ixy->iy', frac_coord, tf.gather(cell, ind))
+    return tf.cond(_is_orthorhombic(cell), _orthorhombic, _general)
 
 
 class CellListNL(tf.keras.layers.Layer):
     """Compute neighbour list with cell lists approach, see
     <https://en.wikipedia.org/wiki/Cell_lists>.
 
+    The wrapping of coordinates and the displacements can be computed in a
+    higher precision than the coordinates (`nl_dtype`), the outputs are cast
+    back to the dtype of the coordinates. This keeps the displacements
+    accurate for large periodic cells with a float32 network, the gradients
+    w.r.t. the coordinates are connected through the casts.
+
+    For periodic structures, the periodic images (ghost atoms) are binned
+    together with the atoms. By default, only the images within `rc` of the
+    cell are generated (`ghosts='slab'`), which for small cells is a fraction
+    of all the images in the neighboring cells (`ghosts='full'`).
+
+    The pairs are sorted by the center atom `i`. With `csr=True`, the offsets
+    of each atom's pairs are returned as well (`row_ptr`), in which case the
+    PiNN layers use sorted segment reductions and the triplets are enumerated
+    from the offsets.
+
     """
-    def __init__(self, rc=5.0):
+    def __init__(self, rc=5.0, nl_dtype=None, ghosts='slab', csr=False):
         """
         Args:
             rc (float): cutoff radius
+            nl_dtype (str): dtype to compute the neighbor list in
+                (default: the dtype of the coordinates)
+            ghosts (str): periodic images to generate, 'slab' or 'full'
+            csr (bool): also return the per-atom offsets `row_ptr`
         """
         super(CellListNL, self).__init__()
+        assert ghosts in ['slab', 'full'], f'Unknown ghosts mode {ghosts}'
         self.rc = rc
+        self.nl_dtype = nl_dtype
+        self.ghosts = ghosts
+        self.csr = csr
 
     def call(self, tensors):
         """
@@ -77,6 +137,9 @@ class CellListNL(tf.keras.layers.Layer):
         - `ind_2`: [sparse indices](layers.md#sparse-indices) of neighbor list, with shape `(n_pairs, 2)`
         - `diff`: displacement vectors, with shape `(n_pairs, 3)`
         - `dist`: pairwise distances, with shape `(n_pairs)`
+        - `row_ptr` (if `csr=True`): offsets of the pairs of each atom, with
+          shape `(n_atoms+1)`, i.e. the pairs of atom `i` are
+          `ind_2[row_ptr[i]:row_ptr[i+1]]`
 
         Args:
             tensors (dict of tensor): input tensors, with keys: `{"ind_1", "coord", "cell"}`
@@ -84,15 +147,22 @@ class CellListNL(tf.keras.layers.Layer):
         Returns:
             output (dict of tensor): output tensors, with keys: {"ind_2", "diff", "dist"}`
         """
+        dtype = tensors['coord'].dtype
+        if self.nl_dtype is not None:
+            tensors = {k: tf.cast(tensors[k], self.nl_dtype) if k != 'ind_1'
+                       else tensors[k] for k in ['ind_1', 'coord', 'cell']
+                       if k in tensors}
         atom_sind = tensors['ind_1']
         atom_apos = tensors['coord']
         atom_gind = tf.cumsum(tf.ones_like(atom_sind), 0)
         atom_aind = atom_gind - 1
         to_collect = atom_aind
         if 'cell' in tensors:
-            atom_apos = _wrap_coord(tensors)
+            cell_inv = _cell_inverse(tensors['cell'])
+            atom_apos = _wrap_coord(tensors, cell_inv)
             rep_apos, rep_sind, rep_aind = _pbc_repeat(
-                atom_apos, tensors['cell'], tensors['ind_1'], self.rc)
+                atom_apos, tensors['cell'], tensors['ind_1'], self.rc, cell_inv,
+                self.ghosts)
             atom_sind = tf.concat([atom_sind, rep_sind], 0)
             atom_apos = tf.concat([atom_apos, rep_apos], 0)
             atom_aind = tf.concat([atom_aind, rep_aind], 0)
@@ -137,7 +207,8 @@ class CellListNL(tf.keras.layers.Layer):
             tf.expand_dims(tf.gather_nd(
                 samp_cind, tf.boolean_mask(cell_npos, npos_mask)), 1),
             tf.concat([tf.shape(cell_npos)[:-1], [1]], 0)), -1)
-        # Finally, a sparse list of atom pairs
+        # Finally, a sparse list of atom pairs, the atoms are collected in
+        # order, so that the pairs are sorted by i
         coll_nind = tf.gather(cell_nind, tf.gather_nd(atom_cind, to_collect))
         pair_ic = tf.cast(tf.where(coll_nind), tf.int32)
         pair_ic_i = pair_ic[:, 0]
@@ -158,7 +229,153 @@ class CellListNL(tf.keras.layers.Layer):
 
         output = {
             'ind_2': tf.concat([pair_i_aind, pair_j_aind], 1),
-            'dist': dist,
-            'diff': diff
+            'dist': tf.cast(dist, dtype),
+            'diff': tf.cast(diff, dtype)
+           }
+        if self.csr:
+            n_atoms = tf.shape(tensors['ind_1'])[0]
+            count = tf.math.bincount(pair_i_aind[:, 0], minlength=n_atoms,
+                                     maxlength=n_atoms)
+            output['row_ptr'] = tf.concat([[0], tf.cumsum(count)], 0)
+        return output
+
+
+@tf.custom_gradient
+def _pair_diff(coord, ind_i, ind_j):
+    """displacements of the pairs, with dense gradients w.r.t. coord"""
+    def _grad(ddiff):
+        n_atoms = tf.shape(coord)[0]
+        dcoord = tf.math.unsorted_segment_sum(ddiff, ind_j, n_atoms)
+        dcoord -= tf.math.unsorted_segment_sum(ddiff, ind_i, n_atoms)
+        return dcoord, None, None
+    return tf.gather(coord, ind_j) - tf.gather(coord, ind_i), _grad
+
+
+class AllPairsNL(tf.keras.layers.Layer):
+    """Compute neighbour list by enumerating all pairs within each structure.
+
+    For small non-periodic molecules, e.g. QM9, computing all the O(N^2)
+    distances within each molecule is cheaper than binning the atoms into
+    cells. The atoms of each structure are expected to be contiguous in the
+    batch (as from `sparse_batch`). Periodic structures are not supported, a
+    `ValueError` is raised for batches with a `cell`.
+
+    The output follows `CellListNL`, the pairs are sorted by the center atom.
+    """
+    def __init__(self, rc=5.0, nl_dtype=None, csr=False):
+        """
+        Args:
+            rc (float): cutoff radius
+            nl_dtype (str): dtype to compute the neighbor list in
+                (default: the dtype of the coordinates)
+            csr (bool): also return the per-atom offsets `row_ptr`
+        """
+        super(AllPairsNL, self).__init__()
+        self.rc = rc
+        self.nl_dtype = nl_dtype
+        self.csr = csr
+
+    def call(self, tensors):
+        """
+        The layer expects a dictionary of tensors from a sparse_batch with
+        keys `ind_1` and `coord`, see `CellListNL` for the output.
+
+        Args:
+            tensors (dict of tensor): input tensors, with keys: `{"ind_1", "coord"}`
+
+        Returns:
+            output (dict of tensor): output tensors, with keys: {"ind_2", "diff", "dist"}`
+        """
+        if 'cell' in tensors:
+            raise ValueError('AllPairsNL does not support periodic structures, '
+                             'use CellListNL instead')
+        dtype = tensors['coord'].dtype
+        coord = tensors['coord']
+        if self.nl_dtype is not None:
+            coord = tf.cast(coord, self.nl_dtype)
+        atom_sind = tensors['ind_1'][:, 0]
+        n_atoms = tf.shape(atom_sind)[0]
+        struct_count = tf.math.bincount(atom_sind)
+        struct_start = tf.cumsum(struct_count, exclusive=True)
+        atom_start = tf.gather(struct_start, atom_sind)
+        atom_end = atom_start + tf.gather(struct_count, atom_sind)
+        # the other atoms within the same structure, skipping i itself
+        pair_range = tf.ragged.range(atom_start, atom_end-1)
+        pair_i = tf.cast(pair_range.value_rowids(), tf.int32)
+        pair_j = pair_range.flat_values
+        pair_j += tf.cast(pair_j >= pair_i, tf.int32)
+
+        diff = _pair_diff(coord, pair_i, pair_j)
+        dist = tf.norm(diff, axis=-1)
+        ind_rc = tf.where((dist < self.rc) & (dist > 0))
+        output = {
+            'ind_2': tf.gather_nd(tf.stack([pair_i, pair_j], 1), ind_rc),
+            'dist': tf.cast(tf.gather_nd(dist, ind_rc), dtype),
+            'diff': tf.cast(tf.gather_nd(diff, ind_rc), dtype)
            }
+        if self.csr:
+            count = tf.math.bincount(output['ind_2'][:, 0], minlength=n_atoms,
+                                     maxlength=n_atoms)
+            output['row_ptr'] = tf.concat([[0], tf.cumsum(count)], 0)
         return output
+
+
+class AutoNL(tf.keras.layers.Layer):
+    """Neighbour list that dispatches to `AllPairsNL` or `CellListNL`.
+
+    Non-periodic batches where no structure has more than `max_atoms` atoms
+    use `AllPairsNL`, other batches use `CellListNL`. The choice is made per
+    batch, with `tf.cond`, so that a network can be used for both molecules
+    and larger systems.
+    """
+    def __init__(self, rc=5.0, nl_dtype=None, csr=False, max_atoms=30):
+        """
+        Args:
+            rc (float): cutoff radius
+            nl_dtype (str): dtype to compute the neighbor list in
+                (default: the dtype of the coordinates)
+            csr (bool): also return the per-atom offsets `row_ptr`
+            max_atoms (int): largest structure to compute all pairs for
+        """
+        super(AutoNL, self).__init__()
+        self.rc = rc
+        self.max_atoms = max_atoms
+        self.cell_list = CellListNL(rc, nl_dtype, csr=csr)
+        self.all_pairs = AllPairsNL(rc, nl_dtype, csr=csr)
+
+    def call(self, tensors):
+        """
+        See `CellListNL` for the inputs and outputs.
+
+        Args:
+            tensors (dict of tensor): input tensors, with keys: `{"ind_1", "coord", "cell"}`
+
+        Returns:
+            output (dict of tensor): output tensors, with keys: {"ind_2", "diff", "dist"}`
+        """
+        if 'cell' in tensors:
+            return self.cell_list(tensors)
+        max_count = tf.reduce_max(tf.math.bincount(tensors['ind_1'][:, 0]))
+        return tf.cond(max_count <= self.max_atoms,
+                       lambda: self.all_pairs(tensors),
+                       lambda: self.cell_list(tensors))
+
+
+nl_layers = {'cell': CellListNL, 'all_pairs': AllPairsNL, 'auto': AutoNL}
+
+
+def get_nl_layer(nl_type, rc, max_atoms=30, **kwargs):
+    """Returns a neighbour list layer
+
+    Args:
+        nl_type (str): 'cell' (`CellListNL`), 'all_pairs' (`AllPairsNL`) or
+            'auto' (`AutoNL`)
+        rc (float): cutoff radius
+        max_atoms (int): largest structure to compute all pairs for, only
+            used by `AutoNL`
+        **kwargs: options of the layer, e.g. `nl_dtype` and `csr`
+    """
+    assert nl_type in nl_layers, f'Unknown neighbor list type {nl_type}'
+    if nl_type == 'auto':
+        kwargs['max_atoms'] = max_atoms
+    return nl_layers[nl_type](rc, **kwargs)
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""Molecular dynamics integrated in the TensorFlow graph
+
+The integrators run many steps in one `tf.while_loop`, so that there is no
+Python round-trip per step. The neighbor list is built with a skin and only
+rebuilt when an atom has moved by more than half of the skin, the pairs in
+between are updated from the positions. Frames are written through the ASE
+writers every `stride` steps.
+
+The units follow ASE: positions in Å, time in ASE units (e.g. `5*units.fs`),
+energies in eV (converted from the unit of the model with `to_eV`).
+"""
+import numpy as np
+import tensorflow as tf
+from ase import units
+from pinn.layers import CellListNL
+
+
+class _Writer():
+    """Appends frames to a file with `ase.io.write`, the file is overwritten
+    by the first frame"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.append = False
+
+    def write(self, atoms):
+        from ase.io import write
+        write(self.filename, atoms, append=self.append)
+        self.append = True
+
+
+def open_trajectory(trajectory):
+    """Opens a trajectory to write frames to
+
+    Args:
+        trajectory: file name (`.traj` for ASE trajectories, other formats
+            are written with `ase.io.write`, e.g. extxyz), an object with a
+            `write(atoms)` method, or None
+
+    Returns:
+        an object with a `write(atoms)` method, or None
+    """
+    if not isinstance(trajectory, str):
+        return trajectory
+    if trajectory.endswith('.traj'):
+        from ase.io import Trajectory
+        return Trajectory(trajectory, 'w')
+    return _Writer(trajectory)
+
+
+class _Pairs():
+    """Stands in for the neighbor list layer of the network, and returns the
+    pairs computed by the integrator"""
+
+    def __init__(self, csr=False):
+        self.csr = csr
+        self.pairs = None
+
+    def __call__(self, tensors):
+        pairs = self.pairs
+        if self.csr:
+            n_atoms = tf.shape(tensors['ind_1'])[0]
+            count = tf.math.bincount(pairs['ind_2'][:, 0], minlength=n_atoms,
+                                     maxlength=n_atoms)
+            pairs = {**pairs, 'row_ptr': tf.concat([[0], tf.cumsum(count)], 0)}
+        return pairs
+
+
+class MolecularDynamics():
+    """Base class of the in-graph integrators
+
+    Args:
+        atoms: ASE Atoms, the positions and velocities are updated after each
+            run
+        model: model_dir, params file or params dict of a trained potential
+            model
+        timestep (float): time step in ASE units
+        trajectory: file name (`.traj` for ASE trajectories, other formats
+            are written with `ase.io.write`, e.g. extxyz), or an object
+            with a `write(atoms)` method, e.g. `ase.io.Trajectory`
+        stride (int): write a frame every this many steps
+        skin (float): skin of the neighbor list in Å
+        to_eV (float): conversion of the energy unit of the model to eV
+        checkpoint (str): checkpoint to restore (default: the latest)
+    """
+
+    def __init__(self, atoms, model, timestep, trajectory=None, stride=1,
+                 skin=1.0, to_eV=1.0, checkpoint=None):
+        from pinn.export import load_potential
+        self.atoms = atoms
+        self.timestep = timestep
+        self.trajectory = open_trajectory(trajectory)
+        self.stride = stride
+        self.skin = skin
+        self.to_eV = to_eV
+        self.network, self.model_params = load_potential(model, checkpoint)
+        self.dtype = tf.keras.backend.floatx()
+        # the network takes its pairs from the integrator
+        holder = self.network if hasattr(self.network, 'nl_layer') \
+            else self.network.preprocess
+        self.rc = holder.nl_layer.rc
+        self.nl = CellListNL(self.rc + skin)
+        self.pairs = _Pairs(getattr(holder.nl_layer, 'csr', False))
+        holder.nl_layer = self.pairs
+
+        self.nsteps = 0
+        self.n_builds = 0
+        self.elems = tf.constant(atoms.numbers, tf.int32)
+        self.ind_1 = tf.zeros([len(atoms), 1], tf.int32)
+        self.masses = tf.constant(atoms.get_masses()[:, None], tf.float64)
+        self.cell = tf.constant(atoms.cell[np.newaxis], tf.float64) \
+            if atoms.pbc.any() else None
+        n_atoms = len(atoms)
+        self._loop = tf.function(self._loop_fn, input_signature=[
+            tf.TensorSpec([], tf.int32), tf.TensorSpec([], tf.int32),
+            *[tf.TensorSpec([n_atoms, 3], tf.float64)]*3, tf.TensorSpec([], tf.float64),
+            tf.TensorSpec([None, 2], tf.int32), tf.TensorSpec([None, 3], tf.float64),
+            tf.TensorSpec([n_atoms, 3], tf.float64), tf.TensorSpec([], tf.int32)])
+        self._state = None
+
+    def _build(self, x):
+        """neighbor list with the skin, as pairs and image shifts"""
+        tensors = {'ind_1': self.ind_1, 'coord': x}
+        if self.cell is not None:
+            tensors['cell'] = self.cell
+        # call() directly, the layer would cast the positions to float32
+        nl = self.nl.call(tensors)
+        ind_2 = nl['ind_2']
+        shift = nl['diff'] - (tf.gather(x, ind_2[:, 1]) - tf.gather(x, ind_2[:, 0]))
+        return ind_2, shift
+
+    def _energy_forces(self, x, ind_2, shift):
+        """energy and forces in eV and eV/Å"""
+        with tf.GradientTape() as tape:
+            tape.watch(x)
+            diff = tf.gather(x, ind_2[:, 1]) - tf.gather(x, ind_2[:, 0]) + shift
+            dist = tf.norm(diff, axis=1)
+            ind_rc = tf.where(dist < self.rc)[:, 0]
+            self.pairs.pairs = {'ind_2': tf.gather(ind_2, ind_rc),
+                                'diff': tf.cast(tf.gather(diff, ind_rc), self.dtype),
+                                'dist': tf.cast(tf.gather(dist, ind_rc), self.dtype)}
+            tensors = {'ind_1': self.ind_1, 'elems': self.elems,
+                       'coord': tf.cast(x, self.dtype)}
+            if self.cell is not None:
+                tensors['cell'] = tf.cast(self.cell, self.dtype)
+            from pinn.export import potential_energy
+            energy = potential_energy(self.network, tensors, self.model_params)
+            energy = tf.cast(tf.reduce_sum(energy), tf.float64) * self.to_eV
+        forces = -tf.convert_to_tensor(tape.gradient(energy, x))
+        return energy, forces
+
+    def _step(self, step, x, v, f, ind_2, shift):
+        """one integration step, returns the new x, v, f and energy"""
+        raise NotImplementedError
+
+    def _loop_fn(self, n_steps, step, x, v, f, e, ind_2, shift, x_ref, n_builds):
+        def body(i, x, v, f, e, ind_2, shift, x_ref, n_builds):
+            rebuild = tf.reduce_max(tf.norm(x - x_ref, axis=1)) > self.skin/2
+            ind_2, shift, x_ref, n_builds = tf.cond(
+                rebuild,
+                lambda: (*self._build(x), x, n_builds + 1),
+                lambda: (ind_2, shift, x_ref, n_builds))
+            x, v, f, e = self._step(step + i, x, v, f, ind_2, shift)
+            return i + 1, x, v, f, e, ind_2, shift, x_ref, n_builds
+
+        pair_shape = [tf.TensorShape([None, 2]), tf.TensorShape([None, 3])]
+        invariants = [tf.TensorShape([]), x.shape, v.shape, f.shape, e.shape,
+                      *pair_shape, x_ref.shape, tf.TensorShape([])]
+        _, x, v, f, e, ind_2, shift, x_ref, n_builds = tf.while_loop(
+            lambda i, *_: i < n_steps, body,
+            [tf.constant(0), x, v, f, e, ind_2, shift, x_ref, n_builds],
+            shape_invariants=invariants)
+        return x, v, f, e, ind_2, shift, x_ref, n_builds
+
+    def _initialize(self):
+        x = tf.constant(self.atoms.positions, tf.float64)
+        v = tf.constant(self.atoms.get_velocities(), tf.float64)
+        ind_2, shift = self._build(x)
+        e, f = tf.function(self._energy_forces)(x, ind_2, shift)
+        self._state = [x, v, f, e, ind_2, shift, x, tf.constant(1)]
+
+    def _write(self, energy, forces):
+        from ase.calculators.singlepoint import SinglePointCalculator
+        if self.trajectory is None:
+            return
+        atoms = self.atoms.copy()
+        atoms.calc = SinglePointCalculator(atoms, energy=energy, forces=forces)
+        self.trajectory.write(atoms)
+
+    def _update_atoms(self):
+        x, v, f, e = self._state[:4]
+        self.atoms.set_positions(x.numpy())
+        self.atoms.set_velocities(v.numpy())
+        return e.numpy(), f.numpy()
+
+    def run(self, steps):
+        """Runs the given number of steps, stopping every `stride` steps if a
+        trajectory is written
+
+        Returns:
+            the potential energy of the last step, in eV
+        """
+        if self._state is None:
+            self._initialize()
+            if self.nsteps == 0:
+                self._write(*self._update_atoms())
+        done = 0
+        while done < steps:
+            n = steps - done
+            if self.trajectory is not None:
+                # stop at the next frame to write
+                n = min(n, self.stride - self.nsteps % self.stride)
+            x, v, f, e, ind_2, shift, x_ref, n_builds = self._state
+            self._state = list(self._loop(
+                tf.constant(n), tf.constant(self.nsteps), x, v, f, e, ind_2, shift,
+                x_ref, n_builds))
+            done += n
+            self.nsteps += n
+            energy, forces = self._update_atoms()
+            if self.nsteps % self.stride == 0:
+                self._write(energy, forces)
+        self.n_builds = int(self._state[-1])
+        return self.get_potential_energy()
+
+    def get_potential_energy(self):
+        """potential energy of the current state, in eV"""
+        if self._state is None:
+            self._initialize()
+        return float(self._state[3])
+
+
+class VelocityVerlet(MolecularDynamics):
+    """Velocity Verlet integrator (NVE), see `MolecularDynamics` for the
+    arguments"""
+
+    def _step(self, step, x, v, f, ind_2, shift):
+        dt = self.timestep
+        v = v + 0.5 * dt * f / self.masses
+        x = x + dt * v
+        e, f = self._energy_forces(x, ind_2, shift)
+        v = v + 0.5 * dt * f / self.masses
+        return x, v, f, e
+
+
+class Langevin(MolecularDynamics):
+    """Langevin dynamics (NVT) with the BAOAB splitting
+
+    Args:
+        temperature_K (float): temperature in K
+        friction (float): friction coefficient in inverse ASE time units
+        seed (int): seed of the random forces, the random numbers are
+            generated from the seed and the step, so runs are reproducible
+
+    See `MolecularDynamics` for the other arguments.
+    """
+
+    def __init__(self, atoms, model, timestep, temperature_K, friction,
+                 seed=0, **kwargs):
+        super(Langevin, self).__init__(atoms, model, timestep, **kwargs)
+        self.kT = temperature_K * units.kB
+        self.friction = friction
+        self.seed = seed
+
+    def _step(self, step, x, v, f, ind_2, shift):
+        dt = self.timestep
+        c1 = np.exp(-self.friction * dt)
+        c2 = np.sqrt(1 - c1**2)
+        noise = tf.random.stateless_normal(tf.shape(v), [self.seed, step],
+                                         dtype=tf.float64)
+        v = v + 0.5 * dt * f / self.masses
+        x = x + 0.5 * dt * v
+        v = c1 * v + c2 * tf.sqrt(self.kT / self.masses) * noise
+        x = x + 0.5 * dt * v
+        e, f = self._energy_forces(x, ind_2, shift)
+        v = v + 0.5 * dt * f / self.masses
+        return x, v, f, e
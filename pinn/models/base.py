@@ -12,17 +12,88 @@ def export_model(model_fn):
         params_tmp = default_params.copy()
         params_tmp.update(params)
         params = params_tmp
+        check_train_params(params, kwargs.get('config'))
         model = tf.estimator.Estimator(
             model_fn=model_fn, params=params, model_dir=model_dir, **kwargs)
         return model
     return pinn_model
 
+def check_train_params(params, config=None):
+    """Rejects the unsupported combinations of training options
+
+    Kalman filters can not be combined with gradient accumulation
+    (`accum_steps`) or distributed training (`train_distribute` of the
+    `RunConfig`), and gradient accumulation is not supported in distributed
+    training.
+
+    Args:
+        params (dict): model parameters, with the optimizer
+        config: the `tf.estimator.RunConfig` of the model
+
+    Raises:
+        ValueError: naming the conflicting options
+    """
+    from pinn.optimizers import EKF, gEKF
+    optimizer = params['optimizer']
+    if isinstance(optimizer, (EKF, gEKF)):
+        kalman = type(optimizer).__name__
+    elif isinstance(optimizer, dict) and optimizer.get('class_name') in ['EKF', 'gEKF', 'LRgEKF']:
+        kalman = optimizer['class_name']
+    else:
+        kalman = None
+    accum_steps = params.get('model', {}).get('params', {}).get('accum_steps', 1)
+    distribute = config is not None and config.train_distribute is not None
+    if kalman and accum_steps > 1:
+        raise ValueError(f'accum_steps={accum_steps} (gradient accumulation) is not '
+                         f'supported with the {kalman} optimizer.')
+    if kalman and distribute:
+        raise ValueError(f'train_distribute (distributed training) is not supported '
+                         f'with the {kalman} optimizer.')
+    if accum_steps > 1 and distribute:
+        raise ValueError(f'accum_steps={accum_steps} (gradient accumulation) is not '
+                         f'supported with train_distribute (distributed training).')
+
+
+HIST_SUMMARIES = 'hist_summaries'
+
 class MetricsCollector():
-    def __init__(self, mode):
+    """Collects the losses, errors and metrics of a model
+
+    Args:
+        mode: ModeKeys.TRAIN or ModeKeys.EVAL.
+        summary (str): summaries to write in training, 'off', 'scalar'
+            (no histograms) or 'hist'.
+        hist_every (int): if set, write the histograms every hist_every steps
+            instead of with the scalar summaries.
+    """
+    def __init__(self, mode, summary='hist', hist_every=None):
+        if summary not in ['off', 'scalar', 'hist']:
+            raise ValueError(f'Unknown summary policy {summary}')
         self.mode = mode
         self.LOSS = []
         self.ERROR = []
         self.METRICS = {}
+        self.hist_every = hist_every
+        # summaries are only created if they go to some collection
+        summaries = [tf.compat.v1.GraphKeys.SUMMARIES]
+        self.scalar_collections = [] if summary == 'off' else summaries
+        if summary != 'hist':
+            self.hist_collections = []
+        elif hist_every:
+            self.hist_collections = [HIST_SUMMARIES]
+        else:
+            self.hist_collections = summaries
+
+    def summary_hooks(self, output_dir):
+        """Hooks to write the histograms separately (if hist_every is set)"""
+        if self.hist_collections != [HIST_SUMMARIES]:
+            return []
+        summary_op = tf.compat.v1.summary.merge_all(HIST_SUMMARIES)
+        if summary_op is None:
+            return []
+        return [tf.estimator.SummarySaverHook(
+            save_steps=self.hist_every, output_dir=output_dir,
+            summary_op=summary_op)]
 
     def add_error(self, tag, data, pred, mask=None, weight=1.0,
                   use_error=True, log_error=True, log_hist=True):
@@ -44,20 +115,23 @@ class MetricsCollector():
         error = data - pred
         weight = tf.cast(weight, data.dtype)
         if self.mode == tf.estimator.ModeKeys.TRAIN:
-            if log_hist:
-                tf.compat.v1.summary.histogram(f'{tag}_DATA', data)
-                tf.compat.v1.summary.histogram(f'{tag}_PRED', pred)
-                tf.compat.v1.summary.histogram(f'{tag}_ERROR', error)
-            if log_error:
+            hist = self.hist_collections
+            if log_hist and hist:
+                tf.compat.v1.summary.histogram(f'{tag}_DATA', data, collections=hist)
+                tf.compat.v1.summary.histogram(f'{tag}_PRED', pred, collections=hist)
+                tf.compat.v1.summary.histogram(f'{tag}_ERROR', error, collections=hist)
+            scalar = self.scalar_collections
+            if log_error and scalar:
                 mae = tf.reduce_mean(tf.abs(error))
                 rmse = tf.sqrt(tf.reduce_mean(error**2))
-                tf.compat.v1.summary.scalar(f'{tag}_MAE', mae)
-                tf.compat.v1.summary.scalar(f'{tag}_RMSE', rmse)
+                tf.compat.v1.summary.scalar(f'{tag}_MAE', mae, collections=scalar)
+                tf.compat.v1.summary.scalar(f'{tag}_RMSE', rmse, collections=scalar)
             if mask is not None:
                 error = tf.boolean_mask(error, mask)
             if use_error:
                 loss = tf.reduce_mean(error**2 * weight)
-                tf.compat.v1.summary.scalar(f'{tag}_LOSS', loss)
+                if scalar:
+                    tf.compat.v1.summary.scalar(f'{tag}_LOSS', loss, collections=scalar)
                 self.ERROR.append(error*tf.math.sqrt(weight))
                 self.LOSS.append(loss)
         if self.mode == tf.estimator.ModeKeys.EVAL:
@@ -72,8 +146,122 @@ class MetricsCollector():
                 self.LOSS.append(loss)
 
 
+def stamp_input(features):
+    """Timestamps the arrival of the input features
+
+    The returned features depend on the timestamp, so that it is taken
+    before any computation on them starts.
+    """
+    with tf.control_dependencies(list(features.values())):
+        t_input = tf.timestamp()
+    with tf.control_dependencies([t_input]):
+        features = {k: tf.identity(v) for k, v in features.items()}
+    return features, t_input
+
+
+class ThroughputHook(tf.estimator.SessionRunHook):
+    """Logs the training throughput and the step time breakdown
+
+    The number of atoms, pairs and structures is fetched at every step, the
+    input pipeline wait is measured from the start of each step to the
+    arrival of the features (t_input, see `stamp_input`), and the compute
+    time from there to the end of the train op. Averages are written as
+    THROUGHPUT/* summaries every every_n_steps.
+    """
+    def __init__(self, features, t_input, train_op, output_dir, every_n_steps):
+        with tf.name_scope('THROUGHPUT'):
+            with tf.control_dependencies([train_op]):
+                t_train = tf.timestamp()
+            self._tensors = {
+                'global_step': tf.compat.v1.train.get_global_step(),
+                'atoms': tf.shape(features['ind_1'])[0],
+                'pairs': tf.shape(features['ind_2'])[0],
+                'structures': tf.reduce_max(features['ind_1'])+1,
+                't_input': t_input, 't_train': t_train}
+        self._output_dir = output_dir
+        self._every_n_steps = every_n_steps
+
+    def begin(self):
+        import numpy as np
+        self._timer = tf.compat.v1.train.SecondOrStepTimer(
+            every_steps=self._every_n_steps)
+        self._totals = np.zeros(6)
+        self._writer = tf.compat.v1.summary.FileWriterCache.get(self._output_dir)
+
+    def before_run(self, run_context):
+        import time
+        self._t_run = time.time()
+        return tf.estimator.SessionRunArgs(self._tensors)
+
+    def after_run(self, run_context, run_values):
+        v = run_values.results
+        self._totals += [v['atoms'], v['pairs'], v['structures'],
+                         v['t_input']-self._t_run, v['t_train']-v['t_input'], 1]
+        step = v['global_step']
+        if not self._timer.should_trigger_for_step(step):
+            return
+        elapsed, _ = self._timer.update_last_triggered_step(step)
+        atoms, pairs, structures, t_input, t_train, n_steps = self._totals
+        self._totals[:] = 0
+        if elapsed is None:
+            return
+        values = {'atoms_per_sec': atoms/elapsed,
+                  'pairs_per_sec': pairs/elapsed,
+                  'structures_per_sec': structures/elapsed,
+                  'neighbors_per_atom': pairs/atoms,
+                  'input_wait': t_input/n_steps,
+                  'compute_time': t_train/n_steps}
+        summary = tf.compat.v1.Summary(value=[
+            tf.compat.v1.Summary.Value(tag=f'THROUGHPUT/{k}', simple_value=v)
+            for k, v in values.items()])
+        self._writer.add_summary(summary, step)
+
+
+class ProfilerHook(tf.estimator.SessionRunHook):
+    """Records a `tf.profiler` trace of the training steps in [start, stop)
+
+    The trace is written to output_dir, and shown in the Profile tab of
+    TensorBoard. The ops of the network are named after its layers if it is
+    built under a `LayerProfiler`, see `layer_scopes`.
+    """
+    def __init__(self, output_dir, steps):
+        self._output_dir = output_dir
+        self._start, self._stop = steps
+
+    def begin(self):
+        self._global_step = tf.compat.v1.train.get_global_step()
+        self._active = False
+
+    def after_create_session(self, session, coord):
+        self._step = session.run(self._global_step)
+
+    def before_run(self, run_context):
+        if not self._active and self._start <= self._step < self._stop:
+            tf.profiler.experimental.start(self._output_dir)
+            self._active = True
+
+    def after_run(self, run_context, run_values):
+        self._step += 1
+        if self._active and self._step >= self._stop:
+            tf.profiler.experimental.stop()
+            self._active = False
+
+    def end(self, session):
+        if self._active:
+            tf.profiler.experimental.stop()
+            self._active = False
+
+
+def layer_scopes(network, enabled=True):
+    """Context in which the ops of the network layers are named after the
+    layers (see `pinn.profiler.LayerProfiler`), if enabled"""
+    from contextlib import nullcontext
+    from pinn.profiler import LayerProfiler
+    return LayerProfiler(network) if enabled else nullcontext()
+
+
 @pi_named('TRAIN_OP')
-def get_train_op(optimizer, metrics, tvars, separate_errors=False):
+def get_train_op(optimizer, metrics, tvars, separate_errors=False, accum_steps=1):
     """
     Args:
         optimizer: a PiNN optimizer config.
@@ -82,28 +270,41 @@ def get_train_op(optimizer, metrics, tvars, separate_errors=False):
         error: a list of error vectors (reserved for EKF).
         network: a PiNN network instance.
         sperate_errors (bool): separately update elements in the metrics
+        accum_steps (int): accumulate the gradients over accum_steps
+            (micro-)batches before each update
     """
     from pinn.optimizers import get, EKF, gEKF
     import numpy as np
 
     optimizer = get(optimizer)
-    optimizer.iterations = tf.compat.v1.train.get_or_create_global_step()
+    global_step = tf.compat.v1.train.get_or_create_global_step()
+    if accum_steps == 1:
+        optimizer.iterations = global_step
     nvars = np.sum([np.prod(var.shape) for var in tvars])
     print(f'{nvars} trainable vaiables, training with {tvars[0].dtype.name} precision.')
 
     if not (isinstance(optimizer, EKF) or isinstance(optimizer, gEKF)):
         loss_list =  metrics.LOSS
         if separate_errors:
-            selection = tf.random.uniform([], maxval= len(loss_list), dtype=tf.int32)
+            if accum_steps > 1:
+                # keep the selection within one accumulation window
+                seed = tf.stack([global_step//accum_steps, 0])
+                selection = tf.random.stateless_uniform(
+                    [], seed, maxval=len(loss_list), dtype=tf.int32)
+            else:
+                selection = tf.random.uniform([], maxval= len(loss_list), dtype=tf.int32)
             loss = tf.stack(loss_list)[selection]
         else:
             loss = tf.reduce_sum(loss_list)
         grads = tf.gradients(loss, tvars)
+        if accum_steps > 1:
+            return _accumulate_gradients(optimizer, grads, tvars, accum_steps)
         return optimizer.apply_gradients(zip(grads, tvars))
     else:
         error_list =  metrics.ERROR
         # EKF error vectors are scaled
         if isinstance(optimizer, EKF):
+            error_list = [optimizer.subsample(e) for e in error_list]
             error = tf.concat([tf.reshape(e, [-1])/tf.math.sqrt(tf.cast(tf.size(e), e.dtype))
                                for e in error_list], 0)
         # gEKF should handle this automatically
@@ -114,4 +315,36 @@ def get_train_op(optimizer, metrics, tvars, separate_errors=False):
             mask = tf.concat([tf.fill([tf.size(e)], tf.equal(selection,i))
                               for i,e in enumerate(error_list)], 0)
             error = tf.boolean_mask(error, mask)
-        return optimizer.get_train_op(error, tvars)
+        return optimizer.get_train_op(error, tvars,
+                                      scalar_collections=metrics.scalar_collections,
+                                      hist_collections=metrics.hist_collections)
+
+
+def _accumulate_gradients(optimizer, grads, tvars, accum_steps):
+    """Accumulates the gradients and applies their average every accum_steps
+
+    The global step is increased for every (micro-)batch, such that the
+    training steps, checkpoints and logging intervals count the batches. The
+    optimizer keeps its own count of the weight updates
+    (`optimizer.iterations`), which the learning rate schedules follow.
+    """
+    step = tf.compat.v1.train.get_or_create_global_step()
+    accum = [tf.Variable(tf.zeros(var.shape, var.dtype), trainable=False)
+             for var in tvars]
+    grads = [tf.zeros(var.shape, var.dtype) if grad is None
+             else tf.convert_to_tensor(grad) for grad, var in zip(grads, tvars)]
+    accum_ops = [a.assign_add(g, read_value=False) for a, g in zip(accum, grads)]
+
+    def apply_fn():
+        avg_grads = [a.read_value()/accum_steps for a in accum]
+        with tf.control_dependencies(
+                [optimizer.apply_gradients(zip(avg_grads, tvars))]):
+            reset_ops = [a.assign(tf.zeros_like(a), read_value=False) for a in accum]
+        with tf.control_dependencies(reset_ops):
+            return tf.constant(True)
+
+    with tf.control_dependencies(accum_ops):
+        applied = tf.cond(tf.equal((step+1) % accum_steps, 0), apply_fn,
+                          lambda: tf.constant(False))
+    with tf.control_dependencies([applied]):
+        return step.assign_add(1, read_value=False)
@@ -10,6 +10,7 @@ import tensorflow as tf
 from pinn import get_network
 from pinn.utils import pi_named
 from pinn.models.base import export_model, get_train_op, MetricsCollector
+from pinn.models.base import ThroughputHook, ProfilerHook, layer_scopes, stamp_input
 
 default_params = {
     ### Scaling and units
@@ -27,17 +28,28 @@ default_params = {
     'use_d_weight': False,   # scales the loss according to d_weight
     # Loss function multipliers
     'd_loss_multiplier': 1.0,
+    'accum_steps': 1,        # accumulate gradients over k batches for each update
+    # Logging options
+    'summary': 'hist',       # training summaries: 'off', 'scalar' or 'hist'
+    'hist_every': None,      # if set, write histograms every N steps only
+    'profile_steps': None,   # if set to [start, stop], trace these steps in model_dir
 }
 
 @export_model
-def dipole_model(features, labels, mode, params):
+def dipole_model(features, labels, mode, params, config):
     """Model function for neural network dipoles"""
     network = get_network(params['network'])
     model_params = default_params
     model_params.update(params['model']['params'])
 
-    features = network.preprocess(features)
-    pred = network(features)
+    # the throughput is logged with the summaries, stamp the input only then
+    throughput = mode == tf.estimator.ModeKeys.TRAIN and model_params['summary'] != 'off'
+    if throughput:
+        features, t_input = stamp_input(features)
+    profile = mode == tf.estimator.ModeKeys.TRAIN and model_params['profile_steps']
+    with layer_scopes(network, profile):
+        features = network.preprocess(features)
+        pred = network(features)
     pred = tf.expand_dims(pred, axis=1)
 
     ind = features['ind_1']  # ind_1 => id of molecule for each atom
@@ -50,9 +62,16 @@ def dipole_model(features, labels, mode, params):
     if mode == tf.estimator.ModeKeys.TRAIN:
         metrics = make_metrics(features, dipole, charge, model_params, mode)
         tvars = network.trainable_variables
-        train_op = get_train_op(params['optimizer'], metrics, tvars)
+        train_op = get_train_op(params['optimizer'], metrics, tvars,
+                                accum_steps=model_params['accum_steps'])
+        hooks = metrics.summary_hooks(config.model_dir)
+        if throughput:
+            hooks.append(ThroughputHook(features, t_input, train_op, config.model_dir,
+                                        config.save_summary_steps))
+        if profile:
+            hooks.append(ProfilerHook(config.model_dir, model_params['profile_steps']))
         return tf.estimator.EstimatorSpec(mode, loss=tf.reduce_sum(metrics.LOSS),
-                                          train_op=train_op)
+                                          train_op=train_op, training_hooks=hooks)
 
     if mode == tf.estimator.ModeKeys.EVAL:
         metrics = make_metrics(features, dipole, charge, model_params, mode)
@@ -73,7 +92,8 @@ def dipole_model(features, labels, mode, params):
 
 @pi_named("METRICS")
 def make_metrics(features, d_pred, q_pred, params, mode):
-    metrics = MetricsCollector(mode)
+    metrics = MetricsCollector(mode, summary=params['summary'],
+                               hist_every=params['hist_every'])
 
     d_data = features['d_data']
     q_data = tf.zeros_like(q_pred)
@@ -9,6 +9,7 @@ import tensorflow as tf
 from pinn import get_network
 from pinn.utils import pi_named, atomic_dress, connect_dist_grad
 from pinn.models.base import export_model, get_train_op, MetricsCollector
+from pinn.models.base import ThroughputHook, ProfilerHook, layer_scopes, stamp_input
 
 default_params = {
     ### Scaling and units # The loss function will be MSE((pred - label) * scale)
@@ -44,18 +45,29 @@ default_params = {
     's_loss_multiplier': 1.0,
     'l2_loss_multiplier': 1.0,
     'separate_errors': False,   # workaround at this point
+    'accum_steps': 1,           # accumulate gradients over k batches for each update
+    ## Logging options
+    'summary': 'hist',          # training summaries: 'off', 'scalar' or 'hist'
+    'hist_every': None,         # if set, write histograms every N steps only
+    'profile_steps': None,      # if set to [start, stop], trace these steps in model_dir
 }
 
 @export_model
-def potential_model(features, labels, mode, params):
+def potential_model(features, labels, mode, params, config):
     """Model function for neural network potentials"""
     network = get_network(params['network'])
     model_params = default_params.copy()
     model_params.update(params['model']['params'])
 
-    features = network.preprocess(features)
-    connect_dist_grad(features)
-    pred = network(features)
+    # the throughput is logged with the summaries, stamp the input only then
+    throughput = mode == tf.estimator.ModeKeys.TRAIN and model_params['summary'] != 'off'
+    if throughput:
+        features, t_input = stamp_input(features)
+    profile = mode == tf.estimator.ModeKeys.TRAIN and model_params['profile_steps']
+    with layer_scopes(network, profile):
+        features = network.preprocess(features)
+        connect_dist_grad(features)
+        pred = network(features)
 
     ind = features['ind_1']
     nbatch = tf.reduce_max(ind)+1
@@ -65,9 +77,16 @@ def potential_model(features, labels, mode, params):
         metrics = make_metrics(features, pred, model_params, mode)
         tvars = network.trainable_variables
         train_op = get_train_op(params['optimizer'], metrics, tvars,
-                                separate_errors=model_params['separate_errors'])
+                                separate_errors=model_params['separate_errors'],
+                                accum_steps=model_params['accum_steps'])
+        hooks = metrics.summary_hooks(config.model_dir)
+        if throughput:
+            hooks.append(ThroughputHook(features, t_input, train_op, config.model_dir,
+                                        config.save_summary_steps))
+        if profile:
+            hooks.append(ProfilerHook(config.model_dir, model_params['profile_steps']))
         return tf.estimator.EstimatorSpec(mode, loss=tf.reduce_sum(metrics.LOSS),
-                                          train_op=train_op)
+                                          train_op=train_op, training_hooks=hooks)
 
     if mode == tf.estimator.ModeKeys.EVAL:
         metrics = make_metrics(features, pred, model_params, mode)
@@ -91,7 +110,8 @@ def potential_model(features, labels, mode, params):
 def make_metrics(features, pred, params, mode):
     from pinn.utils import count_atoms
 
-    metrics = MetricsCollector(mode)
+    metrics = MetricsCollector(mode, summary=params['summary'],
+                               hist_every=params['hist_every'])
 
     e_pred = pred
     e_data = features['e_data']
@@ -147,12 +167,14 @@ def make_metrics(features, pred, params, mode):
 
 
 def _get_stress(pred, tensors):
+    """virial of each structure in the batch, divided by its volume"""
     f_ij = _get_dense_grad(pred, tensors['diff'])
-    s_pred = tf.reduce_sum(
+    ind = tf.gather(tensors['ind_1'][:, 0], tensors['ind_2'][:, 0])
+    s_pred = tf.math.unsorted_segment_sum(
         tf.expand_dims(f_ij, 1) *
         tf.expand_dims(tensors['diff'], 2),
-        axis=0, keepdims=True)
-    s_pred /= tf.linalg.det(tensors['cell'])
+        ind, tf.shape(tensors['cell'])[0])
+    s_pred /= tf.reshape(tf.linalg.det(tensors['cell']), [-1, 1, 1])
     return s_pred
 
 
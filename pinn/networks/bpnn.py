@@ -4,7 +4,7 @@ import warnings
 import tensorflow as tf
 from pinn.utils import pi_named, connect_dist_grad
 from pinn.layers.bpsf import G2_SF, G3_SF, G4_SF
-from pinn.layers import CellListNL, CutoffFunc, ANNOutput
+from pinn.layers import get_nl_layer, CutoffFunc, TabulatedBasis, ANNOutput
 
 
 @tf.custom_gradient
@@ -21,6 +21,8 @@ def _fake_fp(diff, fp, jacob, jacob_ind, n_pairs):
 @pi_named('form_tripet')
 def _form_triplet(tensors):
     """Returns triplet indices [ij, jk], where r_ij, r_jk < r_c"""
+    if 'row_ptr' in tensors:
+        return _form_triplet_csr(tensors)
     p_iind = tensors['ind_2'][:, 0]
     n_atoms = tf.shape(tensors['ind_1'])[0]
     n_pairs = tf.shape(tensors['ind_2'])[0]
@@ -37,9 +39,29 @@ def _form_triplet(tensors):
     return t_ind
 
 
+@pi_named('form_tripet')
+def _form_triplet_csr(tensors):
+    """Returns triplet indices [ij, jk] from a neighbor list with offsets
+
+    The pairs ik of each pair ij are the other pairs of the same center atom,
+    i.e. a range in the sorted neighbor list, the triplets are enumerated
+    directly from the offsets `row_ptr`, in the same order as `_form_triplet`.
+    """
+    p_iind = tensors['ind_2'][:, 0]
+    row_ptr = tensors['row_ptr']
+    # ranges of the other pairs, skipping ij itself
+    t_range = tf.ragged.range(tf.gather(row_ptr, p_iind),
+                              tf.gather(row_ptr, p_iind+1)-1)
+    t_ijind = tf.cast(t_range.value_rowids(), tf.int32)
+    t_ikind = t_range.flat_values
+    t_ikind += tf.cast(t_ikind >= t_ijind, tf.int32)
+    t_ind = tf.stack([t_ijind, t_ikind], axis=1)
+    return t_ind
+
+
 class BPSymmFunc(tf.keras.layers.Layer):
     """ Wrapper for building Behler-style symmetry functions"""
-    def __init__(self, sf_spec, rc, cutoff_type, use_jacobian=True):
+    def __init__(self, sf_spec, rc, cutoff_type, use_jacobian=True, basis_table=None):
         super(BPSymmFunc, self).__init__()
         bpsf_layers = {'G2': G2_SF, 'G3': G3_SF, 'G4': G4_SF}
         # specifications
@@ -50,15 +72,20 @@ class BPSymmFunc(tf.keras.layers.Layer):
         for spec in sf_spec:
             layer = bpsf_layers[spec['type']]
             args = {k:v for k,v in spec.items() if k!='type'}
+            # the cutoff is applied with the basis in all SFs
+            args.update({'cutoff': self.fc_layer})
             if spec['type'] == 'G3':
-                args.update({'cutoff': self.fc_layer, 'rc': rc})
+                args.update({'rc': rc})
             if spec['type'] in ['G3', 'G4']:
                 self.triplet = True
             self.bpsfs.append(layer(**args))
+        if basis_table:
+            # the radial terms are tabulated, the angular terms are exact
+            for layer in self.bpsfs:
+                layer.cutoff_basis = TabulatedBasis(layer.cutoff_basis, rc, basis_table)
         self.use_jacobian = use_jacobian
 
     def _compute_fps(self, tensors, gtape=None):
-        fc = self.fc_layer(tensors['dist'])
         fps = {}
         for i, layer in enumerate(self.bpsfs):
             if isinstance(layer, G2_SF):
@@ -66,7 +93,7 @@ class BPSymmFunc(tf.keras.layers.Layer):
                     tensors["ind_2"],
                     dist=tensors["dist"],
                     elems=tensors["elems"],
-                    fc=fc,
+                    row_ptr=tensors.get("row_ptr"),
                 )
             else:
                 fp, jacob_ind = layer(
@@ -75,7 +102,7 @@ class BPSymmFunc(tf.keras.layers.Layer):
                     dist=tensors["dist"],
                     diff=tensors["diff"],
                     elems=tensors["elems"],
-                    fc=fc,
+                    row_ptr=tensors.get("row_ptr"),
                 )
             fps[f'fp_{i}'] = fp
 
@@ -148,32 +175,35 @@ class BPFingerprint(tf.keras.layers.Layer):
                 fps[e].append(tf.gather_nd(fps_all, ind))
         # Concatenate all fingerprints
         fps = {k: tf.concat(v, axis=-1) for k, v in fps.items()}
+        tensors = tensors.copy()
         tensors['elem_fps'] = fps
         return tensors
 
 
 class BPFeedForward(tf.keras.layers.Layer):
     """Element specific feed-forward neural networks used in BPNN"""
-    def __init__(self, nn_spec, act, out_units):
+    def __init__(self, nn_spec, act, out_units, policy=None):
         super(BPFeedForward, self).__init__()
         self.ff_layers = {}
         self.out_units = out_units
         for k, v in nn_spec.items():
             self.ff_layers[k] = [
-                tf.keras.layers.Dense(units, activation=act)
+                tf.keras.layers.Dense(units, activation=act, dtype=policy)
                 for i, units in enumerate(v)]
             self.ff_layers[k].append(
                 tf.keras.layers.Dense(out_units, activation=None,
-                                      use_bias=False))
+                                      use_bias=False, dtype=policy))
 
     def call(self, tensors):
         output = []
         indices = []
         for k, layers in self.ff_layers.items():
             tensor_elem = tensors['elem_fps'][k]
+            dtype = tensor_elem.dtype
             for layer in layers:
                 tensor_elem = layer(tensor_elem)
-            output.append(tensor_elem)
+            # sum up the atomic outputs in full precision
+            output.append(tf.cast(tensor_elem, dtype))
             indices.append(tf.where(tf.equal(tensors['elems'], k))[:,0])
 
         output = tf.math.unsorted_segment_sum(
@@ -184,13 +214,16 @@ class BPFeedForward(tf.keras.layers.Layer):
         return output
 
 class PreprocessLayer(tf.keras.layers.Layer):
-    def __init__(self, sf_spec, rc, cutoff_type, use_jacobian):
+    def __init__(self, sf_spec, rc, cutoff_type, use_jacobian, nl_dtype=None,
+                 csr=False, nl_type='cell', nl_max_atoms=30, basis_table=None):
         super(PreprocessLayer, self).__init__()
-        self.nl_layer = CellListNL(rc)
-        self.symm_func = BPSymmFunc(sf_spec, rc, cutoff_type, use_jacobian)
+        self.nl_layer = get_nl_layer(nl_type, rc, nl_max_atoms, nl_dtype=nl_dtype,
+                                     csr=csr)
+        self.symm_func = BPSymmFunc(sf_spec, rc, cutoff_type, use_jacobian,
+                                    basis_table)
 
     def call(self, tensors):
-        tenors = tensors.copy()
+        tensors = tensors.copy()
         for k in ['elems', 'dist']:
             if k in tensors.keys():
                 tensors[k] = tf.reshape(tensors[k], tf.shape(tensors[k])[:1])
@@ -239,6 +272,20 @@ class BPNN(tf.keras.Model):
             note that one must use the jacobian if one want forces with
             preprocessing, the option is here mainly for verifying the
             jacobian implementation.
+        policy (str): mixed precision policy for the element-wise networks,
+            e.g. "mixed_bfloat16" (default: full precision).
+        nl_dtype (str): dtype to compute the neighbor list in, e.g. "float64"
+            for large cells (default: dtype of the coordinates).
+        csr (bool): return the neighbor list with per-atom offsets, which are
+            used to enumerate the triplets and sum up the symmetry functions.
+        nl_type (str): neighbor list, "cell" for cell lists, "all_pairs" for
+            all pairs within each structure, or "auto" to use all pairs for
+            non-periodic batches of small molecules.
+        nl_max_atoms (int): largest structure to use all pairs for, with
+            nl_type="auto".
+        basis_table (int): if set, tabulate the radial terms of the symmetry
+            functions on a grid of this many intervals and interpolate them,
+            for inference.
 
     Returns:
         prediction or preprocessed tensor dictionary
@@ -247,11 +294,14 @@ class BPNN(tf.keras.Model):
                  rc=5.0, act='tanh', cutoff_type='f1',
                  fp_range=[], fp_scale=False,
                  preprocess=False, use_jacobian=True,
-                 out_units=1, out_pool=False):
+                 out_units=1, out_pool=False, policy=None, nl_dtype=None,
+                 csr=False, nl_type='cell', nl_max_atoms=30, basis_table=None):
         super(BPNN, self).__init__()
-        self.preprocess = PreprocessLayer(sf_spec, rc, cutoff_type, use_jacobian)
+        self.preprocess = PreprocessLayer(sf_spec, rc, cutoff_type, use_jacobian,
+                                          nl_dtype, csr, nl_type, nl_max_atoms,
+                                          basis_table)
         self.fingerprint = BPFingerprint(sf_spec, nn_spec, fp_range, fp_scale, use_jacobian)
-        self.feed_forward = BPFeedForward(nn_spec, act, out_units)
+        self.feed_forward = BPFeedForward(nn_spec, act, out_units, policy)
         self.ann_output = ANNOutput(out_pool)
 
     def call(self, tensors):
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import tensorflow as tf
-from pinn.layers import CellListNL
+from pinn.utils import sorted_segment_sum
+from pinn.layers import get_nl_layer
 
 
 class LJ(tf.keras.Model):
@@ -13,13 +14,19 @@ class LJ(tf.keras.Model):
         tensors: input data (nested tensor from dataset).
         rc: cutoff radius.
         sigma, epsilon: LJ parameters
+        nl_dtype: dtype to compute the neighbor list in
+        csr: return the neighbor list with per-atom offsets
+        nl_type: neighbor list, "cell", "all_pairs" or "auto"
+        nl_max_atoms: largest structure to use all pairs for, with "auto"
     """
-    def __init__(self, rc=3.0, sigma=1.0, epsilon=1.0):
+    def __init__(self, rc=3.0, sigma=1.0, epsilon=1.0, nl_dtype=None, csr=False,
+                 nl_type='cell', nl_max_atoms=30):
         super(LJ, self).__init__()
         self.rc = rc
         self.sigma = sigma
         self.epsilon = epsilon
-        self.nl_layer = CellListNL(rc)
+        self.nl_layer = get_nl_layer(nl_type, rc, nl_max_atoms, nl_dtype=nl_dtype,
+                                     csr=csr)
 
     def preprocess(self, tensors):
         if 'ind_2' not in tensors:
@@ -35,5 +42,8 @@ class LJ(tf.keras.Model):
         en = 4*epsilon*(c12-c6)-e0
         natom = tf.shape(tensors['ind_1'])[0]
         nbatch = tf.reduce_max(tensors['ind_1'])+1
-        en = tf.math.unsorted_segment_sum(en, tensors['ind_2'][:, 0], natom)
+        if 'row_ptr' in tensors:
+            en = sorted_segment_sum(en, tensors['ind_2'][:, 0], natom)
+        else:
+            en = tf.math.unsorted_segment_sum(en, tensors['ind_2'][:, 0], natom)
         return en/2.0
@@ -1,17 +1,47 @@
 # -*- coding: utf-8 -*-
 
 import tensorflow as tf
-from pinn.utils import pi_named, connect_dist_grad
+from pinn.utils import pi_named, connect_dist_grad, sorted_segment_sum, recompute_grad
 from pinn.layers import (
-    CellListNL,
+    get_nl_layer,
     CutoffFunc,
     PolynomialBasis,
     GaussianBasis,
+    CutoffBasis,
+    TabulatedBasis,
     AtomicOnehot,
     ANNOutput,
 )
 
 
+def _pair_dense(layer, prop, ind_i, ind_j):
+    """Applies a dense layer to the concatenated properties of pairs
+
+    Before the activation, the layer is linear in the concatenated
+    properties, so the two halves of its kernel are applied to the
+    properties of the atoms, and the results are gathered for the pairs.
+    This avoids the matmul for each pair, and gives the same output as
+    applying the layer to `concat([prop_i, prop_j])`.
+
+    Args:
+        layer: a `tf.keras.layers.Dense` layer
+        prop (tensor): properties of the atoms, with shape `(n_atoms, n_prop)`
+        ind_i, ind_j (tensor): indices of the atoms of each pair
+
+    Returns:
+        tensor (tensor): output of the layer, in its compute dtype
+    """
+    if not layer.built:
+        layer(tf.zeros([0, 2 * prop.shape[-1]], prop.dtype))
+    dtype = layer.compute_dtype
+    prop = tf.cast(prop, dtype)
+    kernel_i, kernel_j = tf.split(tf.cast(layer.kernel, dtype), 2)
+    tensor = tf.gather(prop @ kernel_i, ind_i) + tf.gather(prop @ kernel_j, ind_j)
+    if layer.use_bias:
+        tensor += tf.cast(layer.bias, dtype)
+    return layer.activation(tensor)
+
+
 class FFLayer(tf.keras.layers.Layer):
     R"""`FFLayer` is a shortcut to create a multi-layer perceptron (MLP) or a
     feed-forward network. A `FFLayer` takes one tensor as input of arbitratry
@@ -47,6 +77,14 @@ class FFLayer(tf.keras.layers.Layer):
     , with the difference that `IILayer`s have their baises set to zero to avoid
     discontinuity in the model output.
 
+    The dense layers may compute in reduced precision (e.g. with
+    `dtype='mixed_bfloat16'`), in which case the output is cast back to the
+    dtype of the input, so that the layers around stay in full precision.
+
+    Given the indices of pairs of atoms, the input is the properties of the
+    atoms and the first dense layer is applied to the concatenated properties
+    of each pair, see `PILayer`.
+
     """
 
     def __init__(self, n_nodes=[64, 64], **kwargs):
@@ -60,17 +98,24 @@ class FFLayer(tf.keras.layers.Layer):
             tf.keras.layers.Dense(n_node, **kwargs) for n_node in n_nodes
         ]
 
-    def call(self, tensor):
+    def call(self, tensor, pairs=None):
         """
         Args:
             tensor (tensor): input tensor
+            pairs (list of tensors): indices `[ind_i, ind_j]` of the atoms of
+                each pair, if the input is to be concatenated for pairs
 
         Returns:
             tensor (tensor): tensor with shape `(...,n_nodes[-1])`
         """
-        for layer in self.dense_layers:
+        dtype = tensor.dtype
+        layers = self.dense_layers
+        if pairs is not None:
+            tensor = _pair_dense(layers[0], tensor, *pairs)
+            layers = layers[1:]
+        for layer in layers:
             tensor = layer(tensor)
-        return tensor
+        return tf.cast(tensor, dtype)
 
 
 class PILayer(tf.keras.layers.Layer):
@@ -100,16 +145,25 @@ class PILayer(tf.keras.layers.Layer):
     FFLayer is `[n_pairs,n_nodes[-1]*n_basis]`, the output is then summed with
     the basis to form the output interaction.
 
+    With `project_atoms`, the first dense layer of the `FFLayer` is applied
+    to the properties of each atom before they are gathered for the pairs,
+    which is equivalent since it is linear before the activation. This is
+    used in the first interaction block, where the properties are the one-hot
+    embedding of the elements.
+
     """
 
-    def __init__(self, n_nodes=[64], **kwargs):
+    def __init__(self, n_nodes=[64], project_atoms=False, **kwargs):
         """
         Args:
             n_nodes (list of int): number of nodes to use
+            project_atoms (bool): apply the first dense layer to the atoms
+                before gathering the pairs
             **kwargs (dict): keyword arguments will be parsed to the feed forward layers
         """
         super(PILayer, self).__init__()
         self.n_nodes = n_nodes
+        self.project_atoms = project_atoms
         self.kwargs = kwargs
 
     def build(self, shapes):
@@ -136,11 +190,13 @@ class PILayer(tf.keras.layers.Layer):
         ind_2, prop, basis = tensors
         ind_i = ind_2[:, 0]
         ind_j = ind_2[:, 1]
-        prop_i = tf.gather(prop, ind_i)
-        prop_j = tf.gather(prop, ind_j)
-
-        inter = tf.concat([prop_i, prop_j], axis=-1)
-        inter = self.ff_layer(inter)
+        if self.project_atoms:
+            inter = self.ff_layer(prop, pairs=[ind_i, ind_j])
+        else:
+            prop_i = tf.gather(prop, ind_i)
+            prop_j = tf.gather(prop, ind_j)
+            inter = tf.concat([prop_i, prop_j], axis=-1)
+            inter = self.ff_layer(inter)
         inter = tf.reshape(inter, [-1, self.n_nodes[-1], self.n_basis])
         inter = tf.einsum("pcb,pb->pc", inter, basis)
         return inter
@@ -175,14 +231,20 @@ class IPLayer(tf.keras.layers.Layer):
         - prop: property tensor with shape `(n_atoms, n_prop)`
         - inter: interaction tensor with shape `(n_pairs, n_inter)`
 
+        Optionally, the offsets `row_ptr` from a [CSR neighbor
+        list](layers.md#celllistnl) can be given as a fourth tensor, in which
+        case the pairs are summed up with a sorted segment sum.
+
         Args:
             tensors (list of tensor): list of [ind_2, prop, inter] tensors
 
         Returns:
             prop (tensor): new property tensor with shape `(n_atoms, n_inter)`
         """
-        ind_2, prop, inter = tensors
+        ind_2, prop, inter = tensors[:3]
         n_atoms = tf.shape(prop)[0]
+        if len(tensors) > 3:
+            return sorted_segment_sum(inter, ind_2[:, 0], n_atoms)
         return tf.math.unsorted_segment_sum(inter, ind_2[:, 0], n_atoms)
 
 
@@ -229,21 +291,22 @@ class OutLayer(tf.keras.layers.Layer):
 
 
 class GCBlock(tf.keras.layers.Layer):
-    def __init__(self, pp_nodes, pi_nodes, ii_nodes, **kwargs):
+    def __init__(self, pp_nodes, pi_nodes, ii_nodes, project_atoms=False, **kwargs):
         super(GCBlock, self).__init__()
         iiargs = kwargs.copy()
         iiargs.update(use_bias=False)
         self.pp_layer = FFLayer(pp_nodes, **kwargs)
-        self.pi_layer = PILayer(pi_nodes, **kwargs)
+        self.pi_layer = PILayer(pi_nodes, project_atoms=project_atoms, **kwargs)
         self.ii_layer = FFLayer(ii_nodes, **iiargs)
         self.ip_layer = IPLayer()
 
     def call(self, tensors):
-        ind_2, prop, basis = tensors
+        ind_2, prop, basis = tensors[:3]
+        row_ptr = tensors[3:]
         prop = self.pp_layer(prop)
         inter = self.pi_layer([ind_2, prop, basis])
         inter = self.ii_layer(inter)
-        prop = self.ip_layer([ind_2, prop, inter])
+        prop = self.ip_layer([ind_2, prop, inter, *row_ptr])
         return prop
 
 
@@ -307,10 +370,11 @@ class ResUpdate(tf.keras.layers.Layer):
 
 
 class PreprocessLayer(tf.keras.layers.Layer):
-    def __init__(self, atom_types, rc):
+    def __init__(self, atom_types, rc, nl_dtype=None, csr=False, nl_type="cell",
+                 nl_max_atoms=30):
         super(PreprocessLayer, self).__init__()
         self.embed = AtomicOnehot(atom_types)
-        self.nl_layer = CellListNL(rc)
+        self.nl_layer = get_nl_layer(nl_type, rc, nl_max_atoms, nl_dtype=nl_dtype, csr=csr)
 
     def call(self, tensors):
         tensors = tensors.copy()
@@ -345,6 +409,13 @@ class PiNet(tf.keras.Model):
         out_pool=False,
         act="tanh",
         depth=4,
+        policy=None,
+        nl_dtype=None,
+        csr=False,
+        nl_type="cell",
+        nl_max_atoms=30,
+        basis_table=None,
+        recompute=False,
     ):
         """
         Args:
@@ -362,25 +433,48 @@ class PiNet(tf.keras.Model):
             center (float|array): center of gaussian function for gaussian basis
             cutoff_type (string): cutoff function to use with the basis.
             act (string): activation function to use
+            policy (string): mixed precision policy for the feed-forward
+                layers, e.g. "mixed_bfloat16" (default: full precision)
+            nl_dtype (string): dtype to compute the neighbor list in, e.g.
+                "float64" for large cells (default: dtype of the coordinates)
+            csr (bool): return the neighbor list with per-atom offsets, which
+                enables sorted segment sums in the IPLayer
+            nl_type (string): neighbor list, "cell" for cell lists, "all_pairs"
+                for all pairs within each structure, or "auto" to use all
+                pairs for non-periodic batches of small molecules
+            nl_max_atoms (int): largest structure to use all pairs for, with
+                nl_type="auto"
+            basis_table (int): if set, tabulate the cutoff and basis functions
+                on a grid of this many intervals and interpolate them, for
+                inference
+            recompute (bool): keep only the inputs of each interaction block
+                for backpropagation and recompute the block, which trades
+                compute for memory in force training
         """
         super(PiNet, self).__init__()
 
         self.depth = depth
-        self.preprocess = PreprocessLayer(atom_types, rc)
+        self.recompute = recompute
+        self.preprocess = PreprocessLayer(atom_types, rc, nl_dtype, csr, nl_type,
+                                          nl_max_atoms)
         self.cutoff = CutoffFunc(rc, cutoff_type)
 
         if basis_type == "polynomial":
             self.basis_fn = PolynomialBasis(n_basis)
         elif basis_type == "gaussian":
             self.basis_fn = GaussianBasis(center, gamma, rc, n_basis)
+        self.cutoff_basis = CutoffBasis(self.cutoff, self.basis_fn)
+        if basis_table:
+            self.cutoff_basis = TabulatedBasis(self.cutoff_basis, rc, basis_table)
 
         self.res_update = [ResUpdate() for i in range(depth)]
-        self.gc_blocks = [GCBlock([], pi_nodes, ii_nodes, activation=act)]
+        self.gc_blocks = [GCBlock([], pi_nodes, ii_nodes, project_atoms=True, activation=act,
+                                  dtype=policy)]
         self.gc_blocks += [
-            GCBlock(pp_nodes, pi_nodes, ii_nodes, activation=act)
+            GCBlock(pp_nodes, pi_nodes, ii_nodes, activation=act, dtype=policy)
             for i in range(depth - 1)
         ]
-        self.out_layers = [OutLayer(out_nodes, out_units) for i in range(depth)]
+        self.out_layers = [OutLayer(out_nodes, out_units, dtype=policy) for i in range(depth)]
         self.ann_output = ANNOutput(out_pool)
 
     def call(self, tensors):
@@ -400,6 +494,10 @@ class PiNet(tf.keras.Model):
         - `diff`: distance vectors from the neighbour list, with shape `(n_pairs, 3)`;
         - `prop`: initial properties `(n_pairs, n_elems)`;
 
+        The cutoff basis of the pairs, `(n_pairs, n_basis)`, can also be
+        given as `basis`, e.g. to share it between networks with the same
+        basis; it is otherwise computed from `dist`.
+
         Args:
             tensors (dict of tensors): input tensors
 
@@ -407,11 +505,17 @@ class PiNet(tf.keras.Model):
             output (tensor): output tensor with shape `[n_atoms, out_nodes]`
         """
         tensors = self.preprocess(tensors)
-        fc = self.cutoff(tensors["dist"])
-        basis = self.basis_fn(tensors["dist"], fc=fc)
+        if "basis" in tensors:
+            basis = tensors["basis"]
+        else:
+            basis = self.cutoff_basis(tensors["dist"])
         output = 0.0
+        row_ptr = [tensors["row_ptr"]] if "row_ptr" in tensors else []
         for i in range(self.depth):
-            prop = self.gc_blocks[i]([tensors["ind_2"], tensors["prop"], basis])
+            gc_block = self.gc_blocks[i]
+            if self.recompute:
+                gc_block = recompute_grad(gc_block)
+            prop = gc_block([tensors["ind_2"], tensors["prop"], basis, *row_ptr])
             output = self.out_layers[i]([tensors["ind_1"], prop, output])
             tensors["prop"] = self.res_update[i]([tensors["prop"], prop])
 
@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
 
 import tensorflow as tf
+from pinn.utils import recompute_grad
 from pinn.layers import (
-    CellListNL,
+    get_nl_layer,
     CutoffFunc,
     PolynomialBasis,
     GaussianBasis,
+    CutoffBasis,
+    TabulatedBasis,
     AtomicOnehot,
     ANNOutput,
 )
@@ -13,6 +16,19 @@ from pinn.layers import (
 from .pinet import FFLayer, PILayer, IPLayer, ResUpdate
 
 
+def _build_skipped(layer, shapes):
+    """Builds a layer that is skipped in the call
+
+    The Dense layers of PiNN are named in the order they are created, and
+    the variables in the checkpoints are named after them. Building the
+    skipped layers keeps the names of the later ones, and thus the
+    checkpoints, unchanged. The skipped layers have no variables.
+    """
+    if not layer.built:
+        layer.build(shapes)
+        layer.built = True
+
+
 class PIXLayer(tf.keras.layers.Layer):
     R"""`PIXLayer` takes the equalvariant properties ${}^{3}\mathbb{P}_{ix\zeta}$ as input and outputs interactions for each pair ${}^{3}\mathbb{I}_{ijx\zeta}$. The `PIXLayer` has two styles, specified by the `weighted` argument:
 
@@ -66,13 +82,12 @@ class PIXLayer(tf.keras.layers.Layer):
         ind_2, px = tensors
         ind_i = ind_2[:, 0]
         ind_j = ind_2[:, 1]
-        px_i = tf.gather(px, ind_i)
-        px_j = tf.gather(px, ind_j)
 
         if self.weighted:
-            return self.wi(px_i) + self.wj(px_j)
+            # the projections are linear, apply them per atom before gathering
+            return tf.gather(self.wi(px), ind_i) + tf.gather(self.wj(px), ind_j)
         else:
-            return px_j
+            return tf.gather(px, ind_j)
 
 
 class DotLayer(tf.keras.layers.Layer):
@@ -190,18 +205,28 @@ class OutLayer(tf.keras.layers.Layer):
 
 
 class GCBlock(tf.keras.layers.Layer):
-    def __init__(self, weighted: bool, pp_nodes, pi_nodes, ii_nodes, **kwargs):
+    def __init__(self, weighted: bool, pp_nodes, pi_nodes, ii_nodes, project_atoms=False,
+                 zero_p3=False, **kwargs):
+        """
+        Args:
+            project_atoms (bool): apply the first dense layer of the PILayer to
+                the atoms before gathering the pairs (see `PILayer`)
+            zero_p3 (bool): the input p3 is zero (in the first block), the
+                equivariant interactions then reduce to the scaled diff
+        """
         super(GCBlock, self).__init__()
+        self.zero_p3 = zero_p3
         iiargs = kwargs.copy()
         iiargs.update(use_bias=False)
         ii_nodes = ii_nodes.copy()
         ii_nodes[-1] *= 3
         self.pp1_layer = FFLayer(pp_nodes, **kwargs)
-        self.pi1_layer = PILayer(pi_nodes, **kwargs)
+        self.pi1_layer = PILayer(pi_nodes, project_atoms=project_atoms, **kwargs)
         self.ii1_layer = FFLayer(ii_nodes, **iiargs)
         self.ip1_layer = IPLayer()
 
-        self.pp3_layer = FFLayer(pp_nodes, activation=None, use_bias=False)
+        self.pp3_layer = FFLayer(pp_nodes, activation=None, use_bias=False,
+                                 dtype=kwargs.get('dtype'))
         self.pix_layer = PIXLayer(weighted=weighted, **kwargs)
         self.ii3_layer = FFLayer(ii_nodes, **iiargs)
         self.ip3_layer = IPLayer()
@@ -213,20 +238,25 @@ class GCBlock(tf.keras.layers.Layer):
         self.scale3_layer = ScaleLayer()
 
     def call(self, tensors):
-        ind_2, p1, p3, diff, basis = tensors
+        ind_2, p1, p3, diff, basis = tensors[:5]
+        row_ptr = tensors[5:]
 
         p1 = self.pp1_layer(p1)
         i1 = self.pi1_layer([ind_2, p1, basis])
         i1 = self.ii1_layer(i1)
         i1_1, i1_2, i1_3 = tf.split(i1, 3, axis=-1)
-        p1 = self.ip1_layer([ind_2, p1, i1_2])
+        p1 = self.ip1_layer([ind_2, p1, i1_2, *row_ptr])
 
-        p3 = self.pp3_layer(p3)
-        i3 = self.pix_layer([ind_2, p3])
-        i3 = self.scale1_layer([i3, i1_3])
         scaled_diff = self.scale2_layer([diff[:, :, None], i1_1])
-        i3 = i3 + scaled_diff
-        p3 = self.ip3_layer([ind_2, p3, i3])
+        if self.zero_p3:
+            _build_skipped(self.pix_layer, [ind_2.shape, p3.shape])
+            i3 = scaled_diff
+        else:
+            p3 = self.pp3_layer(p3)
+            i3 = self.pix_layer([ind_2, p3])
+            i3 = self.scale1_layer([i3, i1_3])
+            i3 = i3 + scaled_diff
+        p3 = self.ip3_layer([ind_2, p3, i3, *row_ptr])
 
         p1t1 = self.dot_layer(p3) + p1
         p3t1 = self.scale3_layer([p3, p1t1])
@@ -235,10 +265,11 @@ class GCBlock(tf.keras.layers.Layer):
 
 
 class PreprocessLayer(tf.keras.layers.Layer):
-    def __init__(self, atom_types, rc):
+    def __init__(self, atom_types, rc, nl_dtype=None, csr=False, nl_type="cell",
+                 nl_max_atoms=30):
         super(PreprocessLayer, self).__init__()
         self.embed = AtomicOnehot(atom_types)
-        self.nl_layer = CellListNL(rc)
+        self.nl_layer = get_nl_layer(nl_type, rc, nl_max_atoms, nl_dtype=nl_dtype, csr=csr)
 
     def call(self, tensors):
         tensors = tensors.copy()
@@ -274,6 +305,13 @@ class PiNet2(tf.keras.Model):
         act="tanh",
         depth=4,
         weighted=True,
+        policy=None,
+        nl_dtype=None,
+        csr=False,
+        nl_type="cell",
+        nl_max_atoms=30,
+        basis_table=None,
+        recompute=False,
     ):
         """
         Args:
@@ -292,26 +330,49 @@ class PiNet2(tf.keras.Model):
             cutoff_type (string): cutoff function to use with the basis.
             act (string): activation function to use
             weighted (bool): whether to use weighted style
+            policy (string): mixed precision policy for the feed-forward
+                layers, e.g. "mixed_bfloat16" (default: full precision)
+            nl_dtype (string): dtype to compute the neighbor list in, e.g.
+                "float64" for large cells (default: dtype of the coordinates)
+            csr (bool): return the neighbor list with per-atom offsets, which
+                enables sorted segment sums in the IPLayer
+            nl_type (string): neighbor list, "cell" for cell lists, "all_pairs"
+                for all pairs within each structure, or "auto" to use all
+                pairs for non-periodic batches of small molecules
+            nl_max_atoms (int): largest structure to use all pairs for, with
+                nl_type="auto"
+            basis_table (int): if set, tabulate the cutoff and basis functions
+                on a grid of this many intervals and interpolate them, for
+                inference
+            recompute (bool): keep only the inputs of each interaction block
+                for backpropagation and recompute the block, which trades
+                compute for memory in force training
         """
         super(PiNet2, self).__init__()
 
         self.depth = depth
-        self.preprocess = PreprocessLayer(atom_types, rc)
+        self.recompute = recompute
+        self.preprocess = PreprocessLayer(atom_types, rc, nl_dtype, csr, nl_type,
+                                          nl_max_atoms)
         self.cutoff = CutoffFunc(rc, cutoff_type)
 
         if basis_type == "polynomial":
             self.basis_fn = PolynomialBasis(n_basis)
         elif basis_type == "gaussian":
             self.basis_fn = GaussianBasis(center, gamma, rc, n_basis)
+        self.cutoff_basis = CutoffBasis(self.cutoff, self.basis_fn)
+        if basis_table:
+            self.cutoff_basis = TabulatedBasis(self.cutoff_basis, rc, basis_table)
 
         self.res_update1 = [ResUpdate() for i in range(depth)]
         self.res_update3 = [ResUpdate() for i in range(depth)]
-        self.gc_blocks = [GCBlock(weighted, [], pi_nodes, ii_nodes, activation=act)]
+        self.gc_blocks = [GCBlock(weighted, [], pi_nodes, ii_nodes, project_atoms=True,
+                                  zero_p3=True, activation=act, dtype=policy)]
         self.gc_blocks += [
-            GCBlock(weighted, pp_nodes, pi_nodes, ii_nodes, activation=act)
+            GCBlock(weighted, pp_nodes, pi_nodes, ii_nodes, activation=act, dtype=policy)
             for i in range(depth - 1)
         ]
-        self.out_layers = [OutLayer(out_nodes, out_units) for i in range(depth)]
+        self.out_layers = [OutLayer(out_nodes, out_units, dtype=policy) for i in range(depth)]
         self.ann_output = ANNOutput(out_pool)
 
     def call(self, tensors):
@@ -329,7 +390,11 @@ class PiNet2(tf.keras.Model):
         - `ind_2`: [sparse indices](layers.md#sparse-indices) for neighbour list, with shape `(n_pairs, 2)`;
         - `dist`: distances from the neighbour list, with shape `(n_pairs)`;
         - `diff`: distance vectors from the neighbour list, with shape `(n_pairs, 3)`;
-        - `prop`: initial properties `(n_pairs, n_elems)`;
+        - `p1`: initial properties `(n_pairs, n_elems)`;
+
+        The cutoff basis of the pairs, `(n_pairs, n_basis)`, can also be
+        given as `basis`, e.g. to share it between networks with the same
+        basis; it is otherwise computed from `dist`.
 
         Args:
             tensors (dict of tensors): input tensors
@@ -339,16 +404,28 @@ class PiNet2(tf.keras.Model):
         """
         tensors = self.preprocess(tensors)
         tensors["p3"] = tf.zeros([tf.shape(tensors["ind_1"])[0], 3, 1])
-        fc = self.cutoff(tensors["dist"])
-        basis = self.basis_fn(tensors["dist"], fc=fc)
+        if "basis" in tensors:
+            basis = tensors["basis"]
+        else:
+            basis = self.cutoff_basis(tensors["dist"])
         output = 0.0
+        row_ptr = [tensors["row_ptr"]] if "row_ptr" in tensors else []
         for i in range(self.depth):
-            p1, p3 = self.gc_blocks[i](
-                [tensors["ind_2"], tensors["p1"], tensors["p3"], tensors["diff"], basis]
+            gc_block = self.gc_blocks[i]
+            if self.recompute:
+                gc_block = recompute_grad(gc_block)
+            p1, p3 = gc_block(
+                [tensors["ind_2"], tensors["p1"], tensors["p3"], tensors["diff"], basis,
+                 *row_ptr]
             )
             output = self.out_layers[i]([tensors["ind_1"], p1, p3, output])
             tensors["p1"] = self.res_update1[i]([tensors["p1"], p1])
-            tensors["p3"] = self.res_update3[i]([tensors["p3"], p3])
+            if i == 0:
+                # p3 is zero before the first block
+                _build_skipped(self.res_update3[i], [tensors["p3"].shape, p3.shape])
+                tensors["p3"] = p3
+            else:
+                tensors["p3"] = self.res_update3[i]([tensors["p3"], p3])
 
         output = self.ann_output([tensors["ind_1"], output])
         return output
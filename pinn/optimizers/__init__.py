@@ -1,6 +1,6 @@
 import tensorflow as tf
 from pinn.optimizers.ekf import EKF, default_ekf
-from pinn.optimizers.gekf import gEKF
+from pinn.optimizers.gekf import gEKF, LRgEKF
 
 default_adam = {
     'class_name': 'Adam',
@@ -21,4 +21,6 @@ def get(optimizer):
             return EKF(**optimizer['config'])
         if optimizer['class_name']=='gEKF':
             return gEKF(**optimizer['config'])
+        if optimizer['class_name']=='LRgEKF':
+            return LRgEKF(**optimizer['config'])
     return tf.keras.optimizers.get(optimizer)
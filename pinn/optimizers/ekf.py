@@ -2,6 +2,8 @@
 
 import tensorflow as tf
 
+_summaries = (tf.compat.v1.GraphKeys.SUMMARIES,)
+
 default_ekf = {
     'class_name': 'EKF',
     'config': {
@@ -12,16 +14,29 @@ class EKF():
     (Singraber, Morawietz, Behler and Dellage, JCTC, 2017), with some difference
     in the details about learning rate and noise scheduling.
 
+    For large error vectors (e.g. forces of large batches), the cost of the
+    update can be bounded by evaluating the Jacobian in chunks
+    (`jacob_chunk`), by randomly subsampling each error vector (`max_errors`),
+    or by processing the errors sequentially in blocks (`block_size`), which
+    replaces the m x m linear system with several smaller ones.
+
     Args:
         learning_rate: learning rate
         inv_fp_prec (str): floating point precision for matrix inversion
         q_0: initial process noise
         q_tau: time constant for noise
         q_min: minimal noisee
+        jacob_chunk (int): if set, compute the Jacobian in a loop with at most
+            jacob_chunk rows in flight (default: vectorize all rows)
+        max_errors (int): maximal number of components to use from each error
+            vector in an update (default: all)
+        block_size (int): if set, update the filter sequentially with blocks of
+            at most block_size error components
     """
     def __init__(self, learning_rate, max_learning_rate=1.0,
                  epsilon=1.0, q_0=0.0, q_min=0.0, q_tau=3000.0,
-                 inv_dtype='float64'):
+                 inv_dtype='float64', jacob_chunk=None, max_errors=None,
+                 block_size=None):
         self.iterations = None
         self.learning_rate = learning_rate
         self.max_learning_rate = max_learning_rate
@@ -30,43 +45,91 @@ class EKF():
         self.q_min = q_min
         self.q_tau = q_tau
         self.inv_dtype = tf.dtypes.as_dtype(inv_dtype)
+        self.jacob_chunk = jacob_chunk
+        self.max_errors = max_errors
+        self.block_size = block_size
+
+    def subsample(self, error):
+        """Randomly selects at most max_errors components of an error vector"""
+        error = tf.reshape(error, [-1])
+        if not self.max_errors:
+            return error
+        ind = tf.random.shuffle(tf.range(tf.size(error)))[:self.max_errors]
+        return tf.gather(error, ind)
+
+    def _kalman_gain(self, P, HT, lr):
+        """Computes the Kalman gain K and PH for a (block of) Jacobian"""
+        # Computing Kalman Gain (avoid inversion, solve as linear equations)
+        PH = tf.tensordot(P, tf.transpose(HT), 1)
+        A_inv = tf.eye(tf.shape(HT)[0], dtype=HT.dtype)/lr + tf.tensordot(HT, PH, 1)
+        K = tf.linalg.lstsq(tf.cast(A_inv, self.inv_dtype),
+                            tf.cast(tf.transpose(PH), self.inv_dtype),
+                            fast=False)
+        K = tf.transpose(tf.cast(K, HT.dtype))
+        return K, PH
 
-    def get_train_op(self, error, tvars):
+    def get_train_op(self, error, tvars,
+                     scalar_collections=_summaries, hist_collections=_summaries):
+        """Creates the update op, summaries are written to the given
+        collections and skipped if the collections are empty."""
         from tensorflow.python.ops.parallel_for.gradients import jacobian
         from tensorflow.keras.optimizers.schedules import deserialize
-        jacob = jacobian(error, tvars)
+        if self.jacob_chunk is None:
+            jacob = jacobian(error, tvars)
+        else:
+            # evaluate the rows of the Jacobian in a loop, jacob_chunk rows
+            # at a time, instead of vectorizing over the whole error vector
+            jacob = jacobian(error, tvars, use_pfor=False,
+                             parallel_iterations=self.jacob_chunk)
         HT = tf.concat([tf.reshape(j, [tf.shape(j)[0], -1]) for j in jacob], axis=1)
-        H = tf.transpose(HT)
-        m = tf.shape(H)[1]
+        m = tf.shape(HT)[0]
         n = tf.reduce_sum(
             [tf.reduce_prod(var.shape) for var in tvars])
-        tf.compat.v1.summary.scalar(f'KalmanFilter/m', m)
-        tf.compat.v1.summary.scalar(f'KalmanFilter/n', n)
-        P = tf.Variable(tf.eye(n, dtype=H.dtype)/self.epsilon, trainable=False)
-        t = tf.cast(tf.compat.v1.train.get_global_step(), H.dtype)
+        if scalar_collections:
+            tf.compat.v1.summary.scalar(f'KalmanFilter/m', m, collections=scalar_collections)
+            tf.compat.v1.summary.scalar(f'KalmanFilter/n', n, collections=scalar_collections)
+        P = tf.Variable(tf.eye(n, dtype=HT.dtype)/self.epsilon, trainable=False)
+        t = tf.cast(tf.compat.v1.train.get_global_step(), HT.dtype)
         try:
             lr = deserialize(self.learning_rate)(t)
         except:
-            lr = tf.cast(self.learning_rate, H.dtype)
+            lr = tf.cast(self.learning_rate, HT.dtype)
         lr = tf.math.minimum(lr, self.max_learning_rate)
-        # Computing Kalman Gain (avoid inversion, solve as linear equations)
-        PH = tf.tensordot(P, H, 1)
-        A_inv = tf.eye(m, dtype=H.dtype)/lr + tf.tensordot(HT, PH, 1)
-        K = tf.linalg.lstsq(tf.cast(A_inv, self.inv_dtype),
-                            tf.cast(tf.transpose(PH), self.inv_dtype),
-                            fast=False)
-        K = tf.transpose(tf.cast(K, H.dtype))
-        grads = tf.tensordot(K, error, 1)
+        if self.block_size is None:
+            K, PH = self._kalman_gain(P, HT, lr)
+            grads = tf.tensordot(K, error, 1)
+            dP = -tf.tensordot(K, tf.transpose(PH), 1)
+        else:
+            # Sequential updates, the error of each block is linearized at
+            # the weights updated with the previous blocks
+            def _block_update(i, P_i, dw):
+                start = i*self.block_size
+                end = tf.minimum(start+self.block_size, m)
+                HT_b = HT[start:end]
+                error_b = error[start:end] + tf.tensordot(HT_b, dw, 1)
+                K, PH = self._kalman_gain(P_i, HT_b, lr)
+                dw = dw - tf.tensordot(K, error_b, 1)
+                P_i = P_i - tf.tensordot(K, tf.transpose(PH), 1)
+                return i+1, P_i, dw
+            n_blocks = (m+self.block_size-1)//self.block_size
+            _, P_new, dw = tf.while_loop(
+                lambda i, P_i, dw: i < n_blocks, _block_update,
+                [tf.constant(0), tf.identity(P), tf.zeros([n], HT.dtype)])
+            grads = -dw
+            dP = P_new - P
         lengths = [tf.reduce_prod(var.shape) for var in tvars]
         idx = tf.cumsum([0]+lengths)
-        Q = tf.eye(n, dtype=H.dtype)*tf.math.maximum(tf.exp(-t/self.q_tau)*self.q_0, self.q_min)
+        Q = tf.eye(n, dtype=HT.dtype)*tf.math.maximum(tf.exp(-t/self.q_tau)*self.q_0, self.q_min)
         grads = [tf.reshape(grads[idx[i]:idx[i+1]], var.shape)
                  for i,  var in enumerate(tvars)]
         grads_and_vars = zip(grads, tvars)
-        ops = [self.iterations.assign_add(1, read_value=False)]
-        ops += [P.assign_add(Q-tf.tensordot(K, tf.transpose(PH),1), read_value=False)]
-        ops += [var.assign_add(-grad, read_value=False) for grad, var in grads_and_vars]
-        tf.compat.v1.summary.histogram(f'KalmanFilter/P_diag', tf.linalg.diag_part(P))
-        tf.compat.v1.summary.histogram(f'KalmanFilter/P', P)
+        with tf.control_dependencies(grads+[dP]):
+            ops = [self.iterations.assign_add(1, read_value=False)]
+            ops += [P.assign_add(Q+dP, read_value=False)]
+            ops += [var.assign_add(-grad, read_value=False) for grad, var in grads_and_vars]
+        if hist_collections:
+            tf.compat.v1.summary.histogram(f'KalmanFilter/P_diag', tf.linalg.diag_part(P),
+                                           collections=hist_collections)
+            tf.compat.v1.summary.histogram(f'KalmanFilter/P', P, collections=hist_collections)
         train_op = tf.group(ops)
         return train_op
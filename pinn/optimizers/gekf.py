@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import numpy as np
 import tensorflow as tf
+from pinn.optimizers.ekf import _summaries
 
 class gEKF():
     """
@@ -13,10 +15,12 @@ class gEKF():
         q_tau: time constant for noise
         q_min: minimal noise
         div_prec (str): dtype for division
+        hist_P (bool): also log a histogram of the full P matrix, which
+            copies all n^2 elements at each summary step
     """
     def __init__(self, learning_rate, max_learning_rate=1.0,
                  epsilon=1.0, q_0=0.0, q_min=0.0, q_tau=3000.0,
-                 inv_dtype='float64'):
+                 inv_dtype='float64', hist_P=False):
         self.iterations = None
         self.learning_rate = learning_rate
         self.max_learning_rate = max_learning_rate
@@ -25,10 +29,14 @@ class gEKF():
         self.q_min = q_min
         self.q_tau = q_tau
         self.inv_dtype = tf.dtypes.as_dtype(inv_dtype)
+        self.hist_P = hist_P
 
-    def get_train_op(self, error, tvars):
+    def get_train_op(self, error, tvars,
+                     scalar_collections=_summaries, hist_collections=_summaries):
         from tensorflow.keras.optimizers.schedules import deserialize
         # gradients, initialize variables
+        with tf.control_dependencies([error]):
+            t0 = tf.timestamp()
         l1 = tf.reduce_mean(tf.abs(error))
         l2 = tf.reduce_mean(error**2)
         g1 = tf.gradients(l1, tvars)
@@ -55,10 +63,116 @@ class gEKF():
         Q = tf.eye(n, dtype=g1.dtype)*tf.math.maximum(tf.exp(-t/self.q_tau)*self.q_0, self.q_min)
         grads = [tf.reshape(grads[idx[i]:idx[i+1]], var.shape) for i,  var in enumerate(tvars)]
         grads_and_vars = zip(grads, tvars)
-        ops = [self.iterations.assign_add(1, read_value=False)]
-        ops += [P.assign_add(Q - tf.einsum('i,j->ij', k, Pg1), read_value=False)]
-        ops += [var.assign_sub(grad, read_value=False) for grad, var in grads_and_vars]
-        tf.compat.v1.summary.histogram('KalmanFilter/P_diag', tf.linalg.diag_part(P))
-        tf.compat.v1.summary.histogram('KalmanFilter/P', P)
-        train_op = tf.group(ops)
+        dP = Q - tf.einsum('i,j->ij', k, Pg1)
+        with tf.control_dependencies(grads+[dP]):
+            ops = [self.iterations.assign_add(1, read_value=False)]
+            ops += [P.assign_add(dP, read_value=False)]
+            ops += [var.assign_sub(grad, read_value=False) for grad, var in grads_and_vars]
+        with tf.control_dependencies(ops):
+            t1 = tf.timestamp()
+        if scalar_collections:
+            for tag, value in [('n', n), ('P_bytes', n*n*g1.dtype.size),
+                               ('step_time', t1-t0)]:
+                tf.compat.v1.summary.scalar(f'KalmanFilter/{tag}', value,
+                                            collections=scalar_collections)
+        if hist_collections:
+            tf.compat.v1.summary.histogram('KalmanFilter/P_diag', tf.linalg.diag_part(P),
+                                           collections=hist_collections)
+            if self.hist_P:
+                tf.compat.v1.summary.histogram('KalmanFilter/P', P,
+                                               collections=hist_collections)
+        train_op = tf.group(ops+[t1])
+        return train_op
+
+
+class LRgEKF(gEKF):
+    """
+    gEKF with a limited-memory approximation of the P matrix
+
+    P is stored as a diagonal minus a low-rank factor, P = diag(d) - U^T U,
+    where each row of U is the rank-1 correction of one update. Only the
+    latest `rank` corrections are kept, the diagonal contribution of an
+    evicted correction is folded into d. The memory and cost per step are
+    thus O(n*rank) instead of O(n^2).
+
+    Dropping the off-diagonal part of the evicted corrections is an
+    approximation, after which P may no longer be positive definite. The
+    diagonal of P is therefore kept above max(q_min, eps), by raising d where
+    needed.
+
+    Args:
+        learning_rate: learning rate
+        rank (int): number of rank-1 corrections to keep
+        epsilon: scale initial guess for P matrix
+        q_0: initial process noise
+        q_tau: time constant for noise
+        q_min: minimal noise
+        div_prec (str): dtype for division
+        hist_P (bool): unused, the full P matrix is never formed
+    """
+    def __init__(self, learning_rate, rank=32, **kwargs):
+        super(LRgEKF, self).__init__(learning_rate, **kwargs)
+        self.rank = rank
+
+    def get_train_op(self, error, tvars,
+                     scalar_collections=_summaries, hist_collections=_summaries):
+        from tensorflow.keras.optimizers.schedules import deserialize
+        # gradients, initialize variables
+        with tf.control_dependencies([error]):
+            t0 = tf.timestamp()
+        l1 = tf.reduce_mean(tf.abs(error))
+        l2 = tf.reduce_mean(error**2)
+        g1 = tf.gradients(l1, tvars)
+        g2 = tf.gradients(l2, tvars)
+        g1 = tf.concat([tf.reshape(g, [-1]) for g in g1], axis=0)
+        g2 = tf.concat([tf.reshape(g, [-1]) for g in g2], axis=0)
+        n = g1.shape[0]
+        d = tf.Variable(tf.ones(n, dtype=g1.dtype)/self.epsilon, trainable=False)
+        U = tf.Variable(tf.zeros([self.rank, n], dtype=g1.dtype), trainable=False)
+        ptr = tf.Variable(0, dtype=tf.int32, trainable=False)
+        t = tf.cast(tf.compat.v1.train.get_global_step(), g1.dtype)
+        try:
+            lr = deserialize(self.learning_rate)(t)
+        except:
+            lr = tf.cast(self.learning_rate, g1.dtype)
+        lr = tf.math.minimum(lr, self.max_learning_rate)
+        lengths = [tf.reduce_prod(var.shape) for var in tvars]
+        idx = tf.cumsum([0]+lengths)
+        Pg1 = d*g1 - tf.einsum('ri,r->i', U, tf.einsum('ri,i->r', U, g1))
+        Pg2 = d*g2 - tf.einsum('ri,r->i', U, tf.einsum('ri,i->r', U, g2))
+        g1Pg1 = tf.einsum('i,i->', g1, Pg1)
+        g1Pg2 = tf.einsum('i,i->', g1, Pg2)
+        a = tf.cast(1./lr+g1Pg1, self.inv_dtype)
+        k = tf.cast(tf.cast(Pg1, self.inv_dtype)/a, g2.dtype)
+        u = tf.cast(tf.cast(Pg1, self.inv_dtype)/tf.sqrt(a), g2.dtype)
+        grads = lr/2*(Pg2-k*g1Pg2) # preconditioned gradients for update
+        q = tf.math.maximum(tf.exp(-t/self.q_tau)*self.q_0, self.q_min)
+        grads = [tf.reshape(grads[idx[i]:idx[i+1]], var.shape) for i,  var in enumerate(tvars)]
+        grads_and_vars = zip(grads, tvars)
+        # P <- P - u u^T + qI, evicting the oldest correction
+        p_min = max(self.q_min, np.finfo(g1.dtype.as_numpy_dtype).eps)
+        with tf.control_dependencies(grads+[u]):
+            u_evicted = U[ptr]
+            d_new = d - u_evicted**2 + q
+            # keep the diagonal of the new P positive
+            u_sq = tf.reduce_sum(U**2, axis=0) - u_evicted**2 + u**2
+            d_new = tf.maximum(d_new, u_sq + p_min)
+            with tf.control_dependencies([d_new]):
+                ops = [self.iterations.assign_add(1, read_value=False)]
+                ops += [d.assign(d_new, read_value=False)]
+                ops += [U.scatter_nd_update([[ptr]], [u])]
+                ops += [ptr.assign((ptr+1) % self.rank, read_value=False)]
+                ops += [var.assign_sub(grad, read_value=False) for grad, var in grads_and_vars]
+        with tf.control_dependencies(ops):
+            t1 = tf.timestamp()
+        if scalar_collections:
+            for tag, value in [('n', n), ('rank', self.rank),
+                               ('P_bytes', (self.rank+1)*n*g1.dtype.size),
+                               ('step_time', t1-t0)]:
+                tf.compat.v1.summary.scalar(f'KalmanFilter/{tag}', value,
+                                            collections=scalar_collections)
+        if hist_collections:
+            tf.compat.v1.summary.histogram('KalmanFilter/P_diag', d - tf.reduce_sum(U**2, axis=0),
+                                           collections=hist_collections)
+        train_op = tf.group(ops+[t1])
         return train_op
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""Per-layer profiling of PiNN networks"""
+
+import time
+from collections import OrderedDict
+import numpy as np
+import tensorflow as tf
+
+
+def _sublayers(layer, prefix='', depth=2):
+    """Lists the (label, layer) of the sublayers of a layer
+
+    The labels follow the attribute names, e.g. `gc_blocks[0].pi_layer`,
+    sublayers are listed before their children, up to the given depth.
+    """
+    found = []
+    def _collect(label, obj):
+        if isinstance(obj, tf.keras.layers.Layer):
+            found.append((label, obj))
+            if depth > 1:
+                found.extend(_sublayers(obj, f'{label}.', depth-1))
+        elif isinstance(obj, (list, tuple)):
+            for i, v in enumerate(obj):
+                _collect(f'{label}[{i}]', v)
+        elif isinstance(obj, dict):
+            for k, v in obj.items():
+                _collect(f'{label}[{k}]', v)
+    for name, attr in vars(layer).items():
+        if name.startswith('_'):
+            continue
+        # keras wraps lists and dicts of layers in trackable wrappers
+        if hasattr(attr, '_storage'):
+            attr = attr._storage
+        _collect(f'{prefix}{name}', attr)
+    return found
+
+
+class LayerProfiler():
+    """Profiles the layers of a PiNN network
+
+    Within the context, the calls of the sublayers of the network (e.g. the
+    `PreprocessLayer`, the cutoff and basis functions, each `GCBlock` and its
+    PI, II and IP layers, the `OutLayer`s and `ANNOutput`) are wrapped in
+    named trace scopes. When the network is run eagerly, the wall time and
+    the size of the outputs of each layer are recorded, see
+    `LayerProfiler.table`. Times are inclusive, i.e. the time of a `GCBlock`
+    includes its PI, II and IP layers. The output size is that of the output
+    tensors of each call, not the peak memory of the layer.
+
+    If `logdir` is given, a `tf.profiler` trace is recorded during the
+    context as well, the eager layer calls show up as named events in the
+    trace viewer of TensorBoard. In `tf.function`s and graphs, only the name
+    scopes take effect: the ops (and their gradients) are named after the
+    layers, but there are no per-layer events or timings. Training steps are
+    profiled this way with the `profile_steps` parameter of the models.
+
+    Example:
+        with LayerProfiler(network) as prof:
+            network(tensors)
+        print(prof.table())
+
+    Args:
+        network: a PiNN network (Keras model)
+        depth (int): depth of sublayers to profile
+        logdir (str): if set, write a `tf.profiler` trace there
+    """
+    def __init__(self, network, depth=2, logdir=None):
+        self.network = network
+        # layers shared by several parents (e.g. the cutoff function) are
+        # profiled once, under their first label
+        seen = set()
+        self.layers = [(label, layer) for label, layer in _sublayers(network, depth=depth)
+                       if not (id(layer) in seen or seen.add(id(layer)))]
+        self.logdir = logdir
+        self.stats = OrderedDict(
+            (label, {'calls': 0, 'time': 0., 'bytes': 0}) for label, _ in self.layers)
+
+    def _wrap(self, label, call):
+        stats = self.stats[label]
+        def profiled_call(*args, **kwargs):
+            with tf.name_scope(label.replace('[', '_').replace(']', '')), \
+                 tf.profiler.experimental.Trace(label):
+                t0 = time.perf_counter()
+                output = call(*args, **kwargs)
+                if tf.executing_eagerly():
+                    stats['time'] += time.perf_counter() - t0
+                    stats['calls'] += 1
+                    stats['bytes'] += sum(
+                        t.shape.num_elements()*t.dtype.size
+                        for t in tf.nest.flatten(output) if isinstance(t, tf.Tensor))
+            return output
+        return profiled_call
+
+    def __enter__(self):
+        for label, layer in self.layers:
+            layer.call = self._wrap(label, layer.call)
+        if self.logdir is not None:
+            tf.profiler.experimental.start(self.logdir)
+        return self
+
+    def __exit__(self, *args):
+        if self.logdir is not None:
+            tf.profiler.experimental.stop()
+        for label, layer in self.layers:
+            del layer.call
+
+    def records(self):
+        """Returns the per-layer statistics as a list of dicts
+
+        Each record has the layer `label`, the number of `calls`, the total
+        and mean `time` (in seconds) and the mean size of the output tensors
+        per call, `output_size` (in bytes).
+        """
+        records = []
+        for label, stats in self.stats.items():
+            calls = max(stats['calls'], 1)
+            records.append({
+                'layer': label, 'calls': stats['calls'],
+                'total_time': stats['time'], 'mean_time': stats['time']/calls,
+                'output_size': stats['bytes']//calls})
+        return records
+
+    def table(self):
+        """Formats the per-layer statistics as a table
+
+        The share is given relative to the top-level layers.
+        """
+        records = self.records()
+        total = sum(r['total_time'] for r in records if '.' not in r['layer'])
+        lines = [f'{"layer":<36} {"calls":>6} {"time/call (ms)":>15} '
+                 f'{"share":>7} {"outputs (MB)":>12}']
+        for r in records:
+            if r['calls'] == 0:
+                continue
+            indent = '  ' * r['layer'].count('.')
+            name = indent + r['layer'].split('.')[-1]
+            share = r['total_time']/total if total > 0 else np.nan
+            lines.append(f'{name:<36} {r["calls"]:>6} {r["mean_time"]*1e3:>15.3f} '
+                         f'{share:>7.1%} {r["output_size"]/2**20:>12.3f}')
+        return '\n'.join(lines)
@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""Batched geometry optimization of many structures
+
+The structures are packed into one batch in the sparse format of PiNN
+(`coord`, `elems`, `ind_1` and `cell`), so that the energies and forces of
+all structures are evaluated with one call of the model. The optimizers step
+each structure independently, with the per-structure quantities computed as
+segment sums over the batch. Converged structures are dropped from the batch
+and replaced with the next ones, and are returned as soon as they finish.
+
+The optimizers follow the FIRE and LBFGS optimizers of ASE, with the same
+parameters and convergence criterion (the maximum force on an atom below
+`fmax`).
+"""
+import os
+import numpy as np
+import tensorflow as tf
+
+
+def _sum(x, ind, n):
+    """Per-structure sum of a per-atom quantity"""
+    return np.bincount(ind, x, minlength=n)
+
+
+def _max(x, ind, n):
+    """Per-structure maximum of a per-atom quantity"""
+    out = np.zeros(n)
+    np.maximum.at(out, ind, x)
+    return out
+
+
+def _free(atoms):
+    """Mask of the atoms that are not fixed by constraints"""
+    from ase.constraints import FixAtoms
+    free = np.ones(len(atoms), bool)
+    for constraint in atoms.constraints:
+        if not isinstance(constraint, FixAtoms):
+            raise NotImplementedError(
+                f'{type(constraint).__name__} constraints are not supported')
+        free[constraint.index] = False
+    return free
+
+
+class BatchOptimizer():
+    """Base class of the batched optimizers
+
+    Args:
+        model: model_dir, params file or params dict of a trained potential
+            model, or the directory of a model exported with `pinn export`
+        batch_size (int): number of structures to optimize at once
+        maxstep (float): maximum step in Å
+        to_eV (float): conversion of the energy unit of the model to eV
+        checkpoint (str): checkpoint to restore (default: the latest)
+    """
+
+    def __init__(self, model, batch_size=64, maxstep=0.2, to_eV=1.0,
+                 checkpoint=None):
+        from pinn.export import ExportedPotential, load_potential
+        self.batch_size = batch_size
+        self.maxstep = maxstep
+        self.to_eV = to_eV
+        if isinstance(model, str) and \
+           tf.io.gfile.exists(os.path.join(model, 'saved_model.pb')):
+            self.module = tf.saved_model.load(model)
+            self.dtype = self.module.energy.input_signature[0]['coord'].dtype
+        else:
+            self.dtype = tf.keras.backend.floatx()
+            self.module = ExportedPotential(*load_potential(model, checkpoint),
+                                            dtype=self.dtype)
+
+    def _init_state(self, n_atoms, n_structs):
+        """Initial state of new structures
+
+        Returns:
+            two dictionaries of arrays, with the atoms and the structures
+            along the first axis
+        """
+        return {}, {}
+
+    def _step(self, r, f, ind, atom_state, struct_state):
+        """Computes the step of all structures from the positions and forces,
+        and updates the state in place
+
+        Returns:
+            the displacements of the atoms
+        """
+        raise NotImplementedError
+
+    def _evaluate(self, batch):
+        """energies and forces of the batch, in eV and eV/Å"""
+        tensors = {'coord': tf.constant(batch['r'], self.dtype),
+                   'elems': tf.constant(batch['elems'], tf.int32),
+                   'ind_1': tf.constant(batch['ind'][:, None], tf.int32)}
+        if self.pbc:
+            tensors['cell'] = tf.constant(batch['cell'], self.dtype)
+            results = self.module.energy_forces_pbc(tensors)
+        else:
+            results = self.module.energy_forces(tensors)
+        energy = results['energy'].numpy().astype(np.float64) * self.to_eV
+        forces = results['forces'].numpy().astype(np.float64) * self.to_eV
+        return energy, forces * batch['free'][:, None]
+
+    def _pack(self, batch, keep, new):
+        """Drops the structures not in `keep` and appends the new ones"""
+        keep_atoms = keep[batch['ind']]
+        n_structs = np.sum(keep) + len(new)
+        atom_state, struct_state = self._init_state(
+            sum(len(atoms) for _, atoms in new), len(new))
+        packed = {
+            'r': [batch['r'][keep_atoms]] + [atoms.positions for _, atoms in new],
+            'elems': [batch['elems'][keep_atoms]] + [atoms.numbers for _, atoms in new],
+            'free': [batch['free'][keep_atoms]] + [_free(atoms) for _, atoms in new],
+            'cell': [batch['cell'][keep]] + [[atoms.cell[:]] for _, atoms in new],
+            'steps': [batch['steps'][keep], np.zeros(len(new), int)]}
+        packed = {k: np.concatenate(v) for k, v in packed.items()}
+        packed['atom_state'] = {
+            k: np.concatenate([batch['atom_state'][k][keep_atoms], v])
+            for k, v in atom_state.items()}
+        packed['struct_state'] = {
+            k: np.concatenate([batch['struct_state'][k][keep], v])
+            for k, v in struct_state.items()}
+        packed['structures'] = [s for s, k in zip(batch['structures'], keep) if k] + new
+        packed['ind'] = np.repeat(np.arange(n_structs),
+                                  [len(atoms) for _, atoms in packed['structures']])
+        return packed
+
+    def irun(self, structures, fmax=0.05, steps=1000):
+        """Optimizes the structures, and yields them as they finish
+
+        Args:
+            structures: iterable of ASE Atoms, e.g. from `ase.io.iread`, all
+                periodic or all non-periodic
+            fmax (float): convergence criterion of the maximum force in eV/Å
+            steps (int): maximum number of steps of each structure
+
+        Yields:
+            the index of the structure and a copy of it with the optimized
+            positions, the energy and forces (with a SinglePointCalculator),
+            and `converged` and `steps` in `atoms.info`
+        """
+        from ase.calculators.singlepoint import SinglePointCalculator
+        structures = enumerate(structures)
+        self.pbc = None
+        atom_state, struct_state = self._init_state(0, 0)
+        batch = {'r': np.zeros([0, 3]), 'elems': np.zeros([0], int),
+                 'free': np.zeros([0], bool), 'cell': np.zeros([0, 3, 3]),
+                 'steps': np.zeros([0], int), 'ind': np.zeros([0], int),
+                 'atom_state': atom_state, 'struct_state': struct_state,
+                 'structures': []}
+        keep = np.zeros([0], bool)
+        while True:
+            new = []
+            while np.sum(keep) + len(new) < self.batch_size:
+                i, atoms = next(structures, (None, None))
+                if atoms is None:
+                    break
+                if self.pbc is None:
+                    self.pbc = atoms.pbc.any()
+                if atoms.pbc.any() != self.pbc:
+                    raise ValueError(
+                        'Periodic and non-periodic structures can not be mixed')
+                new.append((i, atoms))
+            batch = self._pack(batch, keep, new)
+            if not batch['structures']:
+                return
+            n_structs = len(batch['structures'])
+            energy, forces = self._evaluate(batch)
+            f_max = _max(np.sum(forces**2, axis=1), batch['ind'], n_structs)
+            converged = f_max < fmax**2
+            keep = ~converged & (batch['steps'] < steps)
+            for j in np.where(~keep)[0]:
+                i, atoms = batch['structures'][j]
+                atoms = atoms.copy()
+                atoms.positions = batch['r'][batch['ind'] == j]
+                atoms.calc = SinglePointCalculator(
+                    atoms, energy=energy[j], forces=forces[batch['ind'] == j])
+                atoms.info.update(converged=bool(converged[j]),
+                                  steps=int(batch['steps'][j]))
+                yield i, atoms
+            dr = self._step(batch['r'], forces, batch['ind'],
+                            batch['atom_state'], batch['struct_state'])
+            batch['r'] = batch['r'] + dr * batch['free'][:, None]
+            batch['steps'] += 1
+
+    def run(self, structures, fmax=0.05, steps=1000, output=None):
+        """Optimizes the structures
+
+        Args:
+            structures: iterable of ASE Atoms
+            fmax (float): convergence criterion of the maximum force in eV/Å
+            steps (int): maximum number of steps of each structure
+            output: file name or trajectory to write the structures to as
+                they finish, see `pinn.md.open_trajectory`
+
+        Returns:
+            the optimized structures, in the order of the input
+        """
+        from pinn.md import open_trajectory
+        output = open_trajectory(output)
+        results = {}
+        for i, atoms in self.irun(structures, fmax=fmax, steps=steps):
+            if output is not None:
+                output.write(atoms)
+            results[i] = atoms
+        return [results[i] for i in sorted(results)]
+
+
+class FIRE(BatchOptimizer):
+    """Fast inertial relaxation engine (FIRE), as `ase.optimize.FIRE`
+
+    Args:
+        dt (float): initial time step
+        dtmax (float): maximum time step
+        Nmin (int): number of downhill steps before increasing the time step
+        finc (float): factor to increase the time step
+        fdec (float): factor to decrease the time step
+        astart (float): initial mixing parameter
+        fa (float): factor to decrease the mixing parameter
+
+    See `BatchOptimizer` for the other arguments.
+    """
+
+    def __init__(self, model, dt=0.1, dtmax=1.0, Nmin=5, finc=1.1, fdec=0.5,
+                 astart=0.1, fa=0.99, **kwargs):
+        super(FIRE, self).__init__(model, **kwargs)
+        self.dt = dt
+        self.dtmax = dtmax
+        self.Nmin = Nmin
+        self.finc = finc
+        self.fdec = fdec
+        self.astart = astart
+        self.fa = fa
+
+    def _init_state(self, n_atoms, n_structs):
+        atom_state = {'v': np.zeros([n_atoms, 3])}
+        struct_state = {'dt': np.full(n_structs, self.dt),
+                        'a': np.full(n_structs, self.astart),
+                        'n_downhill': np.zeros(n_structs, int),
+                        'started': np.zeros(n_structs, bool)}
+        return atom_state, struct_state
+
+    def _step(self, r, f, ind, atom_state, struct_state):
+        n = len(struct_state['dt'])
+        v, dt, a = atom_state['v'], struct_state['dt'], struct_state['a']
+        vf = _sum(np.sum(v * f, axis=1), ind, n)
+        vv = _sum(np.sum(v * v, axis=1), ind, n)
+        ff = _sum(np.sum(f * f, axis=1), ind, n)
+        downhill = struct_state['started'] & (vf > 0)
+        uphill = struct_state['started'] & ~downhill
+        # mix the velocities with the forces, or stop if going uphill
+        mix = np.divide(a * np.sqrt(vv), np.sqrt(ff), out=np.zeros(n), where=downhill)
+        v = np.where(downhill[ind, None], (1 - a)[ind, None] * v + mix[ind, None] * f, 0.)
+        speedup = downhill & (struct_state['n_downhill'] > self.Nmin)
+        dt = np.where(speedup, np.minimum(dt * self.finc, self.dtmax), dt)
+        a = np.where(speedup, a * self.fa, a)
+        dt = np.where(uphill, dt * self.fdec, dt)
+        a = np.where(uphill, self.astart, a)
+        struct_state['n_downhill'] = np.where(
+            downhill, struct_state['n_downhill'] + 1, 0)
+        struct_state['started'][:] = True
+        struct_state['dt'], struct_state['a'] = dt, a
+        # MD step, limited to maxstep
+        v = v + dt[ind, None] * f
+        atom_state['v'] = v
+        dr = dt[ind, None] * v
+        norm = np.sqrt(_sum(np.sum(dr**2, axis=1), ind, n))
+        scale = np.where(norm > self.maxstep, self.maxstep / np.maximum(norm, 1e-300), 1.)
+        return dr * scale[ind, None]
+
+
+class LBFGS(BatchOptimizer):
+    """Limited-memory BFGS, as `ase.optimize.LBFGS` (without line search)
+
+    Args:
+        memory (int): number of steps kept to approximate the Hessian
+        damping (float): factor of the steps
+        alpha (float): initial guess of the Hessian in eV/Å²
+
+    See `BatchOptimizer` for the other arguments.
+    """
+
+    def __init__(self, model, memory=100, damping=1.0, alpha=70.0, **kwargs):
+        super(LBFGS, self).__init__(model, **kwargs)
+        self.memory = memory
+        self.damping = damping
+        self.H0 = 1. / alpha
+        self.slot = 0
+
+    def _init_state(self, n_atoms, n_structs):
+        # the history is a ring buffer shared by all structures, entries
+        # from before a structure joined the batch have rho = 0 and do not
+        # contribute to its steps
+        atom_state = {'s': np.zeros([n_atoms, self.memory, 3]),
+                      'y': np.zeros([n_atoms, self.memory, 3]),
+                      'r0': np.zeros([n_atoms, 3]),
+                      'f0': np.zeros([n_atoms, 3])}
+        struct_state = {'rho': np.zeros([n_structs, self.memory]),
+                        'iteration': np.zeros(n_structs, int)}
+        return atom_state, struct_state
+
+    def _step(self, r, f, ind, atom_state, struct_state):
+        n = len(struct_state['iteration'])
+        s, y, rho = atom_state['s'], atom_state['y'], struct_state['rho']
+        iteration = struct_state['iteration']
+        # update the history
+        k = self.slot % self.memory
+        self.slot += 1
+        update = iteration > 0
+        s0 = (r - atom_state['r0']) * update[ind, None]
+        y0 = (atom_state['f0'] - f) * update[ind, None]
+        ys = _sum(np.sum(y0 * s0, axis=1), ind, n)
+        s[:, k], y[:, k] = s0, y0
+        rho[:, k] = np.divide(1., ys, out=np.zeros(n), where=update)
+        # two-loop recursion, from the newest entry to the oldest
+        n_hist = min(self.memory, np.max(iteration, initial=0))
+        slots = [(k - j) % self.memory for j in range(n_hist)]
+        q = -f
+        a = np.zeros([n, self.memory])
+        for i in slots:
+            a[:, i] = rho[:, i] * _sum(np.sum(s[:, i] * q, axis=1), ind, n)
+            q = q - a[ind, i, None] * y[:, i]
+        z = self.H0 * q
+        for i in reversed(slots):
+            b = rho[:, i] * _sum(np.sum(y[:, i] * z, axis=1), ind, n)
+            z = z + s[:, i] * (a[:, i] - b)[ind, None]
+        dr = -z
+        # scale the step so that no atom moves more than maxstep
+        longest = np.sqrt(_max(np.sum(dr**2, axis=1), ind, n))
+        scale = np.where(longest >= self.maxstep, self.maxstep / np.maximum(longest, 1e-300), 1.)
+        atom_state['r0'], atom_state['f0'] = r, f
+        struct_state['iteration'] += 1
+        return dr * scale[ind, None] * self.damping
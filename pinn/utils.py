@@ -96,6 +96,19 @@ def count_atoms(ind_1, dtype):
         tf.ones_like(ind_1, dtype), ind_1, tf.reduce_max(ind_1)+1)
 
 
+def sorted_segment_sum(data, segment_ids, num_segments):
+    """Sums up the data in sorted segments, e.g. pairs sorted by the center
+
+    Equivalent to `tf.math.unsorted_segment_sum` for sorted segment_ids, but
+    uses the cheaper `tf.math.segment_sum`, the output is padded to
+    num_segments.
+    """
+    output = tf.math.segment_sum(data, segment_ids)
+    n_pad = num_segments - tf.shape(output)[0]
+    padding = tf.zeros(tf.concat([[n_pad], tf.shape(data)[1:]], 0), data.dtype)
+    return tf.concat([output, padding], 0)
+
+
 def get_atomic_dress(dataset, elems, key='e_data'):
     """Fit the atomic energy with a element dependent atomic dress
 
@@ -261,3 +274,83 @@ def _connect_basis_grad(diff, basis, jacob):
         ddiff = tf.reduce_sum(ddiff, axis=2)
         return ddiff, None, None
     return tf.identity(basis), lambda dbasis: _grad(dbasis, jacob)
+
+
+def recompute_grad(layer):
+    """Wraps a layer to recompute its activations during backpropagation
+
+    Only the inputs of the layer are kept for the backward pass, the
+    intermediate tensors are recomputed from them. Unlike
+    `tf.recompute_grad`, the gradient is again a recomputed function of the
+    inputs, so that the second order derivatives needed for force training
+    are exact, and recomputed block by block as well. The memory is saved in
+    graph mode (the estimator or a `tf.function`); integer inputs, such as
+    the neighbor list indices, get no gradients.
+
+    Args:
+        layer: a callable taking a (nested) list of tensors
+
+    Returns:
+        a function with the same inputs and outputs as the layer
+    """
+    def wrapped(inputs):
+        flat = tf.nest.flatten(inputs)
+        is_float = [x.dtype.is_floating for x in flat]
+        structure = []
+
+        def fn(*x):
+            it = iter(x)
+            args = [next(it) if f else arg for arg, f in zip(flat, is_float)]
+            out = layer(tf.nest.pack_sequence_as(inputs, args))
+            structure[:] = [out]
+            return tf.nest.flatten(out)
+
+        out = _recompute(fn, [x for x, f in zip(flat, is_float) if f])
+        return tf.nest.pack_sequence_as(structure[0], out)
+    return wrapped
+
+
+def _after(tensors, dep):
+    """Returns the tensors, computed only after dep in graph mode
+
+    The ordering is a data dependency: each tensor is added a zero taken
+    from the first element of dep (or a nan, if that element is nan). A
+    `tf.control_dependencies` edge is not enough, grappler's dependency
+    optimizer prunes it and the recomputation is then scheduled with the
+    forward pass. The zero is selected with `tf.where` rather than e.g.
+    multiplied by zero, which constant folding would remove as well.
+    `tf.recompute_grad` orders its recomputation in the same way.
+    """
+    if tf.executing_eagerly():
+        return list(tensors)
+    elem = tf.reshape(dep, [-1])[:1]
+    zero = tf.reduce_sum(tf.where(tf.math.is_nan(elem), elem, tf.zeros_like(elem)))
+    return [t + tf.cast(zero, t.dtype) for t in tensors]
+
+
+def _recompute(fn, x):
+    """Evaluates fn(*x), a list of tensors, without keeping the intermediates;
+    the gradient recomputes fn and is itself evaluated with _recompute"""
+    @tf.custom_gradient
+    def _inner(*x):
+        y = fn(*x)
+
+        def _grad(*dy, variables=None):
+            variables = [] if variables is None else list(variables)
+            dy = [tf.zeros_like(yi) if d is None else d for d, yi in zip(dy, y)]
+            # recompute only once dy is available, after the forward pass
+            x_dep = _after(x, dy[0])
+            n = len(x)
+
+            def vjp(*args):
+                with tf.GradientTape() as tape:
+                    tape.watch(args[:n])
+                    out = fn(*args[:n])
+                return tape.gradient(out, list(args[:n]) + variables,
+                                     output_gradients=list(args[n:]),
+                                     unconnected_gradients='zero')
+
+            grads = _recompute(vjp, x_dep + dy)
+            return grads[:n], grads[n:]
+        return y, _grad
+    return _inner(*x)
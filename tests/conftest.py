@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""Options and fixtures for the performance benchmarks
+
+The tests marked with `benchmark` are skipped unless `--bench` is given. The
+results can be saved as a JSON baseline with `--bench-save`, and compared
+against a saved baseline with `--bench-compare`, in which case a benchmark
+fails when it is slower than the baseline by more than `--bench-threshold`.
+"""
+
+import json, time, platform
+import numpy as np
+import pytest
+
+_results = {}
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('benchmark')
+    group.addoption('--bench', action='store_true',
+                    help='run the benchmarks')
+    group.addoption('--bench-save', metavar='PATH', default=None,
+                    help='save the benchmark results to a JSON baseline')
+    group.addoption('--bench-compare', metavar='PATH', default=None,
+                    help='compare the benchmarks against a JSON baseline')
+    group.addoption('--bench-threshold', metavar='FRAC', default=0.2, type=float,
+                    help='relative slowdown flagged as a regression')
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers', 'benchmark: performance benchmark, only run with --bench')
+
+
+def _bench_enabled(config):
+    return any(config.getoption(opt) for opt in
+               ['--bench', '--bench-save', '--bench-compare'])
+
+
+def pytest_collection_modifyitems(config, items):
+    if _bench_enabled(config):
+        return
+    skip = pytest.mark.skip(reason='benchmarks only run with --bench')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture
+def bench(request):
+    """Times a function and records the result under the test id
+
+    Usage: `bench(fn, *args, repeats=10, **kwargs)`, the function is called
+    once to warm up (e.g. tracing) and the median of the repeats is recorded.
+    Returns the output of the function.
+    """
+    config = request.config
+    baseline = None
+    if config.getoption('--bench-compare'):
+        with open(config.getoption('--bench-compare')) as f:
+            baseline = json.load(f)['results'].get(request.node.name)
+
+    def _bench(fn, *args, repeats=10, **kwargs):
+        out = fn(*args, **kwargs)
+        elapsed = []
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            out = fn(*args, **kwargs)
+            elapsed.append(time.perf_counter() - t0)
+        result = {'median': float(np.median(elapsed)),
+                  'min': float(np.min(elapsed)), 'repeats': repeats}
+        _results[request.node.name] = result
+        if baseline is not None:
+            threshold = config.getoption('--bench-threshold')
+            slowdown = result['median']/baseline['median'] - 1
+            result['baseline'] = baseline['median']
+            if slowdown > threshold:
+                pytest.fail(f'{request.node.name} is {slowdown:.1%} slower than '
+                            f'the baseline ({result["median"]:.4g}s vs. '
+                            f'{baseline["median"]:.4g}s)')
+        return out
+    return _bench
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    if not _results:
+        return
+    tr = terminalreporter
+    tr.section('benchmarks')
+    tr.write_line(f'{"name":<40} {"median (s)":>12} {"min (s)":>12} {"baseline (s)":>12}')
+    for name, res in _results.items():
+        base = f'{res["baseline"]:12.4g}' if 'baseline' in res else f'{"-":>12}'
+        tr.write_line(f'{name:<40} {res["median"]:12.4g} {res["min"]:12.4g} {base}')
+
+
+def pytest_sessionfinish(session):
+    path = session.config.getoption('--bench-save')
+    if not (path and _results):
+        return
+    import tensorflow as tf
+    with open(path, 'w') as f:
+        json.dump({'machine': platform.node(), 'processor': platform.processor(),
+                   'tensorflow': tf.__version__, 'results': _results}, f, indent=2)
@@ -51,3 +51,33 @@ def get_trivial_numpy_ds():
     dataset = load_numpy(data)
     return dataset
 
+
+def get_lj_model(model_dir, **model_params):
+    """Trains a small PiNet potential on LJ hydrogen boxes, returns the params"""
+    import pinn
+    from pinn.io import load_numpy, sparse_batch
+    from ase import Atoms
+    from ase.calculators.lj import LennardJones
+    rng = np.random.default_rng(0)
+    atoms = Atoms('H8', cell=[4, 4, 4], pbc=True)
+    atoms.calc = LennardJones(rc=3.0)
+    data = {'coord': [], 'elems': [], 'cell': [], 'e_data': [], 'f_data': []}
+    for i in range(20):
+        atoms.positions = rng.uniform(0, 4, [8, 3])
+        data['coord'].append(atoms.positions.copy())
+        data['elems'].append(atoms.numbers)
+        data['cell'].append(np.array(atoms.cell))
+        data['e_data'].append(atoms.get_potential_energy())
+        data['f_data'].append(atoms.get_forces())
+    data = {k: np.array(v) for k, v in data.items()}
+    params = {
+        'model_dir': model_dir,
+        'network': {'name': 'PiNet', 'params': {
+            'atom_types': [1], 'rc': 3.0, 'depth': 2,
+            'pp_nodes': [8], 'pi_nodes': [8], 'ii_nodes': [8], 'out_nodes': [8]}},
+        'model': {'name': 'potential_model', 'params': {
+            'use_force': True, 'e_scale': 2.0, 'e_unit': 0.5, 'e_dress': {1: 0.1},
+            **model_params}}}
+    pinn.get_model(params).train(
+        lambda: load_numpy(data).repeat().apply(sparse_batch(4)), steps=20)
+    return params
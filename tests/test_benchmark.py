@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""Performance benchmarks for the hot paths of PiNN
+
+These tests are skipped by default, run them with:
+
+    pytest tests/test_benchmark.py --bench-save baseline.json
+    pytest tests/test_benchmark.py --bench-compare baseline.json
+
+The benchmarks are not forked, so that the timings are collected in one
+process, see `conftest.py` for the options.
+"""
+
+import pytest
+import numpy as np
+import tensorflow as tf
+from pinn.benchmark import water_box, make_batch
+
+
+def _water_nl(n_atoms, rc=5.0):
+    from pinn.layers import CellListNL
+    tensors = make_batch([water_box(n_atoms)])
+    tensors.update(CellListNL(rc)(tensors))
+    return tensors
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('n_atoms', [100, 1000, 10000])
+def test_cell_list_nl(bench, n_atoms):
+    from pinn.layers import CellListNL
+    tensors = make_batch([water_box(n_atoms)])
+    nl = tf.function(CellListNL(rc=5.0))
+    bench(lambda: nl(tensors)['ind_2'].numpy())
+
+
+def _layer_fwd_bwd(layer, inputs):
+    @tf.function
+    def fwd_bwd():
+        with tf.GradientTape() as tape:
+            out = layer(inputs)
+        return tape.gradient(out, layer.trainable_variables)
+    return lambda: [g.numpy() for g in fwd_bwd()]
+
+
+def _stacked_basis(cutoff, basis):
+    # one op per basis function, as before the basis was vectorized
+    if hasattr(basis, 'center'):
+        return lambda d: tf.stack([tf.exp(-g * (d - c)**2) * cutoff(d)
+                                   for c, g in zip(basis.center, basis.gamma)], axis=1)
+    return lambda d: tf.stack([cutoff(d)**n for n in basis.n_basis], axis=1)
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('order', [1, 2])
+@pytest.mark.parametrize('impl', ['stacked', 'vectorized'])
+@pytest.mark.parametrize('basis', ['gaussian', 'polynomial'])
+def test_cutoff_basis(bench, basis, impl, order):
+    """Gradients of the radial basis w.r.t. the distances (order 1), and of
+    the squared forces w.r.t. the basis weights (order 2, force training)"""
+    from pinn.layers import CutoffFunc, GaussianBasis, PolynomialBasis, CutoffBasis
+    cutoff = CutoffFunc(5.0)
+    basis = {'gaussian': lambda: GaussianBasis(rc=5.0, n_basis=10, gamma=3.0),
+             'polynomial': lambda: PolynomialBasis(10)}[basis]()
+    fn = CutoffBasis(cutoff, basis) if impl == 'vectorized' else _stacked_basis(cutoff, basis)
+    dist = tf.constant(np.random.default_rng(0).uniform(0.5, 5.0, 200000), tf.float32)
+    weight = tf.Variable(tf.random.uniform([10]))
+
+    @tf.function
+    def grad():
+        with tf.GradientTape() as tape2:
+            with tf.GradientTape() as tape1:
+                tape1.watch(dist)
+                out = tf.reduce_sum(fn(dist) * weight)
+            grad = tape1.gradient(out, dist)
+            loss = tf.reduce_sum(grad**2)
+        return grad if order == 1 else tape2.gradient(loss, weight)
+    bench(lambda: grad().numpy())
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('layer', ['PILayer', 'GCBlock'])
+def test_pinet_layers(bench, layer):
+    from pinn.networks.pinet import PILayer, GCBlock
+    from pinn.layers import CutoffFunc, PolynomialBasis
+    tensors = _water_nl(1000)
+    n_atoms = tensors['coord'].shape[0]
+    prop = tf.random.uniform([n_atoms, 16])
+    basis = PolynomialBasis(4)(tensors['dist'], fc=CutoffFunc(5.0)(tensors['dist']))
+    if layer == 'PILayer':
+        layer = PILayer([16, 16], activation='tanh')
+    else:
+        layer = GCBlock([16, 16], [16, 16], [16, 16], activation='tanh')
+    bench(_layer_fwd_bwd(layer, [tensors['ind_2'], prop, basis]))
+
+
+@pytest.mark.benchmark
+def test_bpsf_jacobian(bench):
+    from pinn.networks.bpnn import BPSymmFunc
+    from pinn.benchmark import default_networks
+    params = default_networks['BPNN']['params']
+    tensors = _water_nl(300)
+    sf = BPSymmFunc(params['sf_spec'], params['rc'], 'f1', use_jacobian=True)
+    fn = tf.function(lambda tensors: sf(dict(tensors))['jacob_0'])
+    bench(lambda: fn(tensors).numpy())
+
+
+def _water_ds(n_structs, n_atoms):
+    from pinn.io import load_numpy
+    data = [water_box(n_atoms, seed=i) for i in range(n_structs)]
+    data = {k: np.stack([d[k] for d in data]) for k in data[0]}
+    data['e_data'] = np.zeros(n_structs)
+    return load_numpy(data)
+
+
+@pytest.mark.benchmark
+def test_sparse_batch(bench):
+    from pinn.io import sparse_batch
+    dataset = _water_ds(256, 96).cache()
+    ds = dataset.apply(sparse_batch(32))
+    bench(lambda: [b['coord'].numpy() for b in ds])
+
+
+@pytest.mark.benchmark
+def test_load_tfrecord(bench, tmp_path):
+    from pinn.io import load_tfrecord, write_tfrecord
+    write_tfrecord(f'{tmp_path}/water.yml', _water_ds(1024, 96))
+    ds = load_tfrecord(f'{tmp_path}/water.yml')
+    bench(lambda: [b['coord'].numpy() for b in ds])
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""Tests for the in-graph molecular dynamics"""
+
+import tempfile
+import pytest
+import numpy as np
+from shutil import rmtree
+from ase import Atoms, units
+from helpers import get_lj_model
+
+
+def _atoms(pbc=True):
+    rng = np.random.default_rng(1)
+    grid = np.stack(np.meshgrid(*[np.arange(2)]*3), -1).reshape(-1, 3)
+    atoms = Atoms('H8', positions=grid*2.0 + rng.uniform(-0.2, 0.2, [8, 3]),
+                  cell=[4, 4, 4], pbc=pbc)
+    atoms.set_velocities(rng.normal(0, 0.01, [8, 3]))
+    return atoms
+
+
+@pytest.mark.forked
+@pytest.mark.parametrize('pbc', [True, False])
+def test_velocity_verlet(pbc):
+    """The in-graph integrator follows the ASE integrator with the same
+    potential, and the skin neighbor list does not change the results"""
+    import pinn
+    from ase.md.verlet import VelocityVerlet as ASEVelocityVerlet
+    from pinn.export import export_potential
+    from pinn.md import VelocityVerlet
+    testpath = tempfile.mkdtemp()
+    params = get_lj_model(f'{testpath}/model')
+    export_potential(params['model_dir'], f'{testpath}/export')
+
+    results = []
+    for skin in [0.01, 2.0]:
+        atoms = _atoms(pbc)
+        md = VelocityVerlet(atoms, params['model_dir'], 0.5*units.fs, skin=skin)
+        md.run(20)
+        results.append((atoms.positions, atoms.get_velocities(), md.n_builds))
+    assert results[0][2] > results[1][2] == 1
+    assert np.allclose(results[0][0], results[1][0], atol=1e-4)
+    assert np.allclose(results[0][1], results[1][1], atol=1e-4)
+
+    atoms = _atoms(pbc)
+    atoms.calc = pinn.get_calc(f'{testpath}/export', properties=['energy', 'forces'])
+    ASEVelocityVerlet(atoms, 0.5*units.fs).run(20)
+    assert np.allclose(atoms.positions, results[0][0], atol=1e-4)
+    rmtree(testpath)
+
+
+@pytest.mark.forked
+def test_trajectory():
+    """Frames are written every stride steps, Langevin runs are reproducible
+    with the same seed"""
+    from ase.io import read
+    from pinn.md import Langevin
+    testpath = tempfile.mkdtemp()
+    params = get_lj_model(f'{testpath}/model')
+    positions = []
+    for i in range(2):
+        atoms = _atoms()
+        md = Langevin(atoms, params['model_dir'], 0.5*units.fs, temperature_K=300,
+                      friction=0.01, seed=1, trajectory=f'{testpath}/md{i}.xyz',
+                      stride=5)
+        md.run(7)
+        md.run(8)
+        positions.append(atoms.positions)
+    assert np.allclose(positions[0], positions[1])
+    frames = read(f'{testpath}/md0.xyz', ':')
+    assert len(frames) == 4
+    assert np.allclose(frames[-1].positions, positions[0])
+    assert np.isclose(frames[-1].get_potential_energy(), md.get_potential_energy())
+    rmtree(testpath)
@@ -115,7 +115,9 @@ def test_derivitives():
 
 
 @pytest.mark.forked
-def test_clist_nl():
+@pytest.mark.parametrize('cells', ['triclinic', 'orthorhombic', 'mixed'])
+@pytest.mark.parametrize('ghosts', ['slab', 'full'])
+def test_clist_nl(cells, ghosts):
     """Cell list neighbor test
     Compare with ASE implementation
     """
@@ -123,7 +125,12 @@ def test_clist_nl():
     from ase.neighborlist import neighbor_list
     from pinn.layers import CellListNL
 
-    to_test = [bulk('Cu'), bulk('Mg'), bulk('Fe')]
+    to_test = {
+        'triclinic': [bulk('Cu'), bulk('Mg'), bulk('Fe')],
+        'orthorhombic': [bulk('Cu', cubic=True), bulk('NaCl', 'rocksalt', 5.6, cubic=True)],
+        'mixed': [bulk('Cu', cubic=True), bulk('Mg')]}[cells]
+    for a in to_test:
+        a.positions += 3.0 # some atoms outside of the cell
     ind, coord, cell = [],[],[]
     for i, a in enumerate(to_test):
         ind.append([[i]]*len(a))
@@ -134,7 +141,7 @@ def test_clist_nl():
         'ind_1': tf.constant(np.concatenate(ind, axis=0), tf.int32),
         'coord': tf.constant(np.concatenate(coord, axis=0), tf.float32),
         'cell': tf.constant(np.stack(cell, axis=0), tf.float32)}
-    nl = CellListNL(rc=10)(tensors)
+    nl = CellListNL(rc=10, ghosts=ghosts)(tensors)
     dist_pinn = nl['dist'].numpy()
 
     dist_ase = []
@@ -142,3 +149,440 @@ def test_clist_nl():
         dist_ase.append(neighbor_list('d', a, 10))
     dist_ase = np.concatenate(dist_ase,0)
     assert np.allclose(np.sort(dist_ase), np.sort(dist_pinn), rtol=1e-2)
+
+
+def _write_lj_tfrecords(tmp):
+    from pinn.io import load_numpy, sparse_batch, write_tfrecord
+    from test_potential import _get_lj_data
+    dataset = load_numpy(_get_lj_data(), splits={'train': 8, 'eval': 2})
+    for split in ['train', 'eval']:
+        write_tfrecord(f'{tmp}/{split}.yml', dataset[split].apply(sparse_batch(10)))
+
+
+@pytest.mark.forked
+def test_distributed_training():
+    """Data-parallel training with two local worker processes"""
+    import yaml
+    import multiprocessing as mp
+    from click.testing import CliRunner
+    from pinn.cli import main
+    tmp = tempfile.mkdtemp(prefix='pinn_test')
+    # tf.data may hang in a forked process, write the dataset in a new one
+    writer = mp.get_context('spawn').Process(target=_write_lj_tfrecords, args=(tmp,))
+    writer.start()
+    writer.join()
+    params = {
+        'model_dir': f'{tmp}/model',
+        'network': {
+            'name': 'PiNet',
+            'params': {
+                'ii_nodes':[8,8],
+                'pi_nodes':[8,8],
+                'pp_nodes':[8,8],
+                'out_nodes':[8,8],
+                'depth': 2,
+                'rc': 5.0,
+                'atom_types':[1]}},
+        'model':{
+            'name': 'potential_model',
+            'params': {'use_force': True}}}
+    with open(f'{tmp}/params.yml', 'w') as f:
+        yaml.safe_dump(params, f)
+    result = CliRunner().invoke(main, [
+        'train', f'{tmp}/params.yml', '-t', f'{tmp}/train.yml',
+        '-e', f'{tmp}/eval.yml', '--workers', '2', '--train-steps', '20',
+        '--ckpt-every', '10'])
+    assert result.exit_code == 0, result.output
+    assert tf.train.latest_checkpoint(f'{tmp}/model').endswith('-20')
+    assert os.path.isdir(f'{tmp}/model/eval')
+    rmtree(tmp, ignore_errors=True)
+
+
+@pytest.mark.forked
+def test_benchmark():
+    """Stage timings of the benchmark on synthetic systems"""
+    from pinn.benchmark import (default_networks, water_box, qm9_like,
+                                make_batch, run_benchmark)
+    batches = [('water', make_batch([water_box(24, seed=i) for i in range(2)])),
+               ('qm9', make_batch([qm9_like(12)]))]
+    records = run_benchmark({'LJ': default_networks['LJ']}, batches, repeats=2)
+    assert [r['batch_size'] for r in records] == [2, 1]
+    assert [r['n_atoms'] for r in records] == [48, 12]
+    assert all(r[f'{s}_time'] > 0 for r in records
+               for s in ['nl', 'preprocess', 'forward', 'forces'])
+    assert records[0]['stress_time'] > 0
+    assert records[1]['stress_time'] is None
+
+
+@pytest.mark.forked
+def test_layer_profiler():
+    """Per-layer timings of PiNet"""
+    from pinn.networks.pinet import PiNet
+    from pinn.profiler import LayerProfiler
+    from pinn.benchmark import water_box, make_batch
+    tensors = make_batch([water_box(24)])
+    network = PiNet(atom_types=[1, 8], depth=2)
+    network(dict(tensors))
+    with LayerProfiler(network) as prof:
+        network(dict(tensors))
+        network(dict(tensors))
+    stats = {r['layer']: r for r in prof.records()}
+    for layer in ['preprocess', 'basis_fn', 'gc_blocks[1].pi_layer',
+                  'gc_blocks[1].ip_layer', 'out_layers[0]', 'ann_output']:
+        assert stats[layer]['calls'] == 2
+        assert stats[layer]['total_time'] > 0
+    assert stats['gc_blocks[1]']['total_time'] > stats['gc_blocks[1].pi_layer']['total_time']
+    assert 'pi_layer' in prof.table()
+    # the layers are restored after profiling
+    assert 'call' not in vars(network.gc_blocks[0].pi_layer)
+
+
+@pytest.mark.forked
+def test_profile_steps():
+    """Training steps are traced in model_dir, with ops named after layers"""
+    from glob import glob
+    from helpers import get_lj_model
+    testpath = tempfile.mkdtemp()
+    get_lj_model(testpath, profile_steps=[5, 8])
+    traces = glob(f'{testpath}/plugins/profile/*/*.xplane.pb')
+    assert len(traces) == 1
+    with open(traces[0], 'rb') as f:
+        assert b'gc_blocks_1/pi_layer' in f.read()
+    rmtree(testpath)
+
+
+@pytest.mark.forked
+@pytest.mark.parametrize('network', ['PiNet', 'PiNet2', 'BPNN'])
+def test_mixed_precision(network):
+    """Networks with reduced precision dense layers and full precision output"""
+    from pinn import get_network
+    from pinn.benchmark import default_networks, water_box, make_batch
+    # the bfloat16 error depends on the random weights, fix them
+    tf.random.set_seed(0)
+    tensors = make_batch([water_box(24)])
+    params = default_networks[network]['params'].copy()
+    if network != 'BPNN':
+        params['depth'] = 2
+    ref = get_network({'name': network, 'params': params})
+    mixed = get_network({'name': network, 'params': {**params, 'policy': 'mixed_bfloat16'}})
+    ref(dict(tensors))
+    mixed(dict(tensors))
+    mixed.set_weights(ref.get_weights())
+    forces = []
+    for net in [ref, mixed]:
+        with tf.GradientTape() as tape:
+            tape.watch(tensors['coord'])
+            energy = tf.reduce_sum(net(dict(tensors)))
+        assert energy.dtype == tf.float32
+        forces.append(tape.gradient(energy, tensors['coord']))
+    assert all(v.dtype == tf.float32 for v in mixed.trainable_variables)
+    assert forces[1].dtype == tf.float32
+    assert np.max(np.abs(forces[1]-forces[0])) < 0.1*np.max(np.abs(forces[0]))
+
+
+@pytest.mark.forked
+def test_clist_nl_float64():
+    """Neighbor list in float64 for float32 coordinates in a large cell"""
+    from pinn.layers import CellListNL
+    from pinn.benchmark import water_box
+    coord = (water_box(96)['coord'] + 990.).astype(np.float32)
+    tensors = {'ind_1': tf.zeros([len(coord), 1], tf.int32),
+               'coord': tf.constant(coord),
+               'cell': tf.constant(np.eye(3, dtype=np.float32)[None]*1000.)}
+    with tf.GradientTape() as tape:
+        tape.watch(tensors['coord'])
+        nl = CellListNL(rc=5.0, nl_dtype='float64')(tensors)
+        energy = tf.reduce_sum(nl['dist']**2)
+    grad = tape.gradient(energy, tensors['coord'])
+    assert nl['diff'].dtype == tf.float32 and grad.dtype == tf.float32
+    i, j = nl['ind_2'].numpy().T
+    diff = coord[j].astype(np.float64) - coord[i]
+    diff -= np.round(diff/1000.)*1000.
+    assert np.allclose(nl['diff'], diff, atol=1e-6)
+    # d(sum(d_ij^2))/dx_i = -4 sum_j diff_ij (pairs are counted twice)
+    grad_ref = -4*np.array([diff[i == a].sum(0) for a in range(len(coord))])
+    assert np.allclose(grad, grad_ref, atol=1e-3)
+
+
+@pytest.mark.forked
+@pytest.mark.parametrize('network', ['PiNet', 'PiNet2', 'BPNN'])
+def test_csr_nl(network):
+    """Neighbor list with offsets gives the same predictions and forces"""
+    import pinn
+    from pinn.layers import CellListNL
+    from pinn.networks.bpnn import _form_triplet
+    from pinn.benchmark import water_box, make_batch, default_networks
+    tensors = make_batch([water_box(48, seed=i) for i in range(3)])
+    nl = CellListNL(rc=4.0, csr=True)(tensors)
+    ind_i = nl['ind_2'][:, 0].numpy()
+    assert np.all(np.diff(ind_i) >= 0)
+    assert np.array_equal(np.diff(nl['row_ptr']), np.bincount(ind_i, minlength=144))
+    assert np.array_equal(_form_triplet({**tensors, **nl}),
+                          _form_triplet({**tensors, 'ind_2': nl['ind_2']}))
+
+    params = {**default_networks[network]['params'], 'rc': 4.0}
+    if network != 'BPNN':
+        params['depth'] = 2
+    nets = [pinn.get_network({'name': network, 'params': {**params, 'csr': csr}})
+            for csr in [False, True]]
+    for net in nets:
+        net(dict(tensors))
+    nets[1].set_weights(nets[0].get_weights())
+    results = []
+    for net in nets:
+        with tf.GradientTape() as tape:
+            tape.watch(tensors['coord'])
+            energy = tf.reduce_sum(net(dict(tensors)))
+        results.append((energy, tape.gradient(energy, tensors['coord'])))
+    assert np.allclose(results[0][0], results[1][0], rtol=1e-4)
+    assert np.allclose(results[0][1], results[1][1], rtol=1e-3, atol=1e-3)
+
+
+@pytest.mark.forked
+def test_all_pairs_nl():
+    """All pairs and automatic neighbor lists agree with the cell list"""
+    from pinn.layers import CellListNL, AllPairsNL, AutoNL
+    from pinn.benchmark import qm9_like, water_box, make_batch
+
+    def _pairs(nl):
+        order = np.lexsort(nl['ind_2'].numpy().T[::-1])
+        return nl['ind_2'].numpy()[order], nl['dist'].numpy()[order]
+
+    for sizes in [[3, 18, 29, 9], [12, 100]]:
+        tensors = make_batch([qm9_like(n, seed=n) for n in sizes])
+        ind_ref, dist_ref = _pairs(CellListNL(rc=4.0)(tensors))
+        all_pairs = AllPairsNL(rc=4.0, csr=True)(tensors)
+        ind_2 = all_pairs['ind_2'].numpy()
+        assert np.all(np.diff(ind_2[:, 0]) >= 0)
+        assert np.array_equal(np.diff(all_pairs['row_ptr']),
+                              np.bincount(ind_2[:, 0], minlength=sum(sizes)))
+        for nl in [all_pairs, tf.function(AutoNL(rc=4.0, max_atoms=30))(tensors)]:
+            ind_2, dist = _pairs(nl)
+            assert np.array_equal(ind_2, ind_ref)
+            assert np.allclose(dist, dist_ref)
+    with pytest.raises(ValueError):
+        AllPairsNL(rc=4.0)(make_batch([water_box(24)]))
+
+
+@pytest.mark.forked
+def test_nl_type():
+    """Networks give the same energy and forces with all neighbor lists"""
+    from pinn.networks.pinet import PiNet
+    from pinn.benchmark import qm9_like, make_batch
+    tensors = make_batch([qm9_like(n, seed=n) for n in [5, 12, 20]])
+    nets = [PiNet(atom_types=[1, 6, 7, 8, 9], depth=2, nl_type=nl_type)
+            for nl_type in ['cell', 'all_pairs', 'auto']]
+    for net in nets:
+        net(dict(tensors))
+        net.set_weights(nets[0].get_weights())
+    results = []
+    for network in nets:
+        with tf.GradientTape() as tape:
+            tape.watch(tensors['coord'])
+            energy = tf.reduce_sum(network(dict(tensors)))
+        results.append((energy, tape.gradient(energy, tensors['coord'])))
+        assert not isinstance(results[-1][1], tf.IndexedSlices)
+    for energy, forces in results[1:]:
+        assert np.allclose(energy, results[0][0], rtol=1e-5)
+        assert np.allclose(forces, results[0][1], atol=1e-4)
+
+
+@pytest.mark.forked
+@pytest.mark.parametrize('cutoff_type', ['f1', 'f2', 'hip'])
+def test_cutoff_basis(cutoff_type):
+    """The cutoff+basis matches the per-basis list comprehension,
+    including the gradients (up to second order) where fc is zero"""
+    from pinn.layers import CutoffFunc, GaussianBasis, PolynomialBasis, CutoffBasis
+    from pinn.layers.bpsf import G2_SF, G4_SF
+    from pinn.benchmark import water_box, make_batch
+    from pinn.networks.bpnn import _form_triplet
+    tf.keras.backend.set_floatx('float64')
+    cutoff = CutoffFunc(5.0, cutoff_type)
+    ref_basis = {
+        'gaussian': lambda b, d, fc: tf.stack(
+            [tf.exp(-g * (d - c)**2) * fc for c, g in zip(b.center, b.gamma)], axis=1),
+        'polynomial': lambda b, d, fc: tf.stack([fc**i for i in b.n_basis], axis=1)}
+    # the last distance sits at the cutoff, where fc == 0
+    dist = tf.constant(np.r_[np.random.uniform(0.5, 4.9, 50), 5.0])
+    for name, basis in [('gaussian', GaussianBasis(rc=5.0, n_basis=10, gamma=0.5)),
+                        ('polynomial', PolynomialBasis(6)),
+                        ('polynomial', PolynomialBasis([0, 2, 3]))]:
+        combined = CutoffBasis(cutoff, basis)
+        ref = lambda d: ref_basis[name](basis, d, cutoff(d))
+        weight = tf.constant(np.random.randn(ref(dist).shape[1]))
+        results = []
+        for fn in [ref, combined]:
+            with tf.GradientTape() as tape2:
+                tape2.watch(dist)
+                with tf.GradientTape() as tape1:
+                    tape1.watch(dist)
+                    out = tf.reduce_sum(fn(dist) * weight)
+                grad = tape1.gradient(out, dist)
+            results.append([fn(dist), grad, tape2.gradient(grad, dist)])
+        for ref_val, val in zip(*results):
+            assert np.allclose(ref_val[:-1], val[:-1])
+            assert np.all(np.isfinite(val.numpy()))
+        # fc**0 has a NaN gradient at fc == 0 in the reference
+        for ref_val, val in zip(*results):
+            if np.isfinite(ref_val[-1].numpy()).all():
+                assert np.allclose(ref_val[-1], val[-1])
+    # symmetry functions with and without the cutoff layer
+    tensors = make_batch([water_box(24)])
+    tensors = {k: tf.cast(v, tf.float64) if v.dtype.is_floating else v
+               for k, v in tensors.items()}
+    tensors.update(pinn.layers.CellListNL(rc=5.0)(tensors))
+    tensors['ind_3'] = _form_triplet(tensors)
+    g2 = dict(Rs=[1.0, 2.0, 3.0], eta=[0.5, 1.0, 2.0], i=8)
+    g4 = dict(lambd=[1.0, -1.0], zeta=[1.0, 4.0], eta=[0.1, 0.5], i=8, j=1)
+    for layer, kwargs in [(G2_SF, g2), (G4_SF, g4)]:
+        args = {k: tensors[k] for k in ['ind_2', 'dist', 'diff', 'elems', 'ind_3']}
+        if layer is G2_SF:
+            args.pop('diff'), args.pop('ind_3')
+        results = []
+        for with_cutoff in [False, True]:
+            sf = layer(**kwargs, cutoff=cutoff if with_cutoff else None)
+            with tf.GradientTape() as tape:
+                tape.watch(args['dist'])
+                fp = sf(**args, fc=None if with_cutoff else cutoff(args['dist']))[0]
+                loss = tf.reduce_sum(fp**2)
+            grad = tape.gradient(loss, args['dist'])
+            results.append((fp, tf.convert_to_tensor(grad)))
+        assert np.allclose(results[0][0], results[1][0])
+        assert np.allclose(results[0][1], results[1][1])
+
+
+@pytest.mark.forked
+@pytest.mark.parametrize('network', ['PiNet', 'PiNet2', 'BPNN'])
+def test_tabulated_basis(network):
+    """The tabulated basis is within the reported error bounds of the exact
+    cutoff+basis, and gives the same energies and forces"""
+    from pinn.layers import CutoffFunc, GaussianBasis, PolynomialBasis, \
+        CutoffBasis, TabulatedBasis
+    from pinn.benchmark import water_box, make_batch, default_networks
+    dist = tf.constant(np.random.uniform(0.1, 4.0, 1000), tf.float64)
+    for basis in [GaussianBasis(rc=4.0, n_basis=10, gamma=3.0), PolynomialBasis(6)]:
+        exact = CutoffBasis(CutoffFunc(4.0, 'f2'), basis)
+        table = TabulatedBasis(exact, 4.0, 500)
+        assert table.errors['value'] < 1e-8 and table.errors['derivative'] < 1e-6
+        results = []
+        for fn in [exact.call, table.call]:
+            with tf.GradientTape() as tape:
+                tape.watch(dist)
+                out = fn(dist)
+                columns = [out[:, b] for b in range(out.shape[1])]
+            results.append((out, tape.gradient(columns, dist)))
+        assert np.abs(results[0][0] - results[1][0]).max() <= table.errors['value']
+        assert np.abs(results[0][1] - results[1][1]).max() <= \
+            table.errors['derivative'] * out.shape[1]
+    # the table can be built while building a graph (e.g. in an estimator)
+    with tf.Graph().as_default():
+        assert TabulatedBasis(exact, 4.0, 500).errors == table.errors
+
+    tensors = make_batch([water_box(48, seed=i) for i in range(2)])
+    params = {**default_networks[network]['params'], 'rc': 4.0}
+    # untrained networks can give large energies, fix the initial weights
+    tf.random.set_seed(0)
+    nets = [pinn.get_network({'name': network, 'params': {**params, 'basis_table': n}})
+            for n in [None, 1000]]
+    for net in nets:
+        net(dict(tensors))
+    nets[1].set_weights(nets[0].get_weights())
+    results = []
+    for net in nets:
+        with tf.GradientTape() as tape:
+            tape.watch(tensors['coord'])
+            energy = tf.reduce_sum(net(dict(tensors)))
+        results.append((energy, tape.gradient(energy, tensors['coord'])))
+    assert np.allclose(results[0][0], results[1][0], rtol=1e-4)
+    forces = [f.numpy() for _, f in results]
+    assert np.abs(forces[0] - forces[1]).max() < 1e-3 * np.abs(forces[0]).max()
+
+
+@pytest.mark.forked
+@pytest.mark.parametrize('network', ['PiNet', 'PiNet2'])
+def test_project_atoms(network):
+    """Applying the first dense layer of the first block per atom gives the
+    same results as applying it to the concatenated properties of the pairs,
+    the preprocessing still gives the one-hot embedding"""
+    from pinn.layers import AtomicOnehot
+    from pinn.benchmark import water_box, make_batch, default_networks
+    tensors = make_batch([water_box(24, seed=i) for i in range(2)])
+    params = {**default_networks[network]['params'], 'depth': 2}
+    net = pinn.get_network({'name': network, 'params': params})
+    prop = 'prop' if network == 'PiNet' else 'p1'
+    inputs = net.preprocess(dict(tensors))
+    onehot = AtomicOnehot(params['atom_types'])(tensors['elems'])
+    assert np.array_equal(inputs[prop], tf.cast(onehot, tensors['coord'].dtype))
+    block = net.gc_blocks[0]
+    pi_layer = block.pi_layer if network == 'PiNet' else block.pi1_layer
+    results = []
+    for project_atoms in [True, False]:
+        pi_layer.project_atoms = project_atoms
+        with tf.GradientTape() as tape:
+            tape.watch(inputs['dist'])
+            energy = tf.reduce_sum(net(dict(inputs)))
+        results.append((energy, tape.gradient(energy, inputs['dist'])))
+    assert np.allclose(results[0][0], results[1][0], rtol=1e-5)
+    assert np.allclose(results[0][1], results[1][1], rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.forked
+@pytest.mark.parametrize('network', ['PiNet', 'PiNet2'])
+def test_recompute(network):
+    """Recomputing the interaction blocks gives the same forces and the same
+    (second order) gradients of a force loss, with tapes and in graph mode"""
+    from pinn.benchmark import water_box, make_batch, default_networks
+    batch = make_batch([water_box(24, seed=i) for i in range(2)])
+    params = {**default_networks[network]['params'], 'depth': 3}
+    net = pinn.get_network({'name': network, 'params': params})
+
+    def eager(tensors):
+        with tf.GradientTape() as outer:
+            with tf.GradientTape() as tape:
+                tape.watch(tensors['coord'])
+                energy = tf.reduce_sum(net(dict(tensors)))
+            forces = -tape.gradient(energy, tensors['coord'])
+            loss = tf.reduce_sum(forces**2)
+        grads = outer.gradient(loss, net.trainable_variables,
+                               unconnected_gradients='zero')
+        return [forces] + [tf.convert_to_tensor(g) for g in grads]
+
+    def graph(tensors):
+        energy = tf.reduce_sum(net(dict(tensors)))
+        forces = -tf.gradients(energy, tensors['coord'])[0]
+        loss = tf.reduce_sum(forces**2)
+        grads = tf.gradients(loss, net.trainable_variables,
+                             unconnected_gradients='zero')
+        return [forces] + [tf.convert_to_tensor(g) for g in grads]
+
+    results = []
+    for recompute in [False, True]:
+        net.recompute = recompute
+        results.append([x.numpy() for x in eager(batch)])
+    with tf.Graph().as_default():
+        tensors = {k: tf.constant(v) for k, v in batch.items()}
+        net = pinn.get_network({'name': network, 'params': params})
+        outputs = []
+        for recompute in [False, True]:
+            net.recompute = recompute
+            outputs.append(graph(tensors))
+        with tf.compat.v1.Session() as sess:
+            sess.run(tf.compat.v1.global_variables_initializer())
+            results += sess.run(outputs)
+    for ref, out in [results[:2], results[2:]]:
+        for x, y in zip(ref, out):
+            assert np.abs(x - y).max() <= 1e-4 * np.abs(x).max()
+
+
+@pytest.mark.forked
+def test_recompute_order():
+    """The recomputation depends on the upstream gradient through a data
+    dependency that survives the graph optimizations of a session"""
+    from pinn.utils import _after
+    with tf.Graph().as_default():
+        x = tf.constant([1.0, 2.0])
+        dep = tf.compat.v1.placeholder(tf.float32, [None, 3])
+        out = _after([x], dep)[0]
+        with tf.compat.v1.Session() as sess:
+            assert np.all(sess.run(out, {dep: np.ones([2, 3])}) == [1.0, 2.0])
+            assert np.all(np.isnan(sess.run(out, {dep: np.full([2, 3], np.nan)})))
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""Tests for the optimizers and the training ops"""
+import pytest
+import numpy as np
+import tensorflow as tf
+
+
+def _run_kalman(optimizer, n_steps=5, state=False):
+    # fit a small tanh regression problem with a given Kalman filter, and
+    # optionally return the non-trainable variables of the filter
+    from pinn.optimizers import get
+    np.random.seed(0)
+    x = np.random.uniform(-1, 1, [20, 3])
+    y = np.tanh(x @ np.random.uniform(-1, 1, [3, 2]))
+    with tf.Graph().as_default():
+        optimizer = get(optimizer)
+        optimizer.iterations = tf.compat.v1.train.get_or_create_global_step()
+        w = tf.Variable(np.full([3, 2], 0.1), dtype=tf.float64)
+        error = tf.reshape(y - tf.tanh(tf.constant(x) @ w), [-1])
+        train_op = optimizer.get_train_op(error, [w])
+        with tf.compat.v1.Session() as sess:
+            sess.run(tf.compat.v1.global_variables_initializer())
+            for i in range(n_steps):
+                sess.run(train_op)
+            if state:
+                return sess.run(w), sess.run(
+                    [v for v in tf.compat.v1.global_variables() if v is not w])
+            return sess.run(w)
+
+
+@pytest.mark.forked
+def test_lrgekf_full_rank():
+    # LRgEKF is exact as long as no correction is evicted
+    w_ref = _run_kalman({'class_name': 'gEKF',
+                         'config': {'learning_rate': 0.1}})
+    w_lr = _run_kalman({'class_name': 'LRgEKF',
+                        'config': {'learning_rate': 0.1, 'rank': 5}})
+    assert np.allclose(w_ref, w_lr)
+
+
+@pytest.mark.forked
+def test_lrgekf_eviction():
+    # P stays positive definite once old corrections are evicted
+    w_ref = _run_kalman({'class_name': 'gEKF',
+                         'config': {'learning_rate': 0.1}}, n_steps=12)
+    w_lr, state = _run_kalman({'class_name': 'LRgEKF',
+                               'config': {'learning_rate': 0.1, 'rank': 3}},
+                              n_steps=12, state=True)
+    d, U = [v for v in state if np.ndim(v) > 0]
+    assert U.shape == (3, 6)
+    assert np.all(d - np.sum(U**2, axis=0) > 0)
+    assert np.all(np.linalg.eigvalsh(np.diag(d) - U.T @ U) > 0)
+    assert np.all(np.isfinite(w_lr))
+    assert np.abs(w_lr - w_ref).max() < np.abs(w_ref - 0.1).max()
+
+
+@pytest.mark.forked
+def test_ekf_blocks():
+    # sequential block updates should match the joint EKF update
+    w_ref = _run_kalman({'class_name': 'EKF',
+                         'config': {'learning_rate': 0.1}})
+    w_blk = _run_kalman({'class_name': 'EKF',
+                         'config': {'learning_rate': 0.1, 'block_size': 7,
+                                    'jacob_chunk': 8}})
+    assert np.allclose(w_ref, w_blk)
+
+
+@pytest.mark.forked
+def test_accumulate_gradients():
+    # the averaged gradients should only be applied every accum_steps
+    from pinn.optimizers import get
+    from pinn.models.base import _accumulate_gradients
+    with tf.Graph().as_default():
+        optimizer = get({'class_name': 'SGD', 'config': {'learning_rate': 1.0}})
+        step = tf.compat.v1.train.get_or_create_global_step()
+        w = tf.Variable([1.0, 2.0])
+        g = tf.compat.v1.placeholder(tf.float32, [2])
+        train_op = _accumulate_gradients(optimizer, [g], [w], 3)
+        with tf.compat.v1.Session() as sess:
+            sess.run(tf.compat.v1.global_variables_initializer())
+            for grad in [[1., 0.], [0., 1.]]:
+                sess.run(train_op, {g: grad})
+                assert np.allclose(sess.run(w), [1., 2.])
+            sess.run(train_op, {g: [2., 2.]})
+            assert np.allclose(sess.run(w), [0., 1.])
+            # the global step counts the batches, the optimizer the updates
+            assert sess.run(step) == 3
+            assert sess.run(optimizer.iterations) == 1
+
+
+@pytest.mark.forked
+@pytest.mark.parametrize('optimizer, accum_steps, distribute', [
+    ('EKF', 2, False), ('LRgEKF', 1, True), ('Adam', 2, True)])
+def test_check_train_params(optimizer, accum_steps, distribute):
+    # unsupported combinations are rejected when the model is created
+    import pinn, tempfile
+    from shutil import rmtree
+    testpath = tempfile.mkdtemp()
+    params = {'model_dir': testpath,
+              'optimizer': {'class_name': optimizer, 'config': {'learning_rate': 0.1}},
+              'network': {'name': 'PiNet', 'params': {}},
+              'model': {'name': 'potential_model', 'params': {'accum_steps': accum_steps}}}
+    strategy = tf.distribute.OneDeviceStrategy('/cpu:0') if distribute else None
+    config = tf.estimator.RunConfig(train_distribute=strategy)
+    with pytest.raises(ValueError, match='accum_steps=2' if accum_steps > 1 else optimizer):
+        pinn.get_model(params, config=config)
+    rmtree(testpath)
+
+
+@pytest.mark.forked
+def test_summary_policy():
+    # summaries should only be created as requested by the policy
+    from pinn.models.base import MetricsCollector, get_train_op, HIST_SUMMARIES
+    def _summaries(**kwargs):
+        with tf.Graph().as_default():
+            metrics = MetricsCollector(tf.estimator.ModeKeys.TRAIN, **kwargs)
+            w = tf.Variable([1.0, 2.0])
+            metrics.add_error('E', tf.constant([1.0, 1.0]), w)
+            get_train_op({'class_name': 'EKF', 'config': {'learning_rate': 0.1}},
+                         metrics, [w])
+            hooks = metrics.summary_hooks('/tmp')
+            return [len(tf.compat.v1.get_collection(key)) for key in
+                    [tf.compat.v1.GraphKeys.SUMMARIES, HIST_SUMMARIES]], len(hooks)
+    assert _summaries(summary='off') == ([0, 0], 0)
+    assert _summaries(summary='scalar') == ([5, 0], 0)
+    assert _summaries(summary='hist') == ([10, 0], 0)
+    assert _summaries(summary='hist', hist_every=10) == ([5, 5], 1)
+
+
+@pytest.mark.forked
+@pytest.mark.parametrize('summary', ['off', 'scalar'])
+def test_throughput_stamp(summary):
+    # the input is only timestamped when the throughput is logged
+    import pinn, tempfile
+    from shutil import rmtree
+    from pinn.benchmark import water_box, make_batch
+    testpath = tempfile.mkdtemp()
+    params = {'model_dir': testpath,
+              'network': {'name': 'PiNet', 'params': {'rc': 3.0}},
+              'model': {'name': 'potential_model',
+                        'params': {'use_force': False, 'summary': summary}}}
+    model = pinn.get_model(params)
+    with tf.Graph().as_default() as graph:
+        tf.compat.v1.train.get_or_create_global_step()
+        features = make_batch([water_box(24)])
+        features['e_data'] = tf.zeros([1])
+        spec = model.model_fn(features, None, tf.estimator.ModeKeys.TRAIN, model.config)
+    n_stamps = sum(op.type == 'Timestamp' for op in graph.get_operations())
+    hooks = [type(hook).__name__ for hook in spec.training_hooks]
+    if summary == 'off':
+        assert n_stamps == 0 and 'ThroughputHook' not in hooks
+    else:
+        assert n_stamps == 2 and 'ThroughputHook' in hooks
+    rmtree(testpath)
+
+
+@pytest.mark.forked
+@pytest.mark.parametrize('optimizer', ['gEKF', 'LRgEKF'])
+def test_kalman_summaries(optimizer):
+    # the Kalman filters log their memory footprint and step time
+    from pinn.optimizers import get
+    with tf.Graph().as_default():
+        opt = get({'class_name': optimizer, 'config': {'learning_rate': 0.1}})
+        opt.iterations = tf.compat.v1.train.get_or_create_global_step()
+        w = tf.Variable([1.0, 2.0])
+        opt.get_train_op(w**2, [w])
+        tags = [op.name for op in tf.compat.v1.get_collection(
+            tf.compat.v1.GraphKeys.SUMMARIES)]
+    for tag in ['P_bytes', 'step_time', 'P_diag']:
+        assert f'KalmanFilter/{tag}:0' in tags
+    # the histogram of the full P matrix is off by default
+    assert 'KalmanFilter/P:0' not in tags
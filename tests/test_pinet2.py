@@ -97,3 +97,57 @@ class TestPiNet2:
         tf.debugging.assert_near(
             rotate(pix([ind_2, px]), 42.), pix([ind_2, rotate(px, 42.)])
         )
+
+    @pytest.mark.forked
+    def test_pixlayer_projection(self):
+        """Projecting per atom before the gather equals projecting the pairs"""
+        px = tf.random.uniform((10, 3, 5))
+        ind_2 = tf.random.uniform((30, 2), maxval=10, dtype=tf.int32)
+
+        pix = PIXLayer(weighted=True)
+        out = pix([ind_2, px])
+        ref = pix.wi(tf.gather(px, ind_2[:, 0])) + pix.wj(tf.gather(px, ind_2[:, 1]))
+        tf.debugging.assert_near(out, ref)
+
+    @pytest.mark.forked
+    def test_zero_p3_block(self):
+        """The first block short-circuits the zero p3 with the same results"""
+        from pinn.networks.pinet2 import GCBlock
+        n_atoms, n_pairs = 10, 40
+        ind_2 = tf.random.uniform((n_pairs, 2), maxval=n_atoms, dtype=tf.int32)
+        p1 = tf.random.uniform((n_atoms, 4))
+        p3 = tf.zeros((n_atoms, 3, 1))
+        diff = tf.random.uniform((n_pairs, 3))
+        basis = tf.random.uniform((n_pairs, 4))
+        block = GCBlock(True, [], [16, 16], [16, 16], activation='tanh')
+        inputs = [ind_2, p1, p3, diff, basis]
+        with tf.GradientTape() as tape:
+            tape.watch(diff)
+            ref = block(inputs)
+        ref_grad = tape.gradient(ref, diff)
+        block.zero_p3 = True
+        with tf.GradientTape() as tape:
+            tape.watch(diff)
+            out = block(inputs)
+        for x, y in zip(out, ref):
+            tf.debugging.assert_near(x, y)
+        tf.debugging.assert_near(tape.gradient(out, diff), ref_grad)
+
+    @pytest.mark.forked
+    def test_restore_v0_checkpoint(self):
+        """A PiNet2 checkpoint saved before the first block skipped its p3
+        layers restores with the same variables and outputs"""
+        import os
+        from pinn.export import restore_network
+        ckpt = os.path.join(os.path.dirname(__file__), 'examples/pinet2_v0/model.ckpt-0')
+        params = {'model_dir': None, 'network': {'name': 'PiNet2', 'params': {
+            'atom_types': [1, 8], 'rc': 3.0, 'depth': 2, 'n_basis': 4,
+            'pp_nodes': [4], 'pi_nodes': [4], 'ii_nodes': [4], 'out_nodes': [4]}}}
+        network = restore_network(params, ckpt)
+        rng = np.random.default_rng(0)
+        tensors = {'ind_1': tf.zeros([6, 1], tf.int32),
+                   'elems': tf.constant([8, 1, 1, 8, 1, 1]),
+                   'coord': tf.constant(rng.uniform(0, 3, [6, 3]), tf.float32)}
+        # per-atom outputs of the network that saved the checkpoint
+        ref = [-0.07536997, 0.17956857, 0.23224702, -0.07382760, 0.03461049, 0.21830381]
+        np.testing.assert_allclose(network(tensors), ref, atol=1e-5)
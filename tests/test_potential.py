@@ -152,6 +152,13 @@ def _potential_tests(params):
     model = pinn.get_model(params)
     results, _ = tf.estimator.train_and_evaluate(model, train_spec, eval_spec)
 
+    # The throughput should be logged during training
+    from glob import glob
+    tags = [v.tag for fname in glob(f"{params['model_dir']}/events.out.*")
+            for event in tf.compat.v1.train.summary_iterator(fname)
+            for v in event.summary.value]
+    assert 'THROUGHPUT/atoms_per_sec' in tags
+
     # The calculator should be accessable with model_dir
     atoms = Atoms('H3', positions=[[0, 0, 0], [0, 1, 0], [1, 1, 0]])
     calc = pinn.get_calc(params, properties=['energy', 'forces', 'stress'])
@@ -206,3 +213,125 @@ def _potential_tests(params):
     de = e_pred[-1] - e_pred[0]
     int_p = np.trapz(p_pred, x=l_range**3)
     assert np.allclose(de, int_p, rtol=1e-2)
+
+
+@pytest.mark.forked
+def test_batched_stress():
+    """The stress of a batch is computed per structure, with the volume of
+    each structure"""
+    import pinn
+    from pinn.benchmark import water_box, make_batch, default_networks
+    from pinn.models.potential import _get_stress
+    from pinn.utils import connect_dist_grad
+    structures = [water_box(n, seed=i) for i, n in enumerate([24, 48, 36])]
+    with tf.Graph().as_default():
+        network = pinn.get_network({'name': 'PiNet',
+                                    'params': default_networks['PiNet']['params']})
+
+        def stress(batch):
+            tensors = network.preprocess(batch)
+            connect_dist_grad(tensors)
+            pred = tf.math.unsorted_segment_sum(network(tensors),
+                                                tensors['ind_1'][:, 0],
+                                                tf.shape(tensors['cell'])[0])
+            return _get_stress(pred, tensors)
+
+        batched = stress(make_batch(structures))
+        single = [stress(make_batch([s])) for s in structures]
+        with tf.compat.v1.Session() as sess:
+            sess.run(tf.compat.v1.global_variables_initializer())
+            batched, single = sess.run([batched, single])
+    assert batched.shape == (3, 3, 3)
+    single = np.concatenate(single)
+    assert np.abs(batched - single).max() < 1e-4 * np.abs(single).max()
+
+
+@pytest.mark.forked
+@pytest.mark.parametrize('network', ['PiNet', 'BPNN'])
+def test_export(network):
+    """The exported SavedModel gives the same results as the estimator"""
+    import pinn
+    from pinn.benchmark import default_networks
+    from pinn.calculator import PiNN_saved_calc
+    from pinn.export import export_potential
+    testpath = tempfile.mkdtemp()
+    network_params = {**default_networks[network]['params'], 'rc': 5.}
+    if network == 'BPNN':
+        network_params.update(nn_spec={1: [8, 8]}, sf_spec=[
+            {'type': 'G2', 'i': 1, 'j': 1, 'eta': [0.1, 0.1], 'Rs': [1., 2.]}])
+    else:
+        network_params.update(atom_types=[1], depth=2)
+    params = {
+        'model_dir': f'{testpath}/model',
+        'network': {'name': network, 'params': network_params},
+        'model': {
+            'name': 'potential_model',
+            'params': {'use_force': True, 'e_dress': {1: 0.5},
+                       'e_scale': 5.0, 'e_unit': 2.0}}}
+    def train(): return load_numpy(_get_lj_data()).repeat().apply(sparse_batch(10))
+    pinn.get_model(params).train(train, steps=10)
+    export_potential(params['model_dir'], f'{testpath}/export')
+
+    molecule = Atoms('H4', positions=[[0, 0, 0], [0, 1, 0], [1, 1, 0], [1, 1.5, 1]])
+    crystal = molecule.copy()
+    crystal.set_cell([[4, 0, 0], [0.5, 4, 0], [0, 0, 4]])
+    crystal.set_pbc(True)
+    # the estimator predictor keeps its graph as default, so it goes last
+    results = []
+    for model in [f'{testpath}/export', params['model_dir']]:
+        calc = pinn.get_calc(model)
+        assert isinstance(calc, PiNN_saved_calc) == (model == f'{testpath}/export')
+        for atoms in [molecule, crystal]:
+            calc.calculate(atoms)
+            results.append(calc.results)
+    for saved, ref in zip(results[:2], results[2:]):
+        assert set(saved) == set(ref)
+        for k in ref:
+            assert np.allclose(saved[k], ref[k], rtol=1e-4, atol=1e-5)
+    rmtree(testpath)
+
+
+@pytest.mark.forked
+def test_ensemble():
+    """The ensemble gives the mean and the spread of its members"""
+    import pinn
+    from pinn.benchmark import default_networks
+    from pinn.calculator import PiNN_saved_calc
+    from pinn.export import (ExportedPotential, export_potential, load_potential,
+                             load_params, preprocess_key)
+    testpath = tempfile.mkdtemp()
+    model_dirs = []
+    # the first two models share the preprocessing
+    for i, rc in enumerate([5., 5., 4.]):
+        network_params = {**default_networks['PiNet']['params'],
+                          'rc': rc, 'atom_types': [1], 'depth': 2}
+        params = {
+            'model_dir': f'{testpath}/model{i}',
+            'network': {'name': 'PiNet', 'params': network_params},
+            'model': {'name': 'potential_model', 'params': {'use_force': True}}}
+        def train(): return load_numpy(_get_lj_data()).repeat().apply(sparse_batch(10))
+        pinn.get_model(params).train(train, steps=10)
+        model_dirs.append(params['model_dir'])
+    keys = [preprocess_key(load_params(d)['network']) for d in model_dirs]
+    assert keys[0] == keys[1] != keys[2]
+    export_potential(model_dirs, f'{testpath}/export')
+
+    crystal = Atoms('H4', positions=[[0, 0, 0], [0, 1, 0], [1, 1, 0], [1, 1.5, 1]],
+                    cell=[[4, 0, 0], [0.5, 4, 0], [0, 0, 4]], pbc=True)
+    members = []
+    for model_dir in model_dirs:
+        calc = PiNN_saved_calc(ExportedPotential(*load_potential(model_dir)))
+        calc.calculate(crystal)
+        members.append(calc.results)
+    members = {k: np.array([m[k] for m in members]) for k in members[0]}
+    for model in [model_dirs, f'{testpath}/export']:
+        calc = pinn.get_calc(model)
+        calc.calculate(crystal)
+        for k in ['energy', 'forces', 'stress']:
+            assert np.allclose(calc.results[k], members[k].mean(0), rtol=1e-4, atol=1e-5)
+        assert np.allclose(calc.results['energy_std'], members['energy'].std(), rtol=1e-4)
+        deviation = members['forces'] - members['forces'].mean(0)
+        assert np.allclose(calc.results['forces_std'],
+                           np.sqrt(np.mean(np.sum(deviation**2, axis=2), axis=0)),
+                           rtol=1e-4, atol=1e-5)
+    rmtree(testpath)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""Tests for the batched geometry optimizers"""
+
+import tempfile
+import pytest
+import numpy as np
+from shutil import rmtree
+from ase import Atoms
+from ase.constraints import FixAtoms
+from helpers import get_lj_model
+
+
+def _structures():
+    rng = np.random.default_rng(0)
+    grid = np.stack(np.meshgrid(*[np.arange(2)]*3), -1).reshape(-1, 3)
+    structures = []
+    for n_atoms in [8, 6, 8, 7, 5]:
+        positions = grid[:n_atoms]*2.0 + rng.uniform(-0.3, 0.3, [n_atoms, 3])
+        structures.append(Atoms(f'H{n_atoms}', positions=positions,
+                                cell=[4, 4, 4], pbc=True))
+    structures[1].set_constraint(FixAtoms([0, 1]))
+    return structures
+
+
+@pytest.mark.forked
+@pytest.mark.parametrize('optimizer', ['FIRE', 'LBFGS'])
+def test_relax(optimizer):
+    """The batched optimizers follow the ASE optimizers for each structure,
+    while converged structures are dropped from the batch and new ones are
+    added"""
+    import pinn
+    import ase.optimize
+    import pinn.relax
+    from ase.io import read
+    from pinn.export import export_potential
+    testpath = tempfile.mkdtemp()
+    params = get_lj_model(f'{testpath}/model')
+    export_potential(params['model_dir'], f'{testpath}/export')
+    structures = _structures()
+    # reference trajectories, with the maximum force at each step
+    calc = pinn.get_calc(f'{testpath}/export', properties=['energy', 'forces'])
+    trajs = []
+    for atoms in structures:
+        atoms = atoms.copy()
+        atoms.calc = calc
+        traj = []
+        opt = getattr(ase.optimize, optimizer)(atoms, logfile=None)
+        opt.attach(lambda: traj.append(
+            (np.linalg.norm(atoms.get_forces(), axis=1).max(), atoms.positions.copy())))
+        opt.run(fmax=0., steps=8)
+        trajs.append(traj)
+    # a threshold far from the forces, such that the structures converge at
+    # different steps
+    forces = np.sort([f for traj in trajs for f, _ in traj])
+    gaps = sorted(zip(np.diff(forces), (forces[1:] + forces[:-1])/2), reverse=True)
+    for _, fmax in gaps:
+        n_steps = [next((n for n, (f, _) in enumerate(traj) if f < fmax), 8)
+                   for traj in trajs]
+        if len(set(n_steps)) > 1:
+            break
+    assert len(set(n_steps)) > 1
+
+    opt = getattr(pinn.relax, optimizer)(f'{testpath}/export', batch_size=2)
+    results = opt.run(structures, fmax=fmax, steps=8,
+                      output=f'{testpath}/relaxed.xyz')
+    assert [atoms.info['steps'] for atoms in results] == n_steps
+    assert [atoms.info['converged'] for atoms in results] == \
+        [traj[n][0] < fmax for traj, n in zip(trajs, n_steps)]
+    for traj, n, atoms in zip(trajs, n_steps, results):
+        assert np.allclose(traj[n][1], atoms.positions, atol=1e-4)
+    assert np.allclose(results[1].positions[:2], structures[1].positions[:2])
+    assert len(read(f'{testpath}/relaxed.xyz', ':')) == 5
+    rmtree(testpath)